@@ -1,27 +1,63 @@
+import time
+STARTUP_STARTED = time.perf_counter()
 import customtkinter as ctk
 import tkinter as tk
 from tkinter import messagebox, simpledialog, font as tkfont, colorchooser, filedialog
-import google.generativeai as genai
-import google.api_core.exceptions
 import json
 import os
 import threading
-from PIL import Image
 import shutil
 import datetime
-import time
-import requests
+import collections
+import re
+import contextlib
+import argparse
+import functools
+import importlib
+import base64
+import io
+import sys
+import traceback
+from content_assist_core import (
+    APP_NAME, OPENROUTER_BASE_URL, BACKUP_FOLDER, AUTOCOMPLETE_MAX_PHRASE_WORDS,
+    AUTOCOMPLETE_MAX_SUGGESTIONS, PALETTE_MAX_RESULTS, rich_content_to_plain_text,
+    prepare_rich_content, text_dump_to_rich_content, markdown_tag_spans,
+    replace_rich_content_ranges, run_find_replace, format_find_replace_throughput,
+    benchmark_find_replace, LAZY_IMPORT_SECONDS, require_module, load_genai, HTTP_CLIENT,
+    LatencyRecorder, PagePrefetcher, CompletionIndex, SearchIndex, SearchWorker, DuplicateDetector,
+    CommandIndex, ChunkRetriever, project_page_keys, ModelCatalog, MODEL_CATALOG_SUFFIX, ModelCatalogStore,
+    refresh_model_catalog, format_catalog_age, build_context_content,
+    generate_ai_response, stream_ai_response,
+    extract_ai_text, describe_ai_error, AI_JOB_INTERACTIVE, AI_JOB_PRIORITY_LABELS, AI_MAX_CONCURRENT_JOBS,
+    AIJobScheduler, apply_ai_job_text, BatchRun, RESPONSE_CACHE_SUFFIX, ResponseCache, sidecar_path, AppState
+)
+IMPORTS_FINISHED = time.perf_counter()
 
 # --- Configuration ---
-APP_NAME = "AI Content Assistant - By Abstracto"
-DATA_FILE = "ai_assistant_data_v2_1.json"
-DEFAULT_FOLDER_NAME = "Story Line"
-DEFAULT_MODEL = "gemini-1.5-flash-latest"
-DEFAULT_API_PROVIDER = "google"
 ICONS_FOLDER = "icons"
-BACKUP_FOLDER = "backups"
-MAX_BACKUPS = 10
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+ICON_BUNDLE_MODULE = "icon_bundle"
+PREFETCH_NEIGHBOURS = 2
+AUTOCOMPLETE_MIN_PREFIX = 3
+SEARCH_DEBOUNCE_MS = 150
+DUPLICATE_REPORT_CLUSTERS = 100
+SIDEBAR_PAGE_WINDOW = 150
+MODEL_LIST_ROWS = 14
+MODEL_CONTEXT_FILTERS = {"Any context": 0, "32k+": 32_000, "128k+": 128_000, "1M+": 1_000_000}
+ALL_PROVIDERS_LABEL = "All providers"
+DEFAULT_SLOW_HANDLER_MS = 100
+HEARTBEAT_INTERVAL_MS = 250
+SLOW_HANDLER_LOG_SIZE = 200
+CONTINUATION_CONTEXT_CHARS = 4000
+STREAM_FLUSH_INTERVAL_MS = 50
+STREAM_CHARS_PER_TOKEN = 4
+BATCH_RESULT_MODE_LABELS = {"Append to page": "append", "Replace page": "replace", "Write to new page": "new page"}
+BATCH_PARALLELISM_CHOICES = ["1", "2", "4", "6", "8"]
+DEFAULT_BATCH_PARALLELISM = "4"
+BATCH_PROGRESS_INTERVAL_MS = 1000
+CONTINUATION_MAX_CHARS = 400
+CONTINUATION_SYSTEM_PROMPT = "Continue the following text naturally from exactly where it stops. Reply with the continuation only, at most two sentences, without repeating any of the given text:"
+INVALID_MODEL_NAMES = ["No models found", "API Key Required", "Permission Denied", "Error Fetching Models"]
+AUTOCOMPLETE_IGNORED_KEYS = {"Up", "Down", "Tab", "Escape", "Shift_L", "Shift_R", "Control_L", "Control_R", "Alt_L", "Alt_R", "Caps_Lock"}
 
 # Define expected icon filenames (add more if you use them)
 ICON_FILENAMES = {
@@ -39,377 +75,389 @@ ICON_FILENAMES = {
     "clear": "clear.png",
 }
 
-# --- Helper Function for Icons (using CTkImage) ---
-def load_icon_ctk(filename_key, size=(16, 16)):
-    """Loads an icon and returns a CTkImage."""
-    filename = ICON_FILENAMES.get(filename_key, f"{filename_key}.png")
-    path = os.path.join(ICONS_FOLDER, filename)
-    try:
-        img = Image.open(path)
-        return ctk.CTkImage(light_image=img, dark_image=img, size=size)
-    except FileNotFoundError:
-        print(f"Warning: Icon file not found: {path}")
-        try:
-            placeholder_img = Image.new('RGBA', size, (0,0,0,0))
-            return ctk.CTkImage(light_image=placeholder_img, dark_image=placeholder_img, size=size)
-        except Exception as e:
-            print(f"Error creating placeholder icon: {e}")
-            return None
-    except Exception as e:
-        print(f"Error loading icon {filename}: {e}")
-        return None
-
-
-# --- Application State Management ---
-class AppState:
-    def __init__(self, filename=DATA_FILE):
-        self.filename = os.path.abspath(filename)
-        self.data = {
-            "api_keys": {},
-            "selected_api_key_name": None,
-            "selected_model_name": DEFAULT_MODEL,
-            "appearance_mode": "System",
-            "folders": {},
-            "references": {},
-            "api_provider": DEFAULT_API_PROVIDER,
-            "show_free_models_only": True
-        }
-        if not self.load_data():
-            if not self.data["folders"]:
-                self.add_folder(DEFAULT_FOLDER_NAME, initialize_default=True)
-            if not self.data["api_keys"]:
-                self.data["api_keys"]["Default Key"] = ""
-                self.data["selected_api_key_name"] = "Default Key"
-
-    def get_api_provider(self):
-        return self.data.get("api_provider", DEFAULT_API_PROVIDER)
-    
-    def set_api_provider(self, provider):
-        if provider in ["google", "openrouter"]:
-            self.data["api_provider"] = provider
-            self.save_data()
-            return True
-        return False
-    
-    def get_show_free_models_only(self):
-        return self.data.get("show_free_models_only", True)
-    
-    def set_show_free_models_only(self, value):
-        self.data["show_free_models_only"] = bool(value)
-        self.save_data()
-
-    # --- Backup ---
-    def create_backup(self, max_backups=MAX_BACKUPS):
-        """Creates a timestamped backup of the current data file."""
-        if not os.path.exists(self.filename):
-            print("Backup skipped: Main data file does not exist yet.")
-            return
-
-        if not os.path.exists(BACKUP_FOLDER):
+# --- Icons (using CTkImage) ---
+class IconRegistry:
+    """Process-wide, lazily filled cache of icons.
+
+    Source images are decoded once per name, from the generated icon bundle module when it
+    exists (see pack_icon_bundle) and otherwise from ICONS_FOLDER; CTkImage objects are
+    memoized per (name, size) so every window and dialog shares them. Missing icons get a
+    transparent placeholder and a single warning.
+    """
+    def __init__(self, folder=ICONS_FOLDER):
+        self.folder = folder
+        self._bundle = None
+        self._images = {}
+        self._icons = {}
+        self.stats = {"hits": 0, "bundle_loads": 0, "file_loads": 0, "placeholders": 0, "seconds": 0.0}
+
+    def _bundled_icons(self):
+        if self._bundle is None:
             try:
-                os.makedirs(BACKUP_FOLDER)
-                print(f"Created backup directory: {BACKUP_FOLDER}")
-            except OSError as e:
-                print(f"Error creating backup directory {BACKUP_FOLDER}: {e}")
-                return
-
+                self._bundle = dict(importlib.import_module(ICON_BUNDLE_MODULE).ICONS)
+            except (ImportError, AttributeError):
+                self._bundle = {}
+        return self._bundle
+
+    def _source_image(self, name):
+        if name in self._images:
+            return self._images[name]
+        filename = ICON_FILENAMES.get(name, f"{name}.png")
+        encoded = self._bundled_icons().get(filename)
+        image = None
         try:
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            base_filename = os.path.basename(self.filename)
-            backup_filename = f"{base_filename}.{timestamp}.bak"
-            backup_path = os.path.join(BACKUP_FOLDER, backup_filename)
-
-            shutil.copy2(self.filename, backup_path)
-            print(f"Backup created: {backup_path}")
-
-            backups = sorted(
-                [os.path.join(BACKUP_FOLDER, f) for f in os.listdir(BACKUP_FOLDER) if f.startswith(base_filename) and f.endswith(".bak")],
-                key=os.path.getmtime
-            )
-
-            if len(backups) > max_backups:
-                num_to_delete = len(backups) - max_backups
-                for i in range(num_to_delete):
-                    try:
-                        os.remove(backups[i])
-                        print(f"Deleted old backup: {backups[i]}")
-                    except OSError as e:
-                        print(f"Error deleting old backup {backups[i]}: {e}")
-
+            Image = require_module("PIL.Image", "Icons")
+            if encoded:
+                image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+                image.load()
+                self.stats["bundle_loads"] += 1
+            else:
+                path = os.path.join(self.folder, filename)
+                image = Image.open(path)
+                image.load()
+                self.stats["file_loads"] += 1
+        except FileNotFoundError:
+            print(f"Warning: Icon file not found: {os.path.join(self.folder, filename)}")
         except Exception as e:
-            print(f"Error during backup creation or cleanup: {e}")
-
-
-    def get_appearance_mode(self):
-        return self.data.get("appearance_mode", "System")
-
-    def set_appearance_mode(self, mode):
-        if mode in ["System", "Light", "Dark"]:
-            self.data["appearance_mode"] = mode
-            self.save_data()
-            return True
-        return False
-
-    def load_data(self):
-        """Loads data from self.filename."""
-        print(f"Loading data from: {self.filename}")
-        if os.path.exists(self.filename):
-            try:
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    loaded_data = json.load(f)
-                print(f"Successfully loaded data: {loaded_data.keys()}")
-                
-                if "folders" in loaded_data:
-                    self.data["folders"] = loaded_data["folders"]
-                    print(f"Loaded folders: {list(self.data['folders'].keys())}")
-                
-                if "api_keys" in loaded_data:
-                    self.data["api_keys"] = loaded_data["api_keys"]
-                
-                if "selected_api_key_name" in loaded_data:
-                    self.data["selected_api_key_name"] = loaded_data["selected_api_key_name"]
-                
-                if "selected_model_name" in loaded_data:
-                    self.data["selected_model_name"] = loaded_data["selected_model_name"]
-                
-                if "appearance_mode" in loaded_data:
-                    self.data["appearance_mode"] = loaded_data["appearance_mode"]
-                
-                if "references" in loaded_data:
-                    self.data["references"] = loaded_data["references"]
-                
-                if "api_provider" in loaded_data:
-                    self.data["api_provider"] = loaded_data["api_provider"]
-                
-                if "show_free_models_only" in loaded_data:
-                    self.data["show_free_models_only"] = loaded_data["show_free_models_only"]
-                
-                return True
-            except Exception as e:
-                print(f"Error loading data: {e}")
-                return False
-        else:
-            print(f"Data file not found: {self.filename}")
-            return False
-
-    def save_data(self):
-        """Saves data to self.filename."""
+            print(f"Error loading icon {filename}: {e}")
+        self._images[name] = image
+        return image
+
+    def get(self, name, size=(16, 16)):
+        """Returns the CTkImage for an icon name at the given size, loading it on first use."""
+        key = (name, tuple(size))
+        icon = self._icons.get(key)
+        if icon is not None:
+            self.stats["hits"] += 1
+            return icon
+        started = time.perf_counter()
+        image = self._source_image(name)
         try:
-            if self.data["selected_api_key_name"] not in self.data["api_keys"] and self.data["selected_api_key_name"] is not None:
-                 self.data["selected_api_key_name"] = next(iter(self.data["api_keys"]), None) if self.data["api_keys"] else None
-
-            directory = os.path.dirname(self.filename)
-            if directory and not os.path.exists(directory):
-                os.makedirs(directory)
-
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=4, ensure_ascii=False)
-        except IOError as e:
-            print(f"Error saving data to {self.filename}: {e}")
-            messagebox.showerror("Save Error", f"Could not save data to {self.filename}:\n{e}", parent=None)
+            if image is None:
+                image = require_module("PIL.Image", "Icons").new('RGBA', key[1], (0,0,0,0))
+                self.stats["placeholders"] += 1
+            icon = ctk.CTkImage(light_image=image, dark_image=image, size=key[1])
         except Exception as e:
-             print(f"Unexpected error saving data to {self.filename}: {e}")
-             messagebox.showerror("Save Error", f"An unexpected error occurred while saving to {self.filename}:\n{e}", parent=None)
-
-
-    # --- API Key Management (unchanged) ---
-    def get_api_key_names(self):
-        return list(self.data["api_keys"].keys())
-
-    def get_api_key_value(self, key_name):
-        return self.data["api_keys"].get(key_name, "")
-
-    def add_or_update_api_key(self, key_name, key_value):
-        key_name = key_name.strip()
-        if key_name:
-            self.data["api_keys"][key_name] = key_value.strip()
-            if len(self.data["api_keys"]) == 1 or self.data["selected_api_key_name"] is None:
-                self.set_selected_api_key_name(key_name)
-            self.save_data()
-            return True
-        return False
-
-    def delete_api_key(self, key_name):
-         if key_name in self.data["api_keys"]:
-             if len(self.data["api_keys"]) == 1:
-                  pass
-
-             del self.data["api_keys"][key_name]
-             if self.data["selected_api_key_name"] == key_name:
-                 self.data["selected_api_key_name"] = next(iter(self.data["api_keys"]), None) if self.data["api_keys"] else None
-             self.save_data()
-             return True
-         return False
-
-    def set_selected_api_key_name(self, key_name):
-         if key_name in self.data["api_keys"] or key_name is None:
-             self.data["selected_api_key_name"] = key_name
-             self.save_data()
-             return True
-         return False
-
-    def get_selected_api_key_name(self):
-         if self.data["selected_api_key_name"] not in self.data["api_keys"] and self.data["selected_api_key_name"] is not None:
-              first_key = next(iter(self.data["api_keys"]), None) if self.data["api_keys"] else None
-              self.data["selected_api_key_name"] = first_key
-         return self.data["selected_api_key_name"]
-
-    def get_selected_api_key_value(self):
-        key_name = self.get_selected_api_key_name()
-        return self.get_api_key_value(key_name) if key_name else ""
-
-    # --- Model Management (unchanged) ---
-    def set_selected_model(self, model_name):
-        self.data["selected_model_name"] = model_name
-        self.save_data()
-
-    def get_selected_model(self):
-        return self.data.get("selected_model_name", DEFAULT_MODEL)
-
-    # --- Folder/Page/Function Management (unchanged structure, save calls already present) ---
-    def get_folders(self):
-        return list(self.data["folders"].keys())
-
-    def add_folder(self, folder_name, initialize_default=False):
-        folder_name = folder_name.strip()
-        if folder_name and folder_name not in self.data["folders"]:
-            self.data["folders"][folder_name] = {"pages": {}, "functions": {}}
-            if initialize_default:
-                self.data["folders"][folder_name]["functions"] = {
-                    "Summarize": "Summarize the following text concisely:",
-                    "Describe Scene": "Expand the following scene description with more sensory details (sight, sound, smell, touch) and atmosphere:",
-                    "Generate Dialogue": "Write realistic dialogue between [Character A] and [Character B] based on the following context. Ensure their voices are distinct:\nContext:",
-                    "Improve Flow": "Rewrite the following text to improve the flow, transitions, and readability:",
-                    "Show, Don't Tell": "Rewrite the following sentence(s) to 'show' the emotion/action rather than 'telling' it:",
-                    "Character Reaction": "Describe how [Character Name] would realistically react emotionally and physically to the preceding events:",
-                    "Suggest Twist": "Based on the preceding text, suggest one surprising but plausible plot twist or complication:",
-                    "Fix Grammar": "Correct any grammar and spelling errors in the following text:",
-                }
-            self.save_data()
-            return True
-        return False
+            print(f"Error creating icon {name}: {e}")
+            return None
+        finally:
+            self.stats["seconds"] += time.perf_counter() - started
+        self._icons[key] = icon
+        return icon
 
-    def delete_folder(self, folder_name):
-         if folder_name in self.data["folders"]:
-             if len(self.data["folders"]) == 1:
-                 return False
+    def format_stats(self):
+        stats = self.stats
+        return (f"{len(self._icons)} icons in {stats['seconds'] * 1000:.1f} ms "
+                f"({stats['bundle_loads']} from bundle, {stats['file_loads']} from files, "
+                f"{stats['placeholders']} placeholders, {stats['hits']} cache hits)")
 
-             del self.data["folders"][folder_name]
-             self.save_data()
-             return True
-         return False
 
-    def get_pages(self, folder_name):
-        return list(self.data["folders"].get(folder_name, {}).get("pages", {}).keys())
+ICON_REGISTRY = IconRegistry()
 
-    def add_page(self, folder_name, page_name):
-        page_name = page_name.strip()
-        if folder_name in self.data["folders"] and page_name and page_name not in self.data["folders"][folder_name]["pages"]:
-            self.data["folders"][folder_name]["pages"][page_name] = {"content": [], "notes": ""}
-            self.save_data()
-            return True
-        return False
-
-    def delete_page(self, folder_name, page_name):
-        if folder_name in self.data["folders"] and page_name in self.data["folders"][folder_name]["pages"]:
-            del self.data["folders"][folder_name]["pages"][page_name]
-            self.save_data()
-            return True
-        return False
 
-    def get_page_content(self, folder_name, page_name):
-        """Gets the content for a specific page, handling both old and new formats."""
+def load_icon_ctk(filename_key, size=(16, 16)):
+    """Returns a shared CTkImage for an icon from the process-wide registry."""
+    return ICON_REGISTRY.get(filename_key, size)
+
+
+def _registry_icon(name, size=(18, 18)):
+    """Class attribute that fetches an icon from the registry the first time a widget uses it."""
+    return property(lambda self: ICON_REGISTRY.get(name, size))
+
+
+def pack_icon_bundle(folder=ICONS_FOLDER):
+    """Writes every PNG in the icons folder into a base64 icon bundle module next to this script."""
+    icons = {}
+    for filename in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+        if filename.lower().endswith(".png"):
+            with open(os.path.join(folder, filename), "rb") as f:
+                icons[filename] = base64.b64encode(f.read()).decode("ascii")
+    bundle_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{ICON_BUNDLE_MODULE}.py")
+    with open(bundle_path, "w", encoding="utf-8") as f:
+        f.write(f"# Generated by {os.path.basename(__file__)} --pack-icons; do not edit.\n")
+        f.write("ICONS = {\n")
+        for filename, encoded in icons.items():
+            f.write(f"    {filename!r}: {encoded!r},\n")
+        f.write("}\n")
+    print(f"Packed {len(icons)} icons from '{folder}' into {bundle_path}")
+    return bundle_path
+
+
+class StartupProfiler:
+    """Times the startup phases (imports, state load, window construction, first idle, backup)."""
+    def __init__(self, started=STARTUP_STARTED):
+        self.started = started
+        self._last = started
+        self.phases = []
+        self.exit_code = 0
+
+    def mark(self, phase, at=None):
+        now = time.perf_counter() if at is None else at
+        self.phases.append((phase, (now - self._last) * 1000))
+        self._last = now
+
+    def elapsed_ms(self, phase=None):
+        """Milliseconds from process start to the end of the given phase (or to the last mark)."""
+        total = 0.0
+        for name, phase_ms in self.phases:
+            total += phase_ms
+            if name == phase:
+                break
+        return total
+
+    def format_report(self):
+        lines = ["Startup profile:"]
+        for name, phase_ms in self.phases:
+            lines.append(f"  {name:<28}{phase_ms:8.1f} ms")
+        lines.append(f"  {'total':<28}{self.elapsed_ms():8.1f} ms")
+        lines.append(f"  icons: {ICON_REGISTRY.format_stats()}")
+        return "\n".join(lines)
+
+
+def _handler_name(func):
+    """Readable name for a Tk callback: qualified name, plus the line for lambdas."""
+    if isinstance(func, functools.partial):
+        return f"partial({_handler_name(func.func)})"
+    name = getattr(func, "__qualname__", None) or getattr(func, "__name__", None) or repr(func)
+    code = getattr(func, "__code__", None)
+    if "<lambda>" in name and code is not None:
+        name = f"{name}:{code.co_firstlineno}"
+    return name
+
+
+class EventLoopInstrumentation:
+    """Opt-in timing of every Tk callback (bindings, after/after_idle, variable traces).
+
+    install() patches the tkinter registration methods process-wide, so it must run before
+    the window is built. Each callback's wall time goes into a per-handler LatencyRecorder.
+    A watchdog thread samples the main thread's stack while a callback is running longer
+    than slow_ms, and the slow call is logged with that stack once it returns. A heartbeat
+    after() probe records how late the event loop runs it.
+    """
+    def __init__(self, slow_ms=DEFAULT_SLOW_HANDLER_MS):
+        self.slow_ms = slow_ms
+        self.handlers = {}
+        self.total_ms = collections.Counter()
+        self.loop_lag = LatencyRecorder()
+        self.slow_events = collections.deque(maxlen=SLOW_HANDLER_LOG_SIZE)
+        self._active = []
+        self._main_thread_id = threading.get_ident()
+        self._original_after = tk.Misc.after
+        self._installed = False
+
+    def install(self):
+        if self._installed:
+            return
+        self._installed = True
+        instrumentation = self
+        original_bind = tk.Misc.bind
+        original_bind_all = tk.Misc.bind_all
+        original_tag_bind = tk.Text.tag_bind
+        original_after = tk.Misc.after
+        original_after_idle = tk.Misc.after_idle
+        original_trace_add = tk.Variable.trace_add
+
+        def bind(widget, sequence=None, func=None, add=None):
+            return original_bind(widget, sequence, instrumentation.wrap(func), add)
+
+        def bind_all(widget, sequence=None, func=None, add=None):
+            return original_bind_all(widget, sequence, instrumentation.wrap(func), add)
+
+        def tag_bind(widget, tagName, sequence, func, add=None):
+            return original_tag_bind(widget, tagName, sequence, instrumentation.wrap(func), add)
+
+        def after(widget, ms, func=None, *args):
+            return original_after(widget, ms, instrumentation.wrap(func), *args)
+
+        def after_idle(widget, func, *args):
+            return original_after_idle(widget, instrumentation.wrap(func), *args)
+
+        def trace_add(variable, mode, callback):
+            return original_trace_add(variable, mode, instrumentation.wrap(callback))
+
+        tk.Misc.bind = bind
+        tk.Misc.bind_all = bind_all
+        tk.Text.tag_bind = tag_bind
+        tk.Misc.after = after
+        tk.Misc.after_idle = after_idle
+        tk.Variable.trace_add = trace_add
+        threading.Thread(target=self._watchdog, name="slow-handler-watchdog", daemon=True).start()
+
+    def wrap(self, func):
+        if not callable(func) or getattr(func, "_instrumented", False):
+            return func
+        name = _handler_name(func)
+
+        def handler(*args):
+            entry = [name, time.perf_counter(), None]
+            self._active.append(entry)
+            try:
+                return func(*args)
+            finally:
+                self._active.pop()
+                self._record(entry)
+
+        handler._instrumented = True
+        handler.__name__ = getattr(func, "__name__", "handler")
+        return handler
+
+    def _record(self, entry):
+        name, started, stack = entry
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        recorder = self.handlers.get(name)
+        if recorder is None:
+            recorder = self.handlers[name] = LatencyRecorder()
+        recorder.record(elapsed_ms)
+        self.total_ms[name] += elapsed_ms
+        if elapsed_ms >= self.slow_ms:
+            self.slow_events.append({"handler": name, "ms": round(elapsed_ms, 1), "at": datetime.datetime.now().isoformat(timespec="seconds"), "stack": stack})
+            print(f"Slow handler: {name} took {elapsed_ms:.0f} ms")
+            if stack:
+                print(stack.rstrip())
+
+    def _watchdog(self):
+        interval = max(self.slow_ms / 2000.0, 0.01)
+        while True:
+            time.sleep(interval)
+            try:
+                entry = self._active[-1]
+            except IndexError:
+                continue
+            if entry[2] is None and (time.perf_counter() - entry[1]) * 1000 >= self.slow_ms:
+                frame = sys._current_frames().get(self._main_thread_id)
+                if frame is not None:
+                    entry[2] = "".join(traceback.format_stack(frame))
+
+    def start_heartbeat(self, root):
+        """Schedules the lag probe; it bypasses the wrapped after() so it is not counted as a handler."""
+        expected = time.perf_counter() + HEARTBEAT_INTERVAL_MS / 1000.0
         try:
-            page_data = self.data["folders"].get(folder_name, {}).get("pages", {}).get(page_name, {})
-            
-            if isinstance(page_data, list):
-                return page_data
-            elif isinstance(page_data, dict):
-                return page_data.get("content", [])
-            else:
-                return []
-        except Exception as e:
-            print(f"Error getting page content: {e}")
-            return []
-    def update_page_content(self, folder_name, page_name, rich_content_dump):
-        if folder_name in self.data["folders"] and page_name in self.data["folders"][folder_name]["pages"]:
-            if isinstance(self.data["folders"][folder_name]["pages"][page_name], dict):
-                 self.data["folders"][folder_name]["pages"][page_name]["content"] = rich_content_dump
-            else:
-                 self.data["folders"][folder_name]["pages"][page_name] = {"content": rich_content_dump, "notes": ""}
-            self.save_data()
-            return True
-        return False
-
-    def get_page_notes(self, folder_name, page_name):
-        page_data = self.data["folders"].get(folder_name, {}).get("pages", {}).get(page_name, {})
-        return page_data.get("notes", "")
-
-    def update_page_notes(self, folder_name, page_name, notes):
-        if folder_name in self.data["folders"] and page_name in self.data["folders"][folder_name]["pages"]:
-             if isinstance(self.data["folders"][folder_name]["pages"][page_name], dict):
-                 self.data["folders"][folder_name]["pages"][page_name]["notes"] = notes
-                 self.save_data()
-                 return True
-        return False
-
-    def get_functions(self, folder_name):
-        return self.data["folders"].get(folder_name, {}).get("functions", {})
-
-    def add_or_update_function(self, folder_name, func_name, system_prompt):
-        func_name = func_name.strip()
-        if folder_name in self.data["folders"] and func_name:
-            if "functions" not in self.data["folders"][folder_name]:
-                self.data["folders"][folder_name]["functions"] = {}
-            self.data["folders"][folder_name]["functions"][func_name] = system_prompt.strip()
-            self.save_data()
-            return True
-        return False
-
-    def delete_function(self, folder_name, func_name):
-        if folder_name in self.data["folders"] and "functions" in self.data["folders"][folder_name] and func_name in self.data["folders"][folder_name]["functions"]:
-            del self.data["folders"][folder_name]["functions"][func_name]
-            self.save_data()
-            return True
-        return False
+            self._original_after(root, HEARTBEAT_INTERVAL_MS, self._heartbeat, root, expected)
+        except tk.TclError:
+            pass
 
-    def add_reference(self, folder_name, page_name):
-        """Adds a page to the references list."""
-        ref_key = f"{folder_name}/{page_name}"
-        if ref_key not in self.data.get("references", {}):
-            if not self.data.get("references"):
-                self.data["references"] = {}
-            self.data["references"][ref_key] = {"folder": folder_name, "page": page_name}
-            self.save_data()
-            return True
-        return False
+    def _heartbeat(self, root, expected):
+        self.loop_lag.record(max(0.0, (time.perf_counter() - expected) * 1000))
+        self.start_heartbeat(root)
+
+    def handler_rows(self):
+        """Per-handler stats, slowest p95 first."""
+        rows = []
+        for name, recorder in list(self.handlers.items()):
+            summary = recorder.summary()
+            summary["handler"] = name
+            summary["total_ms"] = round(self.total_ms[name], 1)
+            rows.append(summary)
+        rows.sort(key=lambda row: row["p95"], reverse=True)
+        return rows
+
+    def to_dict(self):
+        return {
+            "slow_handler_ms": self.slow_ms,
+            "heartbeat_interval_ms": HEARTBEAT_INTERVAL_MS,
+            "event_loop_lag": self.loop_lag.summary(),
+            "handlers": self.handler_rows(),
+            "slow_events": list(self.slow_events),
+        }
 
-    def remove_reference(self, folder_name, page_name):
-        """Removes a page from the references list."""
-        ref_key = f"{folder_name}/{page_name}"
-        if ref_key in self.data.get("references", {}):
-            del self.data["references"][ref_key]
-            self.save_data()
-            return True
-        return False
 
-    def get_references(self):
-        """Returns the list of reference pages."""
-        return self.data.get("references", {})
+# Set from the command line (--instrument) before the window is built.
+EVENT_LOOP_INSTRUMENTATION = None
 
 
 # --- Main Application UI ---
 class App(ctk.CTk):
+    icon_folder = _registry_icon("folder")
+    icon_page = _registry_icon("page")
+    icon_add = _registry_icon("add")
+    icon_delete = _registry_icon("delete")
+    icon_settings = _registry_icon("settings")
+    icon_bold = _registry_icon("bold")
+    icon_italic = _registry_icon("italic")
+    icon_underline = _registry_icon("underline")
+    icon_refresh = _registry_icon("refresh")
+    icon_save = _registry_icon("save")
+    icon_load = _registry_icon("load")
+    icon_clear = _registry_icon("clear", (14, 14))
+
     def __init__(self, app_state):
         super().__init__()
         self.app_state = app_state
         self.current_folder = None
         self.current_page = None
-        self.ai_is_running = False
+        self.ai_scheduler = AIJobScheduler()
+        self.ai_scheduler.add_listener(self._on_ai_job_event)
+        self._live_job = None
+        self._ai_tick_id = None
+        self._jobs_dialog = None
+        self._job_rows = {}
+        self._job_order = []
+        self._batch = None
+        self._batch_dialog = None
+        self.ai_ttft_latency = LatencyRecorder()
+        self.ai_stream_history = collections.deque(maxlen=50)
         self.available_models = []
+        self.model_catalog = ModelCatalog()
+        self.model_catalog_store = None
+        self.model_status_label = None
+        self._model_fetches = set()
+        self._model_results = []
+        self._model_list_offset = 0
+        self.model_filter_latency = LatencyRecorder()
         self.folder_expanded_state = {}
         self.search_results = set()
         self._last_saved_content_dump = None
+        self.prefetcher = PagePrefetcher(self.app_state)
+        self.page_open_latency = LatencyRecorder()
+        self.autocomplete_latency = LatencyRecorder()
+        self._autocomplete_popup = None
+        self._autocomplete_listbox = None
+        self._autocomplete_suggestions = []
+        self._continuation_after_id = None
+        self._continuation_generation = 0
+        self._continuation_in_flight = False
+        self.continuation_stats = {"requested": 0, "discarded": 0, "shown": 0, "accepted": 0, "rejected": 0}
+        self._batch_depth = 0
+        self._batch_coalesced = collections.Counter()
+        self._suppress_modified_event = False
+        self.batched_edit_stats = {"batches": 0, "coalesced": collections.Counter()}
+        self.search_worker = None
+        self._content_indexes_ready = False
+        self._cold_indexes = []
+        self._index_build_generation = 0
+        self._index_changes_during_build = None
+        self._deferred_search = None
+        self._search_after_id = None
+        self._search_generation = 0
+        self._search_started = None
+        self._search_first_batch = True
+        self._last_search_term = ""
+        self.search_latency = LatencyRecorder()
+        self.ranked_search_latency = LatencyRecorder()
+        self._search_panel = None
+        self._find_replace_dialog = None
+        self._find_replace_cancel = None
+        self._duplicate_dialog = None
+        self._instrumentation_dialog = None
+        self.duplicate_runs = []
+        self._palette = None
+        self._sidebar_rows = {}
+        self._sidebar_window_starts = {}
+        self._sidebar_window_anchors = {}
+        self._sidebar_fonts = {"normal": ctk.CTkFont(weight="normal"), "bold": ctk.CTkFont(weight="bold"), "page": ctk.CTkFont(size=12)}
+        self._last_sidebar_update = None
+        self.sidebar_latency = LatencyRecorder()
+        self._function_bar_placeholder = None
+        self.function_bar_latency = LatencyRecorder()
+        self._reference_rows = {}
+        self._no_references_label = None
+        self._palette_results = []
+        self._palette_last_query = None
+        self.palette_latency = LatencyRecorder()
+        self.retrieval_latency = LatencyRecorder()
+        self.retrieval_stats = {"calls": 0, "fallbacks": 0, "full_chars": 0, "sent_chars": 0}
+        self.find_replace_stats = []
+        self._attach_content_indexes()
 
         self.update_title()
 
@@ -418,19 +466,6 @@ class App(ctk.CTk):
         ctk.set_appearance_mode(self.app_state.get_appearance_mode())
         ctk.set_default_color_theme("blue")
 
-        self.icon_folder = load_icon_ctk("folder", size=(18, 18))
-        self.icon_page = load_icon_ctk("page", size=(18, 18))
-        self.icon_add = load_icon_ctk("add", size=(18, 18))
-        self.icon_delete = load_icon_ctk("delete", size=(18, 18))
-        self.icon_settings = load_icon_ctk("settings", size=(18, 18))
-        self.icon_bold = load_icon_ctk("bold", size=(18, 18))
-        self.icon_italic = load_icon_ctk("italic", size=(18, 18))
-        self.icon_underline = load_icon_ctk("underline", size=(18, 18))
-        self.icon_refresh = load_icon_ctk("refresh", size=(18, 18))
-        self.icon_save = load_icon_ctk("save", size=(18, 18))
-        self.icon_load = load_icon_ctk("load", size=(18, 18))
-        self.icon_clear = load_icon_ctk("clear", size=(14, 14))
-
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
 
@@ -447,7 +482,7 @@ class App(ctk.CTk):
 
         self.search_entry = ctk.CTkEntry(self.search_frame, placeholder_text="Search pages...")
         self.search_entry.grid(row=0, column=0, padx=(0, 5), sticky="ew")
-        self.search_entry.bind("<Return>", self.perform_search)
+        self.search_entry.bind("<Return>", self.open_search_panel)
         self.search_entry.bind("<KeyRelease>", self.perform_search)
 
         self.clear_search_button = ctk.CTkButton(
@@ -505,8 +540,14 @@ class App(ctk.CTk):
         self.load_button = ctk.CTkButton(self.file_mgmt_frame, text=" Load Project...", image=self.icon_load, compound="left", command=self.load_project)
         self.load_button.grid(row=1, column=0, padx=5, pady=3, sticky="ew")
 
+        self.find_replace_button = ctk.CTkButton(self.file_mgmt_frame, text=" Find & Replace...", image=self.icon_refresh, compound="left", command=self.open_find_replace)
+        self.find_replace_button.grid(row=2, column=0, padx=5, pady=3, sticky="ew")
+
+        self.duplicates_button = ctk.CTkButton(self.file_mgmt_frame, text=" Find Duplicates...", image=self.icon_page, compound="left", command=self.open_duplicate_report)
+        self.duplicates_button.grid(row=3, column=0, padx=5, pady=3, sticky="ew")
+
         self.settings_button = ctk.CTkButton(self.file_mgmt_frame, text=" Settings", image=self.icon_settings, compound="left", command=self.open_settings)
-        self.settings_button.grid(row=2, column=0, padx=5, pady=(10, 5), sticky="ew")
+        self.settings_button.grid(row=4, column=0, padx=5, pady=(10, 5), sticky="ew")
 
         self.main_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         self.main_frame.grid(row=0, column=1, rowspan=4, sticky="nsew", padx=5, pady=5)
@@ -548,6 +589,19 @@ class App(ctk.CTk):
         self.workspace.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="nsew")
         self.workspace.bind("<KeyRelease>", self.on_text_change)
         self.workspace.bind("<ButtonRelease-1>", lambda e: self.after(50, self.update_word_count))
+        self.workspace.bind("<KeyPress>", self._on_workspace_keypress)
+        self.workspace.bind("<Button-1>", lambda e: self._dismiss_suggestions())
+        self.workspace.bind("<FocusOut>", lambda e: self._dismiss_suggestions())
+        self.workspace.bind("<Tab>", self._on_tab_key)
+        self.workspace.bind("<Escape>", lambda e: self._dismiss_suggestions())
+        self.workspace.bind("<Down>", lambda e: self._move_autocomplete_selection(1))
+        self.workspace.bind("<Up>", lambda e: self._move_autocomplete_selection(-1))
+        self.workspace.bind("<<Paste>>", self._on_paste)
+        self.workspace.bind("<Control-p>", self.open_command_palette)
+        self.bind("<Control-p>", self.open_command_palette)
+        if EVENT_LOOP_INSTRUMENTATION is not None:
+            self.bind("<Control-Shift-D>", lambda e: self.open_instrumentation_panel())
+            EVENT_LOOP_INSTRUMENTATION.start_heartbeat(self)
         self.workspace.configure(state="disabled")
 
         bold_font_props = ctk.CTkFont(family="sans-serif", size=14, weight="bold").actual()
@@ -560,6 +614,7 @@ class App(ctk.CTk):
         sep_font_props = ctk.CTkFont(slant="italic", size=12).actual()
         sep_color = self._apply_appearance_mode(("#005588", "#88CCFF"))
         self.workspace.tag_configure("ai_separator", font=sep_font_props, foreground=sep_color)
+        self.workspace.tag_configure("ghost", foreground=self._apply_appearance_mode(("gray60", "gray45")))
         self.workspace.bind("<<Modified>>", self.interpret_markdown)
         
         bold_font = ctk.CTkFont(family="sans-serif", size=14, weight="bold").actual()
@@ -578,8 +633,16 @@ class App(ctk.CTk):
         self.status_bar = ctk.CTkLabel(self.status_bar_frame, text="Ready.", anchor="w", font=ctk.CTkFont(size=12))
         self.status_bar.grid(row=0, column=0, sticky="ew")
 
+        self.jobs_button = ctk.CTkButton(self.status_bar_frame, text="", height=22, fg_color="transparent", border_width=1, text_color=("gray10", "gray90"), command=self.open_jobs_panel)
+        self.jobs_button.grid(row=0, column=1, padx=(10, 0))
+        self.jobs_button.grid_remove()
+
+        self.stop_ai_button = ctk.CTkButton(self.status_bar_frame, text="■ Stop", width=70, height=22, fg_color="#D32F2F", hover_color="#C62828", command=self.stop_ai_function)
+        self.stop_ai_button.grid(row=0, column=2, padx=(10, 0))
+        self.stop_ai_button.grid_remove()
+
         self.word_count_label = ctk.CTkLabel(self.status_bar_frame, text="", anchor="e", font=ctk.CTkFont(size=12))
-        self.word_count_label.grid(row=0, column=1, padx=(10, 0), sticky="e")
+        self.word_count_label.grid(row=0, column=3, padx=(10, 0), sticky="e")
 
         self.update_sidebar()
         folders = self.app_state.get_folders()
@@ -589,55 +652,184 @@ class App(ctk.CTk):
         else:
              self.update_function_bar()
 
+    def _attach_content_indexes(self):
+        """Builds the per-project indexes and subscribes them to AppState content changes.
+
+        Indexes with a current sidecar load right away. The others are built on a worker thread so
+        the window opens first; autocomplete and search wait until _content_indexes_built.
+        """
+        self.app_state.error_handler = lambda title, message: messagebox.showerror(title, message, parent=self)
+        self.completion_index = CompletionIndex(self.app_state)
+        self.search_index = SearchIndex(self.app_state)
+        self._cold_indexes = [index for index in (self.completion_index, self.search_index) if not index.load()]
+        for index in (self.completion_index, self.search_index):
+            if index not in self._cold_indexes:
+                self.app_state.add_content_listener(index.on_content_change)
+        self._index_build_generation += 1
+        self._content_indexes_ready = not self._cold_indexes
+        if self._cold_indexes:
+            # Edits made during the build are replayed into the new indexes once it finishes
+            changes = []
+            self._index_changes_during_build = changes
+            self.app_state.add_content_listener(lambda *change: changes.append(change) if self._index_changes_during_build is changes else None)
+            threading.Thread(
+                target=self._build_cold_indexes,
+                args=(self._index_build_generation, list(self._cold_indexes), project_page_keys(self.app_state)),
+                daemon=True
+            ).start()
+        if self.search_worker is None:
+            self.search_worker = SearchWorker(self.search_index, self._deliver_search_results)
+        else:
+            self.search_worker.search_index = self.search_index
+        self.duplicate_detector = DuplicateDetector(self.app_state)
+        self.app_state.add_content_listener(self.duplicate_detector.on_content_change)
+        self._build_command_index()
+        self.app_state.add_content_listener(self._on_palette_content_change)
+        self.chunk_retriever = ChunkRetriever(self.app_state)
+        self.chunk_retriever.build()
+        self.app_state.add_content_listener(self.chunk_retriever.on_content_change)
+        if getattr(self, "response_cache", None) is not None:
+            self.response_cache.close()  # Runners of the old project still holding it just stop storing
+        self.response_cache = ResponseCache(sidecar_path(self.app_state.filename, RESPONSE_CACHE_SUFFIX))
+        self.model_catalog_store = ModelCatalogStore(sidecar_path(self.app_state.filename, MODEL_CATALOG_SUFFIX))
+
+    def _build_cold_indexes(self, generation, cold_indexes, page_keys):
+        """Worker thread: indexes every page for the indexes that had no current sidecar."""
+        started = time.perf_counter()
+        for index in cold_indexes:
+            try:
+                index.index_pages(page_keys)
+            except Exception as e:
+                print(f"Error building {type(index).__name__}: {e}")
+        try:
+            self.after(0, self._content_indexes_built, generation, (time.perf_counter() - started) * 1000)
+        except RuntimeError:
+            pass  # The window was closed during the build
+
+    def _content_indexes_built(self, generation, elapsed_ms):
+        """Replays the edits made during the cold build, subscribes the indexes and enables search and autocomplete."""
+        if generation != self._index_build_generation:
+            return  # Another project was opened meanwhile
+        for change in self._index_changes_during_build:
+            for index in self._cold_indexes:
+                index.on_content_change(*change)
+        self._index_changes_during_build = None
+        for index in self._cold_indexes:
+            self.app_state.add_content_listener(index.on_content_change)
+        self._cold_indexes = []
+        self._content_indexes_ready = True
+        self.status_bar.configure(text=f"Project indexed in {elapsed_ms:.0f} ms.")
+        if self._deferred_search is not None:
+            search_generation, search_term = self._deferred_search
+            self._deferred_search = None
+            if search_generation == self._search_generation:
+                self._submit_search(search_generation, search_term)
+        if self._search_panel is not None and self._search_panel.winfo_exists():
+            self._last_ranked_query = None
+            self._run_ranked_search()
+
+    def _save_content_indexes(self):
+        """Persists the per-project indexes next to the data file; an index still being built is skipped."""
+        for index in (self.completion_index, self.search_index):
+            if index not in self._cold_indexes:
+                index.save()
+
     def update_title(self):
         """Updates the window title based on the current project file."""
         proj_name = os.path.basename(self.app_state.filename)
         self.title(f"{APP_NAME} - {proj_name}")
 
-    def interpret_markdown(self, event=None):
-        """Interprets basic Markdown syntax and applies text tags."""
+    def interpret_markdown(self, event=None, start="1.0", end=tk.END):
+        """Interprets basic Markdown syntax and applies text tags between start and end."""
+        if self._batch_depth:
+            self._note_coalesced_hook("interpret_markdown")
+            return
+        if event is not None and self._suppress_modified_event:
+            return
         if not self.current_page or self.workspace.cget("state") == "disabled":
             return
 
         cursor_pos = self.workspace.index(tk.INSERT)
         
         for tag in ["bold", "italic", "bold_italic"]:
-            self.workspace.tag_remove(tag, "1.0", tk.END)
-        
-        content = self.workspace.get("1.0", tk.END)
-        
-        patterns = [
-            (r'\*\*\*(.*?)\*\*\*', "bold_italic"),
-            (r'\*\*(.*?)\*\*', "bold"),
-            (r'__(.*?)__', "bold"),
-            (r'\*(.*?)\*', "italic"),
-            (r'_(.*?)_', "italic"),
-        ]
-        
-        for pattern, tag in patterns:
-            start_idx = "1.0"
-            while True:
-                match_start = self.workspace.search(pattern, start_idx, tk.END, regexp=True)
-                if not match_start:
-                    break
-                    
-                match_end = self.workspace.search(
-                    pattern.split(r"(.*?)")[1],
-                    f"{match_start}+1c", 
-                    tk.END,
-                    regexp=True
-                )
-                
-                if match_end:
-                    content_start = f"{match_start}+{len(pattern.split('(')[0])}c"
-                    content_end = match_end
-                    self.workspace.tag_add(tag, content_start, content_end)
-                    start_idx = f"{match_end}+1c"
-                else:
-                    break
+            self.workspace.tag_remove(tag, start, end)
+
+        start = self.workspace.index(start)
+        for tag, span_start, span_end in markdown_tag_spans(self.workspace.get(start, end)):
+            self.workspace.tag_add(tag, f"{start}+{span_start}c", f"{start}+{span_end}c")
         
         self.workspace.mark_set(tk.INSERT, cursor_pos)
 
+    # --- Batched Edits ---
+    @contextlib.contextmanager
+    def batched_edit(self, anchor=tk.INSERT):
+        """Suspends the per-keystroke hooks for a bulk insertion around anchor.
+
+        Markdown interpretation, saving and the word count each run once on exit,
+        limited to the lines touched by the edit.
+        """
+        self._begin_batched_edit(anchor)
+        try:
+            yield
+        finally:
+            self._end_batched_edit()
+
+    def _begin_batched_edit(self, anchor=tk.INSERT):
+        self._batch_depth += 1
+        if self._batch_depth == 1:
+            self._batch_coalesced = collections.Counter()
+            anchor_index = self.workspace.index(anchor)
+            self.workspace.mark_set("batch_start", anchor_index)
+            self.workspace.mark_gravity("batch_start", tk.LEFT)
+            self.workspace.mark_set("batch_end", anchor_index)
+            self.workspace.mark_gravity("batch_end", tk.RIGHT)
+
+    def _end_batched_edit(self):
+        self._batch_depth -= 1
+        if self._batch_depth:
+            return
+        start = self.workspace.index("batch_start linestart")
+        end = self.workspace.index("batch_end lineend")
+        self.workspace.mark_unset("batch_start", "batch_end")
+
+        self.interpret_markdown(start=start, end=end)
+        self.save_current_page_content()
+        self.update_word_count()
+
+        # <<Modified>> is delivered through the event queue; ignore the copy raised by this batch.
+        self._suppress_modified_event = True
+        self.after_idle(self._release_modified_event)
+
+        self.batched_edit_stats["batches"] += 1
+        self.batched_edit_stats["coalesced"].update(self._batch_coalesced)
+        if self._batch_coalesced:
+            details = ", ".join(f"{name} x{count}" for name, count in self._batch_coalesced.items())
+            print(f"Batched edit ({start}-{end}) coalesced {sum(self._batch_coalesced.values())} hook calls: {details}")
+
+    def _release_modified_event(self):
+        self._suppress_modified_event = False
+
+    def _note_coalesced_hook(self, hook_name):
+        self._batch_coalesced[hook_name] += 1
+
+    def _on_paste(self, event=None):
+        """Pastes the clipboard as a single batched edit."""
+        if self.workspace.cget("state") == "disabled":
+            return "break"
+        try:
+            text = self.clipboard_get()
+        except tk.TclError:
+            return "break"
+        self._cancel_continuation()
+        self.workspace.edit_separator()
+        with self.batched_edit(tk.SEL_FIRST if self.workspace.tag_ranges(tk.SEL) else tk.INSERT):
+            if self.workspace.tag_ranges(tk.SEL):
+                self.workspace.delete(tk.SEL_FIRST, tk.SEL_LAST)
+            self.workspace.insert(tk.INSERT, text)
+        self.workspace.edit_separator()
+        self.workspace.see(tk.INSERT)
+        return "break"
+
     def configure_markdown_tags(self):
         bold_font = ctk.CTkFont(family="sans-serif", size=14, weight="bold")
         italic_font = ctk.CTkFont(family="sans-serif", size=14, slant="italic")
@@ -706,6 +898,9 @@ class App(ctk.CTk):
 
     def update_word_count(self, event=None):
         """Updates the word count label in the status bar."""
+        if self._batch_depth:
+            self._note_coalesced_hook("update_word_count")
+            return
         if self.workspace.cget("state") == "disabled":
             self.word_count_label.configure(text="")
             return
@@ -732,45 +927,721 @@ class App(ctk.CTk):
             self.word_count_label.configure(text="WC Error")
 
     def _get_plain_text_content(self, folder_name, page_name):
-        """Extracts plain text from a page's rich content dump."""
+        """Returns a page's plain text from the AppState plain-text cache."""
         try:
-            rich_content_dump = self.app_state.get_page_content(folder_name, page_name)
-            if rich_content_dump:
-                plain_text = ""
-                for item_type, value, index in rich_content_dump:
-                    if item_type == "text":
-                        plain_text += value
-                if plain_text.endswith('\n'):
-                    plain_text = plain_text[:-1]
-                return plain_text
-            return ""
+            return self.app_state.get_page_plain_text(folder_name, page_name)
         except Exception as e:
             print(f"Error getting plain text for {folder_name}/{page_name}: {e}")
             return ""
 
     def perform_search(self, event=None):
-        """Performs search and updates sidebar highlights."""
+        """Debounces the search box and hands the query to the background search worker."""
         search_term = self.search_entry.get().strip()
-        self.search_results.clear()
+        if search_term == self._last_search_term and (event is None or event.keysym != "Return"):
+            return
+        self._last_search_term = search_term
+
+        if self._search_after_id is not None:
+            self.after_cancel(self._search_after_id)
+            self._search_after_id = None
+        self._search_generation += 1
+        self.search_worker.cancel(self._search_generation)
+        self._search_started = time.perf_counter()
+
+        if not search_term:
+            self.search_results.clear()
+            self.update_sidebar()
+            return
+        self._search_after_id = self.after(SEARCH_DEBOUNCE_MS, self._submit_search, self._search_generation, search_term)
 
-        if len(search_term) > 0:
-            term_lower = search_term.lower()
-            folders = self.app_state.get_folders()
-            for folder in folders:
-                pages = self.app_state.get_pages(folder)
-                for page in pages:
-                    page_text = self._get_plain_text_content(folder, page)
-                    if term_lower in page_text.lower():
-                        self.search_results.add((folder, page))
+    def _submit_search(self, generation, search_term):
+        self._search_after_id = None
+        if not self._content_indexes_ready:
+            self._deferred_search = (generation, search_term)
+            self.status_bar.configure(text="Indexing project... the search runs when it finishes.")
+            return
+        self._search_first_batch = True
+        self.search_worker.submit(generation, search_term)
 
-        self.update_sidebar()
+    def _deliver_search_results(self, generation, matches, done):
+        """Called on the worker thread; forwards results to the Tk thread."""
+        self.after(0, self._apply_search_results, generation, matches, done)
+
+    def _apply_search_results(self, generation, matches, done):
+        if generation != self._search_generation:
+            return
+        if self._search_first_batch:
+            self._search_first_batch = False
+            self.search_results.clear()
+        if matches:
+            self.search_results.update(matches)
+            self.update_sidebar()
+        if done:
+            if not self.search_results:
+                self.update_sidebar()
+            elapsed_ms = (time.perf_counter() - self._search_started) * 1000
+            self.search_latency.record(elapsed_ms)
+            self.status_bar.configure(text=f"Search: {len(self.search_results)} matching pages ({elapsed_ms:.0f} ms)")
+
+    # --- Ranked Search Panel ---
+    def open_search_panel(self, event=None):
+        """Opens the ranked search panel for the text in the sidebar search box."""
+        if self._search_panel is None or not self._search_panel.winfo_exists():
+            panel = ctk.CTkToplevel(self)
+            panel.title("Search Results")
+            panel.geometry("560x520")
+            panel.transient(self)
+            panel.grid_columnconfigure(0, weight=1)
+            panel.grid_rowconfigure(1, weight=1)
+
+            self._search_panel_query_var = ctk.StringVar()
+            query_entry = ctk.CTkEntry(panel, textvariable=self._search_panel_query_var, placeholder_text='words, "exact phrase", prefix*')
+            query_entry.grid(row=0, column=0, padx=10, pady=(10, 5), sticky="ew")
+            query_entry.bind("<KeyRelease>", lambda e: self._run_ranked_search())
+            self._search_panel_entry = query_entry
+
+            self._search_panel_results = ctk.CTkScrollableFrame(panel)
+            self._search_panel_results.grid(row=1, column=0, padx=10, pady=5, sticky="nsew")
+
+            self._search_panel_status = ctk.CTkLabel(panel, text="", anchor="w", text_color="gray", font=ctk.CTkFont(size=12))
+            self._search_panel_status.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="ew")
+            self._search_panel = panel
+            self._last_ranked_query = None
+        else:
+            self._search_panel.deiconify()
+            self._search_panel.lift()
+
+        self._search_panel_query_var.set(self.search_entry.get().strip())
+        self._run_ranked_search()
+        self._search_panel_entry.focus_set()
+        return "break"
+
+    def _run_ranked_search(self):
+        query = self._search_panel_query_var.get().strip()
+        if query == self._last_ranked_query:
+            return
+        self._last_ranked_query = query
+        for widget in self._search_panel_results.winfo_children():
+            widget.destroy()
+        if query and not self._content_indexes_ready:
+            self._search_panel_status.configure(text="Indexing project... results appear when it finishes.")
+            return
+
+        started = time.perf_counter()
+        results = self.search_index.rank(query) if query else []
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if query:
+            self.ranked_search_latency.record(elapsed_ms)
+
+        highlight_color = self._apply_appearance_mode(("#aaddff", "#005588"))
+        text_bg_color = self._apply_appearance_mode(ctk.ThemeManager.theme["CTkFrame"]["fg_color"])
+        text_fg_color = self._apply_appearance_mode(ctk.ThemeManager.theme["CTkLabel"]["text_color"])
+        for result in results:
+            row = ctk.CTkFrame(self._search_panel_results)
+            row.pack(fill="x", padx=4, pady=3)
+            header = ctk.CTkButton(
+                row, text=f"{result['folder']} / {result['page']}   ({result['score']:.2f})", anchor="w",
+                command=lambda r=result: self._jump_to_search_result(r), font=ctk.CTkFont(weight="bold")
+            )
+            header.pack(fill="x", padx=4, pady=(4, 2))
+
+            prefix = result["snippet_prefix"]
+            snippet = tk.Text(
+                row, height=3, wrap=tk.WORD, borderwidth=0, highlightthickness=0, cursor="hand2",
+                background=text_bg_color, foreground=text_fg_color, font=ctk.CTkFont(size=12).actual()
+            )
+            snippet.insert("1.0", prefix + result["snippet"])
+            snippet.tag_configure("hit", background=highlight_color)
+            for hit_start, hit_end in result["highlights"]:
+                snippet.tag_add("hit", f"1.0+{hit_start + len(prefix)}c", f"1.0+{hit_end + len(prefix)}c")
+            snippet.configure(state="disabled")
+            snippet.bind("<Button-1>", lambda e, r=result: self._jump_to_search_result(r))
+            snippet.pack(fill="x", padx=8, pady=(0, 4))
+
+        if query and not results:
+            ctk.CTkLabel(self._search_panel_results, text="No matching pages.", text_color="gray").pack(pady=10)
+        self._search_panel_status.configure(text=f"{len(results)} results in {elapsed_ms:.1f} ms" if query else "")
+
+    def _jump_to_search_result(self, result):
+        """Opens the result's page and selects the first hit."""
+        self.select_page(result["folder"], result["page"])
+        if (self.current_folder, self.current_page) != (result["folder"], result["page"]):
+            return
+        hit_start = f"1.0+{result['offset']}c"
+        hit_end = f"{hit_start}+{result['length']}c"
+        self.workspace.tag_remove(tk.SEL, "1.0", tk.END)
+        self.workspace.tag_add(tk.SEL, hit_start, hit_end)
+        self.workspace.mark_set(tk.INSERT, hit_start)
+        self.workspace.see(hit_start)
+        self.workspace.focus_set()
+
+    # --- Project Find & Replace ---
+    def open_find_replace(self):
+        """Opens the project-wide regex find & replace dialog."""
+        if self._find_replace_dialog is not None and self._find_replace_dialog.winfo_exists():
+            self._find_replace_dialog.deiconify()
+            self._find_replace_dialog.lift()
+            return
+
+        dialog = ctk.CTkToplevel(self)
+        dialog.title("Find & Replace in Project")
+        dialog.geometry("620x560")
+        dialog.transient(self)
+        dialog.grid_columnconfigure(1, weight=1)
+        dialog.grid_rowconfigure(4, weight=1)
+
+        ctk.CTkLabel(dialog, text="Find:").grid(row=0, column=0, padx=(10, 5), pady=(10, 5), sticky="w")
+        self._find_var = ctk.StringVar(value=self.search_entry.get().strip())
+        find_entry = ctk.CTkEntry(dialog, textvariable=self._find_var)
+        find_entry.grid(row=0, column=1, padx=(0, 10), pady=(10, 5), sticky="ew")
+
+        ctk.CTkLabel(dialog, text="Replace:").grid(row=1, column=0, padx=(10, 5), pady=5, sticky="w")
+        self._replace_var = ctk.StringVar()
+        ctk.CTkEntry(dialog, textvariable=self._replace_var).grid(row=1, column=1, padx=(0, 10), pady=5, sticky="ew")
+
+        options_frame = ctk.CTkFrame(dialog, fg_color="transparent")
+        options_frame.grid(row=2, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
+        self._find_regex_var = ctk.BooleanVar(value=True)
+        self._find_ignore_case_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(options_frame, text="Regular expression", variable=self._find_regex_var).pack(side="left", padx=(0, 10))
+        ctk.CTkCheckBox(options_frame, text="Ignore case", variable=self._find_ignore_case_var).pack(side="left", padx=(0, 10))
+
+        buttons_frame = ctk.CTkFrame(dialog, fg_color="transparent")
+        buttons_frame.grid(row=3, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
+        self._find_preview_button = ctk.CTkButton(buttons_frame, text="Preview", width=100, command=lambda: self._start_find_replace(apply=False))
+        self._find_preview_button.pack(side="left", padx=(0, 5))
+        self._find_apply_button = ctk.CTkButton(buttons_frame, text="Replace All", width=100, command=lambda: self._start_find_replace(apply=True))
+        self._find_apply_button.pack(side="left", padx=5)
+        self._find_cancel_button = ctk.CTkButton(buttons_frame, text="Cancel", width=100, state="disabled", command=self._cancel_find_replace)
+        self._find_cancel_button.pack(side="left", padx=5)
+        self._find_progress = ctk.CTkProgressBar(buttons_frame)
+        self._find_progress.pack(side="left", fill="x", expand=True, padx=(10, 0))
+        self._find_progress.set(0)
+
+        self._find_results_frame = ctk.CTkScrollableFrame(dialog)
+        self._find_results_frame.grid(row=4, column=0, columnspan=2, padx=10, pady=5, sticky="nsew")
+
+        self._find_status = ctk.CTkLabel(dialog, text="", anchor="w", text_color="gray", font=ctk.CTkFont(size=12))
+        self._find_status.grid(row=5, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="ew")
+
+        find_entry.bind("<Return>", lambda e: self._start_find_replace(apply=False))
+        dialog.protocol("WM_DELETE_WINDOW", self._close_find_replace)
+        self._find_replace_dialog = dialog
+        find_entry.focus_set()
+
+    def _close_find_replace(self):
+        self._cancel_find_replace()
+        self._find_replace_dialog.destroy()
+        self._find_replace_dialog = None
+
+    def _compile_find_pattern(self):
+        """Returns (pattern, flags, replacement) for the dialog fields, or None after reporting an error."""
+        pattern = self._find_var.get()
+        replacement = self._replace_var.get()
+        if not pattern:
+            self._find_status.configure(text="Enter something to find.")
+            return None
+        if not self._find_regex_var.get():
+            pattern = re.escape(pattern)
+            replacement = replacement.replace("\\", "\\\\")
+        flags = re.MULTILINE | (re.IGNORECASE if self._find_ignore_case_var.get() else 0)
+        try:
+            regex = re.compile(pattern, flags)
+            regex.sub(replacement, "")
+        except re.error as e:
+            self._find_status.configure(text=f"Invalid pattern: {e}")
+            return None
+        return pattern, flags, replacement
+
+    def _start_find_replace(self, apply):
+        if self._find_replace_cancel is not None:
+            return
+        if apply and self.ai_scheduler.active_jobs():
+            messagebox.showwarning("Busy", "Wait for the queued and running AI jobs to finish before replacing text.", parent=self._find_replace_dialog)
+            return
+        compiled = self._compile_find_pattern()
+        if compiled is None:
+            return
+        if apply and not messagebox.askyesno("Replace All", "Replace every match in all pages of the project?", parent=self._find_replace_dialog):
+            return
+        if not self.save_current_page_content():
+            self._find_status.configure(text="Could not save the current page; aborting.")
+            return
+
+        pages = []
+        versions = {}
+        for folder_name in self.app_state.get_folders():
+            for page_name in self.app_state.get_pages(folder_name):
+                pages.append((folder_name, page_name, self.app_state.get_page_content(folder_name, page_name)))
+                versions[(folder_name, page_name)] = self.app_state.get_page_version(folder_name, page_name)
+
+        for widget in self._find_results_frame.winfo_children():
+            widget.destroy()
+        self._find_progress.set(0)
+        self._find_status.configure(text=f"{'Replacing' if apply else 'Searching'} in {len(pages)} pages...")
+        self._find_preview_button.configure(state="disabled")
+        self._find_apply_button.configure(state="disabled")
+        self._find_cancel_button.configure(state="normal")
+        cancel_event = threading.Event()
+        self._find_replace_cancel = cancel_event
+
+        def progress(done_pages, total_pages):
+            self.after(0, lambda: self._find_progress.set(done_pages / max(total_pages, 1)) if self._find_replace_dialog else None)
+
+        def worker():
+            try:
+                results, stats = run_find_replace(pages, *compiled, apply, cancel_event=cancel_event, progress=progress)
+            except Exception as e:
+                print(f"Error during find & replace: {e}")
+                self.after(0, lambda error=str(e): self._finish_find_replace(apply, [], None, versions, error))
+                return
+            self.after(0, lambda: self._finish_find_replace(apply, results, stats, versions, None))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _cancel_find_replace(self):
+        if self._find_replace_cancel is not None:
+            self._find_replace_cancel.set()
+
+    def _finish_find_replace(self, apply, results, stats, versions, error):
+        """Shows the per-page match counts and, for Replace All, writes the changed pages in one save."""
+        cancelled = self._find_replace_cancel is None or self._find_replace_cancel.is_set()
+        self._find_replace_cancel = None
+        if self._find_replace_dialog is None or not self._find_replace_dialog.winfo_exists():
+            return
+        self._find_preview_button.configure(state="normal")
+        self._find_apply_button.configure(state="normal")
+        self._find_cancel_button.configure(state="disabled")
+        if error:
+            self._find_status.configure(text=f"Find & replace failed: {error}")
+            return
+        if cancelled:
+            self._find_status.configure(text=f"Cancelled after {stats['pages']} pages; nothing was changed.")
+            return
+
+        matched = sorted((r for r in results if r[2]), key=lambda r: (r[0].lower(), r[1].lower()))
+        replaced_pages = 0
+        skipped_pages = []
+        if apply and matched:
+            if self.current_folder and self.current_page:
+                self.save_current_page_content()
+            with self.app_state.batch_updates():
+                for folder_name, page_name, _, _, new_dump, _ in matched:
+                    if self.app_state.get_page_version(folder_name, page_name) != versions.get((folder_name, page_name)):
+                        skipped_pages.append(f"{folder_name} / {page_name}")
+                        continue
+                    if self.app_state.update_page_content(folder_name, page_name, new_dump):
+                        replaced_pages += 1
+            if (self.current_folder, self.current_page) in {(r[0], r[1]) for r in matched}:
+                self._last_saved_content_dump = None
+                self.select_page(self.current_folder, self.current_page)
+
+        for folder_name, page_name, match_count, preview, _, _ in matched:
+            row = ctk.CTkFrame(self._find_results_frame)
+            row.pack(fill="x", padx=4, pady=3)
+            ctk.CTkButton(
+                row, text=f"{folder_name} / {page_name}   ({match_count} {'match' if match_count == 1 else 'matches'})", anchor="w",
+                font=ctk.CTkFont(weight="bold"), command=lambda f=folder_name, p=page_name: self.select_page(f, p)
+            ).pack(fill="x", padx=4, pady=(4, 2))
+            for line in preview:
+                ctk.CTkLabel(row, text=line, anchor="w", justify="left", wraplength=540, font=ctk.CTkFont(size=12)).pack(fill="x", padx=10)
+
+        total_matches = sum(r[2] for r in matched)
+        throughput = format_find_replace_throughput(stats)
+        self.find_replace_stats.append(stats)
+        print(f"Find & replace: {total_matches} matches in {len(matched)} pages, {throughput}")
+        if apply:
+            summary = f"Replaced {total_matches} matches in {replaced_pages} pages"
+            if skipped_pages:
+                summary += f"; skipped {len(skipped_pages)} pages changed during the run"
+                print(f"Find & replace skipped pages edited meanwhile: {skipped_pages}")
+        else:
+            summary = f"{total_matches} matches in {len(matched)} pages"
+        self._find_status.configure(text=f"{summary}. {throughput}")
+
+    # --- Event Loop Instrumentation ---
+    def open_instrumentation_panel(self):
+        """Shows per-handler latency percentiles and event-loop lag collected by --instrument."""
+        if EVENT_LOOP_INSTRUMENTATION is None:
+            return
+        if self._instrumentation_dialog is None or not self._instrumentation_dialog.winfo_exists():
+            dialog = ctk.CTkToplevel(self)
+            dialog.title("Event Loop Stats")
+            dialog.geometry("820x560")
+            dialog.transient(self)
+            dialog.grid_columnconfigure(0, weight=1)
+            dialog.grid_rowconfigure(1, weight=1)
+
+            top_frame = ctk.CTkFrame(dialog, fg_color="transparent")
+            top_frame.grid(row=0, column=0, padx=10, pady=(10, 5), sticky="ew")
+            ctk.CTkButton(top_frame, text="Refresh", width=90, command=self._refresh_instrumentation_panel).pack(side="left")
+            ctk.CTkButton(top_frame, text="Export JSON...", width=120, command=self._export_instrumentation).pack(side="left", padx=(5, 0))
+            self._instrumentation_status = ctk.CTkLabel(top_frame, text="", anchor="w", text_color="gray", font=ctk.CTkFont(size=12))
+            self._instrumentation_status.pack(side="left", fill="x", expand=True, padx=10)
+
+            self._instrumentation_text = ctk.CTkTextbox(dialog, font=ctk.CTkFont(family="Courier", size=12), wrap="none")
+            self._instrumentation_text.grid(row=1, column=0, padx=10, pady=(5, 10), sticky="nsew")
+            self._instrumentation_dialog = dialog
+        else:
+            self._instrumentation_dialog.deiconify()
+            self._instrumentation_dialog.lift()
+        self._refresh_instrumentation_panel()
+
+    def _refresh_instrumentation_panel(self):
+        instrumentation = EVENT_LOOP_INSTRUMENTATION
+        lines = [f"{'handler':<58}{'calls':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'total':>10}"]
+        for row in instrumentation.handler_rows():
+            lines.append(f"{row['handler'][:57]:<58}{row['count']:>7}{row['p50']:>9.1f}{row['p95']:>9.1f}{row['p99']:>9.1f}{row['max']:>9.1f}{row['total_ms']:>10.0f}")
+        if instrumentation.slow_events:
+            lines.append("")
+            lines.append(f"Slow handlers (>= {instrumentation.slow_ms:.0f} ms), most recent first:")
+            for event in reversed(instrumentation.slow_events):
+                lines.append(f"  {event['at']}  {event['ms']:>8.1f} ms  {event['handler']}")
+        self._instrumentation_text.configure(state="normal")
+        self._instrumentation_text.delete("1.0", "end")
+        self._instrumentation_text.insert("1.0", "\n".join(lines))
+        self._instrumentation_text.configure(state="disabled")
+        self._instrumentation_status.configure(text=f"Event loop lag: {instrumentation.loop_lag.format_summary()}")
+
+    def _export_instrumentation(self):
+        path = filedialog.asksaveasfilename(parent=self._instrumentation_dialog, title="Export Event Loop Stats", defaultextension=".json", filetypes=[("JSON files", "*.json")])
+        if not path:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(EVENT_LOOP_INSTRUMENTATION.to_dict(), f, indent=2)
+            print(f"Event loop stats exported to {path}")
+        except OSError as e:
+            messagebox.showerror("Export Failed", f"Could not write {path}:\n{e}", parent=self._instrumentation_dialog)
+
+    # --- Near-Duplicate Report ---
+    def open_duplicate_report(self):
+        """Opens the near-duplicate paragraph report and starts an analysis run."""
+        if self._duplicate_dialog is None or not self._duplicate_dialog.winfo_exists():
+            dialog = ctk.CTkToplevel(self)
+            dialog.title("Near-Duplicate Paragraphs")
+            dialog.geometry("640x580")
+            dialog.transient(self)
+            dialog.grid_columnconfigure(0, weight=1)
+            dialog.grid_rowconfigure(1, weight=1)
+
+            top_frame = ctk.CTkFrame(dialog, fg_color="transparent")
+            top_frame.grid(row=0, column=0, padx=10, pady=(10, 5), sticky="ew")
+            self._duplicate_rerun_button = ctk.CTkButton(top_frame, text="Re-analyze", width=110, command=self._run_duplicate_analysis)
+            self._duplicate_rerun_button.pack(side="left")
+            self._duplicate_status = ctk.CTkLabel(top_frame, text="", anchor="w", text_color="gray", font=ctk.CTkFont(size=12))
+            self._duplicate_status.pack(side="left", fill="x", expand=True, padx=10)
+
+            self._duplicate_results_frame = ctk.CTkScrollableFrame(dialog)
+            self._duplicate_results_frame.grid(row=1, column=0, padx=10, pady=(5, 10), sticky="nsew")
+            self._duplicate_dialog = dialog
+        else:
+            self._duplicate_dialog.deiconify()
+            self._duplicate_dialog.lift()
+        self._run_duplicate_analysis()
+
+    def _run_duplicate_analysis(self):
+        if not self.save_current_page_content():
+            self._duplicate_status.configure(text="Could not save the current page; aborting.")
+            return
+        self._duplicate_rerun_button.configure(state="disabled")
+        self._duplicate_status.configure(text="Analyzing paragraphs...")
+        detector = self.duplicate_detector
+
+        def worker():
+            try:
+                clusters, stats = detector.analyze()
+            except Exception as e:
+                print(f"Error during duplicate analysis: {e}")
+                self.after(0, lambda error=str(e): self._show_duplicate_report(None, None, error))
+                return
+            self.after(0, lambda: self._show_duplicate_report(clusters, stats, None))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _show_duplicate_report(self, clusters, stats, error):
+        if self._duplicate_dialog is None or not self._duplicate_dialog.winfo_exists():
+            return
+        self._duplicate_rerun_button.configure(state="normal")
+        for widget in self._duplicate_results_frame.winfo_children():
+            widget.destroy()
+        if error:
+            self._duplicate_status.configure(text=f"Analysis failed: {error}")
+            return
+
+        self.duplicate_runs.append(stats)
+        print(f"Duplicate analysis: {stats}")
+        for cluster in clusters[:DUPLICATE_REPORT_CLUSTERS]:
+            cluster_frame = ctk.CTkFrame(self._duplicate_results_frame)
+            cluster_frame.pack(fill="x", padx=4, pady=4)
+            ctk.CTkLabel(cluster_frame, text=f"{len(cluster)} similar paragraphs", font=ctk.CTkFont(weight="bold"), anchor="w").pack(fill="x", padx=6, pady=(4, 0))
+            for member in cluster:
+                row = ctk.CTkFrame(cluster_frame, fg_color="transparent")
+                row.pack(fill="x", padx=6, pady=2)
+                row.grid_columnconfigure(0, weight=1)
+                ctk.CTkButton(
+                    row, text=f"{member['folder']} / {member['page']}", anchor="w", height=24,
+                    command=lambda m=member: self._jump_to_search_result(m)
+                ).grid(row=0, column=0, sticky="ew")
+                remove_button = ctk.CTkButton(row, text="Remove", width=70, height=24, fg_color="#D32F2F", hover_color="#C62828")
+                remove_button.configure(command=lambda m=member, b=remove_button: self._remove_duplicate_paragraph(m, b))
+                remove_button.grid(row=0, column=1, padx=(5, 0))
+                ctk.CTkLabel(row, text=member["preview"], anchor="w", justify="left", wraplength=560,
+                             text_color="gray", font=ctk.CTkFont(size=12)).grid(row=1, column=0, columnspan=2, sticky="ew")
+
+        if not clusters:
+            ctk.CTkLabel(self._duplicate_results_frame, text="No near-duplicate paragraphs found.", text_color="gray").pack(pady=10)
+        shown = f" (showing {DUPLICATE_REPORT_CLUSTERS})" if len(clusters) > DUPLICATE_REPORT_CLUSTERS else ""
+        self._duplicate_status.configure(
+            text=f"{stats['clusters']} clusters{shown} across {stats['paragraphs']} paragraphs; "
+                 f"{stats['rehashed_pages']} of {stats['pages']} pages rehashed in {stats['seconds'] * 1000:.0f} ms"
+        )
+
+    def _remove_duplicate_paragraph(self, member, button):
+        """Deletes one reported paragraph, including the blank line after it, if its page is unchanged."""
+        folder_name, page_name = member["folder"], member["page"]
+        is_current = (self.current_folder, self.current_page) == (folder_name, page_name)
+        if is_current and not self.save_current_page_content():
+            return
+        if self.app_state.get_page_version(folder_name, page_name) != member["version"]:
+            messagebox.showinfo("Page Changed", f"'{page_name}' changed since the analysis. Re-analyze and try again.", parent=self._duplicate_dialog)
+            return
+
+        rich_content_dump = self.app_state.get_page_content(folder_name, page_name)
+        text = rich_content_to_plain_text(rich_content_dump)
+        start = member["offset"]
+        end = start + member["length"]
+        while end < len(text) and text[end] in " \t":
+            end += 1
+        for _ in range(2):
+            if end < len(text) and text[end] == "\n":
+                end += 1
+        if self.app_state.update_page_content(folder_name, page_name, replace_rich_content_ranges(rich_content_dump, [(start, end, "")])):
+            button.configure(state="disabled", text="Removed")
+            if is_current:
+                self._last_saved_content_dump = None
+                self.select_page(folder_name, page_name)
+
+    # --- Command Palette ---
+    def _build_command_index(self):
+        """Fills the palette index with every folder, page, model and core action of the project."""
+        self.command_index = CommandIndex()
+        for folder_name in self.app_state.get_folders():
+            self.command_index.add("folder", folder_name, folder_name)
+            for page_name in self.app_state.get_pages(folder_name):
+                self.command_index.add("page", f"{folder_name} / {page_name}", (folder_name, page_name))
+        models = self.available_models or [self.app_state.get_selected_model()]
+        self.command_index.replace_kind("model", [(model_name, model_name) for model_name in models if model_name])
+        actions = {
+            "New Folder...": self.add_folder_dialog,
+            "New Page...": self.add_page_dialog,
+            "Delete Page": self.delete_page,
+            "Manage Functions...": self.manage_functions_dialog,
+            "Search Results...": self.open_search_panel,
+            "Find & Replace...": self.open_find_replace,
+            "Find Duplicates...": self.open_duplicate_report,
+            "AI Jobs...": self.open_jobs_panel,
+            "Batch Run...": self.open_batch_dialog,
+            "Clear AI Response Cache": self.clear_response_cache,
+            "Save Project As...": self.save_project_as,
+            "Load Project...": self.load_project,
+            "Settings": self.open_settings,
+            "Toggle Bold": self.toggle_bold,
+            "Toggle Italic": self.toggle_italic,
+            "Toggle Underline": self.toggle_underline,
+        }
+        if EVENT_LOOP_INSTRUMENTATION is not None:
+            actions["Event Loop Stats..."] = self.open_instrumentation_panel
+        self.command_index.replace_kind("action", actions.items())
+
+    def _on_palette_content_change(self, event, folder_name, page_name=None):
+        """AppState listener adding and removing palette entries as pages and folders change."""
+        if event == "page_added":
+            self.command_index.add("page", f"{folder_name} / {page_name}", (folder_name, page_name))
+        elif event == "page_deleted":
+            self.command_index.remove("page", f"{folder_name} / {page_name}")
+        elif event == "folder_added":
+            self.command_index.add("folder", folder_name, folder_name)
+        elif event == "folder_deleted":
+            self.command_index.remove("folder", folder_name)
+            self.command_index.remove_where(lambda kind, label, payload: kind == "page" and payload[0] == folder_name)
+
+    def open_command_palette(self, event=None):
+        """Opens the keyboard-driven palette for jumping to pages and running functions or actions."""
+        if self._palette is None or not self._palette.winfo_exists():
+            palette = ctk.CTkToplevel(self)
+            palette.title("Command Palette")
+            palette.transient(self)
+            palette.grid_columnconfigure(0, weight=1)
+            palette.grid_rowconfigure(1, weight=1)
+
+            self._palette_entry = ctk.CTkEntry(palette, placeholder_text="Go to page, run function, choose model...")
+            self._palette_entry.grid(row=0, column=0, padx=10, pady=(10, 5), sticky="ew")
+            self._palette_listbox = tk.Listbox(
+                palette, activestyle="none", exportselection=False, borderwidth=0, highlightthickness=0,
+                height=PALETTE_MAX_RESULTS, font=ctk.CTkFont(size=13).actual(),
+                background=self.workspace.cget("background"), foreground=self.workspace.cget("foreground"),
+                selectbackground=self.workspace.cget("selectbackground")
+            )
+            self._palette_listbox.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="nsew")
+
+            self._palette_entry.bind("<KeyRelease>", self._refresh_command_palette)
+            self._palette_entry.bind("<Down>", lambda e: self._move_palette_selection(1))
+            self._palette_entry.bind("<Up>", lambda e: self._move_palette_selection(-1))
+            self._palette_entry.bind("<Return>", lambda e: self._run_palette_selection())
+            self._palette_entry.bind("<Escape>", lambda e: self._close_command_palette())
+            self._palette_listbox.bind("<Double-Button-1>", lambda e: self._run_palette_selection())
+            palette.protocol("WM_DELETE_WINDOW", self._close_command_palette)
+            self._palette = palette
+
+        x = self.winfo_rootx() + max(0, (self.winfo_width() - 560) // 2)
+        y = self.winfo_rooty() + 80
+        self._palette.geometry(f"560x360+{x}+{y}")
+        self._palette.deiconify()
+        self._palette.lift()
+        self._palette_entry.delete(0, tk.END)
+        self._palette_last_query = None
+        self._refresh_command_palette()
+        self._palette_entry.focus_set()
+        return "break"
+
+    def _close_command_palette(self):
+        if self._palette is not None and self._palette.winfo_exists():
+            self._palette.withdraw()
+
+    def _refresh_command_palette(self, event=None):
+        query = self._palette_entry.get()
+        if query == self._palette_last_query:
+            return
+        self._palette_last_query = query
+        started = time.perf_counter()
+        self._palette_results = self.command_index.query(query)
+        if query.strip():
+            self.palette_latency.record((time.perf_counter() - started) * 1000)
+
+        kind_labels = {"page": "Page", "folder": "Folder", "function": "Function", "model": "Model", "action": "Action"}
+        listbox = self._palette_listbox
+        listbox.delete(0, tk.END)
+        for kind, label, payload in self._palette_results:
+            listbox.insert(tk.END, f"{label}    · {kind_labels.get(kind, kind)}")
+        if self._palette_results:
+            listbox.selection_set(0)
+
+    def _move_palette_selection(self, step):
+        if not self._palette_results:
+            return "break"
+        selection = self._palette_listbox.curselection()
+        index = (selection[0] if selection else 0) + step
+        index = max(0, min(len(self._palette_results) - 1, index))
+        self._palette_listbox.selection_clear(0, tk.END)
+        self._palette_listbox.selection_set(index)
+        self._palette_listbox.see(index)
+        return "break"
+
+    def _run_palette_selection(self):
+        selection = self._palette_listbox.curselection()
+        if not self._palette_results or not selection:
+            return "break"
+        kind, label, payload = self._palette_results[selection[0]]
+        self.command_index.mark_used(kind, label)
+        self._close_command_palette()
+        if kind == "page":
+            self.select_page(*payload)
+        elif kind == "folder":
+            self.select_folder(payload)
+        elif kind == "function":
+            self.run_ai_function(payload)
+        elif kind == "model":
+            self.app_state.set_selected_model(payload)
+            self.status_bar.configure(text=f"Model: {payload}")
+        elif kind == "action":
+            payload()
+        return "break"
 
     def clear_search(self):
         """Clears the search entry and results."""
         self.search_entry.delete(0, tk.END)
+        self._last_search_term = ""
+        self._search_generation += 1
+        self.search_worker.cancel(self._search_generation)
         self.search_results.clear()
         self.update_sidebar()
 
+    def _sidebar_page_window(self, folder_name, pages):
+        """Returns the [start, end) slice of a folder's sorted pages that gets widgets."""
+        if len(pages) <= SIDEBAR_PAGE_WINDOW:
+            return 0, len(pages)
+        start = self._sidebar_window_starts.get(folder_name, 0)
+        if folder_name == self.current_folder and self.current_page in pages and self._sidebar_window_anchors.get(folder_name) != self.current_page:
+            self._sidebar_window_anchors[folder_name] = self.current_page
+            selected_index = pages.index(self.current_page)
+            if not start <= selected_index < start + SIDEBAR_PAGE_WINDOW:
+                start = selected_index - SIDEBAR_PAGE_WINDOW // 2
+        start = max(0, min(start, len(pages) - SIDEBAR_PAGE_WINDOW))
+        self._sidebar_window_starts[folder_name] = start
+        return start, start + SIDEBAR_PAGE_WINDOW
+
+    def _shift_sidebar_window(self, folder_name, direction):
+        step = SIDEBAR_PAGE_WINDOW // 2
+        start = self._sidebar_window_starts.get(folder_name, 0)
+        self._sidebar_window_starts[folder_name] = max(0, start + (step if direction == "next" else -step))
+        self.update_sidebar()
+
+    def _create_sidebar_row(self, key):
+        """Creates the widgets for one navigator row; their look is applied by _configure_sidebar_row."""
+        hover_color = self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["hover_color"])
+        if key[0] == "folder":
+            folder_button = ctk.CTkButton(
+                self.folder_page_frame, text="", image=self.icon_folder, compound="left", anchor="w",
+                command=lambda fn=key[1]: self._on_sidebar_folder_click(fn), hover_color=hover_color
+            )
+            return [folder_button]
+        if key[0] == "more":
+            more_button = ctk.CTkButton(
+                self.folder_page_frame, text="", height=22, fg_color="transparent", hover_color=hover_color,
+                text_color=("gray40", "gray70"), font=self._sidebar_fonts["page"],
+                command=lambda fn=key[1], d=key[2]: self._shift_sidebar_window(fn, d)
+            )
+            return [more_button]
+
+        folder_name, page_name = key[1], key[2]
+        page_button = ctk.CTkButton(
+            self.folder_page_frame, text=f" {page_name}", image=self.icon_page, compound="left", anchor="w",
+            command=lambda fn=folder_name, pn=page_name: self.select_page(fn, pn),
+            text_color_disabled=self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["text_color_disabled"]),
+            height=26, font=self._sidebar_fonts["page"], hover_color=hover_color
+        )
+        ref_button = ctk.CTkButton(
+            self.folder_page_frame, text="📌", width=20,
+            command=lambda fn=folder_name, pn=page_name: self.add_reference(fn, pn),
+        )
+        return [page_button, ref_button]
+
+    def _configure_sidebar_row(self, key, widgets, state):
+        if key[0] == "folder":
+            text, fg_color, font_weight = state
+            widgets[0].configure(text=text, fg_color=fg_color, font=self._sidebar_fonts[font_weight])
+        elif key[0] == "more":
+            widgets[0].configure(text=state[0])
+        else:
+            widgets[0].configure(fg_color=state[0])
+
+    def _grid_sidebar_row(self, key, widgets, row_index):
+        if key[0] == "folder":
+            widgets[0].grid(row=row_index, column=0, pady=(6, 2), padx=5, sticky="ew")
+        elif key[0] == "more":
+            widgets[0].grid(row=row_index, column=0, pady=1, padx=(25, 5), sticky="ew")
+        else:
+            widgets[0].grid(row=row_index, column=0, pady=1, padx=(25, 5), sticky="ew")
+            widgets[1].grid(row=row_index, column=1, pady=1, padx=2)
+
+    def _on_sidebar_folder_click(self, folder_name):
+        """Selects a folder, or toggles its expansion when it is already selected."""
+        if folder_name == self.current_folder:
+            self.toggle_folder_expansion(folder_name)
+        else:
+            self.select_folder(folder_name)
+
     def toggle_folder_expansion(self, folder_name):
         """Toggles the expanded/collapsed state of a folder."""
         current_state = self.folder_expanded_state.get(folder_name, True)
@@ -778,79 +1649,70 @@ class App(ctk.CTk):
         self.update_sidebar()
 
     def update_sidebar(self):
-        for widget in self.folder_page_frame.winfo_children():
-            widget.destroy()
-
-        folders = self.app_state.get_folders()
-        row_index = 0
+        """Reconciles the navigator rows with the project, touching only rows that changed.
 
+        Rows are keyed by folder or (folder, page); existing widgets are reconfigured in place and
+        only re-gridded when their position moves. Expanded folders with more than
+        SIDEBAR_PAGE_WINDOW pages only get widgets for a window of pages around the selection.
+        """
+        started = time.perf_counter()
         theme = ctk.ThemeManager.theme
         selected_fg_color = self._apply_appearance_mode(theme["CTkButton"]["fg_color"])
         normal_folder_fg_color = self._apply_appearance_mode(("gray75", "gray28"))
         normal_page_fg_color = self._apply_appearance_mode(("gray85", "gray35"))
-        hover_color = self._apply_appearance_mode(theme["CTkButton"]["hover_color"])
         search_highlight_color = self._apply_appearance_mode(("#aaddff", "#005588"))
 
-        for folder_name in sorted(folders):
+        desired = []
+        for folder_name in sorted(self.app_state.get_folders()):
             is_selected_folder = (folder_name == self.current_folder)
             is_expanded = self.folder_expanded_state.get(folder_name, True)
-
-            fg_color = selected_fg_color if is_selected_folder else normal_folder_fg_color
-            font_weight = "bold" if is_selected_folder else "normal"
-            expand_indicator = "[-] " if is_expanded else "[+] "
-            folder_display_text = f"{expand_indicator}{folder_name}"
-
-            folder_button = ctk.CTkButton(
-                self.folder_page_frame,
-                text=folder_display_text,
-                image=self.icon_folder,
-                compound="left",
-                command=lambda fn=folder_name: self.toggle_folder_expansion(fn) if not is_selected_folder else self.select_folder(fn),
-                anchor="w",
-                font=ctk.CTkFont(weight=font_weight),
-                fg_color=fg_color,
-                hover_color=hover_color
-            )
-            folder_button.bind("<Button-1>", lambda e, fn=folder_name: self.select_folder(fn))
-            folder_button.grid(row=row_index, column=0, pady=(6, 2), padx=5, sticky="ew")
-            row_index += 1
-
-            if is_expanded:
-                pages = self.app_state.get_pages(folder_name)
-                for page_name in sorted(pages):
-                     is_selected_page = (is_selected_folder and page_name == self.current_page)
-                     is_search_match = (folder_name, page_name) in self.search_results
-
-                     page_fg_color = normal_page_fg_color
-                     if is_selected_page:
-                         page_fg_color = selected_fg_color
-                     elif is_search_match:
-                         page_fg_color = search_highlight_color
-
-                     page_button = ctk.CTkButton(
-                         self.folder_page_frame,
-                         text=f" {page_name}",
-                         image=self.icon_page,
-                         compound="left",
-                         command=lambda fn=folder_name, pn=page_name: self.select_page(fn, pn),
-                         anchor="w",
-                         fg_color=page_fg_color,
-                         text_color_disabled=self._apply_appearance_mode(theme["CTkButton"]["text_color_disabled"]),
-                         height=26,
-                         font=ctk.CTkFont(size=12),
-                         hover_color=hover_color
-                     )
-                     page_button.grid(row=row_index, column=0, pady=1, padx=(25, 5), sticky="ew")
-
-                     ref_button = ctk.CTkButton(
-                         self.folder_page_frame,
-                         text="📌",
-                         width=20,
-                         command=lambda fn=folder_name, pn=page_name: self.add_reference(fn, pn),
-                     )
-                     ref_button.grid(row=row_index, column=1, pady=1, padx=2)
-
-                     row_index += 1
+            desired.append((("folder", folder_name), (
+                f"{'[-] ' if is_expanded else '[+] '}{folder_name}",
+                selected_fg_color if is_selected_folder else normal_folder_fg_color,
+                "bold" if is_selected_folder else "normal",
+            )))
+            if not is_expanded:
+                continue
+
+            pages = sorted(self.app_state.get_pages(folder_name))
+            window_start, window_end = self._sidebar_page_window(folder_name, pages)
+            if window_start > 0:
+                desired.append((("more", folder_name, "previous"), (f"▲ {window_start} more pages",)))
+            for page_name in pages[window_start:window_end]:
+                if is_selected_folder and page_name == self.current_page:
+                    page_fg_color = selected_fg_color
+                elif (folder_name, page_name) in self.search_results:
+                    page_fg_color = search_highlight_color
+                else:
+                    page_fg_color = normal_page_fg_color
+                desired.append((("page", folder_name, page_name), (page_fg_color,)))
+            if window_end < len(pages):
+                desired.append((("more", folder_name, "next"), (f"▼ {len(pages) - window_end} more pages",)))
+
+        desired_keys = {key for key, state in desired}
+        for key in [key for key in self._sidebar_rows if key not in desired_keys]:
+            for widget in self._sidebar_rows.pop(key)["widgets"]:
+                widget.destroy()
+
+        created = updated = moved = 0
+        for row_index, (key, state) in enumerate(desired):
+            row = self._sidebar_rows.get(key)
+            if row is None:
+                row = {"widgets": self._create_sidebar_row(key), "state": None, "row": None}
+                self._sidebar_rows[key] = row
+                created += 1
+            if row["state"] != state:
+                self._configure_sidebar_row(key, row["widgets"], state)
+                row["state"] = state
+                updated += 1
+            if row["row"] != row_index:
+                self._grid_sidebar_row(key, row["widgets"], row_index)
+                row["row"] = row_index
+                moved += 1
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.sidebar_latency.record(elapsed_ms)
+        self._last_sidebar_update = {"rows": len(desired), "created": created, "updated": updated, "moved": moved, "ms": elapsed_ms}
 
         can_add_page = self.current_folder is not None
         can_delete_folder = self.current_folder is not None and len(self.app_state.get_folders()) > 1
@@ -862,28 +1724,33 @@ class App(ctk.CTk):
         self.update_references_list()
 
     def update_references_list(self):
-        """Updates the references list display."""
-        for widget in self.references_list.winfo_children():
-            widget.destroy()
-
+        """Syncs the references panel with AppState, adding or removing only the rows that changed."""
         references = self.app_state.get_references()
-        if not references:
-            label = ctk.CTkLabel(self.references_list, text="No references added", text_color="gray")
-            label.pack(pady=5)
-            return
+        for ref_key in [key for key in self._reference_rows if key not in references]:
+            self._reference_rows.pop(ref_key).destroy()
 
         for ref_key, ref_data in references.items():
+            if ref_key in self._reference_rows:
+                continue
             ref_frame = ctk.CTkFrame(self.references_list, fg_color="transparent")
             ref_frame.pack(fill="x", padx=2, pady=1)
-            
+
             label = ctk.CTkLabel(ref_frame, text=f"📄 {ref_data['page']}", anchor="w")
             label.pack(side="left", padx=(5,0))
-            
+
             remove_btn = ctk.CTkButton(
                 ref_frame, text="×", width=20, height=20,
                 command=lambda f=ref_data['folder'], p=ref_data['page']: self.remove_reference(f, p)
             )
             remove_btn.pack(side="right", padx=(5,0))
+            self._reference_rows[ref_key] = ref_frame
+
+        if self._no_references_label is None:
+            self._no_references_label = ctk.CTkLabel(self.references_list, text="No references added", text_color="gray")
+        if references:
+            self._no_references_label.pack_forget()
+        elif not self._no_references_label.winfo_manager():
+            self._no_references_label.pack(pady=5)
 
     def add_reference(self, folder_name, page_name):
         """Adds current page to references."""
@@ -897,6 +1764,7 @@ class App(ctk.CTk):
 
     def select_folder(self, folder_name):
         print(f"Selecting folder: {folder_name}")
+        self._detach_live_job()
         if self.current_page:
              if not self.save_current_page_content():
                  print("Save failed, aborting folder selection.")
@@ -925,6 +1793,8 @@ class App(ctk.CTk):
 
     def select_page(self, folder_name, page_name):
         print(f"Selecting page: {folder_name} / {page_name}")
+        open_started = time.perf_counter()
+        self._detach_live_job()
 
         if self.current_folder and self.current_page and \
            (self.current_folder != folder_name or self.current_page != page_name):
@@ -935,39 +1805,29 @@ class App(ctk.CTk):
         self.current_folder = folder_name
         self.current_page = page_name
 
+        running_jobs = [job for job in self.ai_scheduler.page_jobs(folder_name, page_name)
+                        if job.status == "running" and not job.applied and "batch" not in job.details]
+        for job in running_jobs:
+            if job is not self._live_job:
+                self._apply_stored_job_text(job)
+
         rich_content_dump = self.app_state.get_page_content(folder_name, page_name)
         self._last_saved_content_dump = rich_content_dump
+        prepared = self.prefetcher.take(folder_name, page_name, self.app_state.get_page_version(folder_name, page_name))
 
         self.workspace.configure(state="normal")
         self.workspace.delete("1.0", tk.END)
 
         try:
             if rich_content_dump:
-                text_content = "".join(item[1] for item in rich_content_dump if item[0] == "text")
-                if text_content.endswith('\n'):
-                     text_content = text_content[:-1]
+                text_content, tag_ranges = prepared if prepared is not None else prepare_rich_content(rich_content_dump)
                 self.workspace.insert("1.0", text_content)
 
-                tag_ranges = {}
-                tag_starts = {}
-
-                sorted_dump = sorted(rich_content_dump, key=lambda x: self._tk_index_to_tuple(x[2]))
-
-                for item_type, value, index_str in sorted_dump:
-                    if item_type.startswith("tagon-"):
-                        tag_name = item_type.split("-", 1)[1]
-                        tag_starts[tag_name] = index_str
-                    elif item_type.startswith("tagoff-"):
-                        tag_name = item_type.split("-", 1)[1]
-                        if tag_name in tag_starts:
-                            start_index = tag_starts.pop(tag_name)
-                            try:
-                                start_tk = self.workspace.index(start_index)
-                                end_tk = self.workspace.index(index_str)
-                                if start_tk and end_tk:
-                                    self.workspace.tag_add(tag_name, start_tk, end_tk)
-                            except tk.TclError as e:
-                                print(f"Warning: Invalid index during tag application for '{tag_name}': {start_index}-{index_str} ({e})")
+                for tag_name, start_index, end_index in tag_ranges:
+                    try:
+                        self.workspace.tag_add(tag_name, start_index, end_index)
+                    except tk.TclError as e:
+                        print(f"Warning: Invalid index during tag application for '{tag_name}': {start_index}-{end_index} ({e})")
 
             self.workspace.edit_reset()
             self.workspace.edit_modified(False)
@@ -982,43 +1842,101 @@ class App(ctk.CTk):
                 print(f"Error in fallback load: {fb_e}")
                 self.workspace.insert("1.0", f"--- Error loading content. Could not extract raw text. ---\nError: {e}")
 
+        for job in running_jobs:
+            if self._live_job is None:
+                self._attach_live_job(job)
+
         self.update_sidebar()
         self.update_function_bar()
         self.toggle_format_toolbar(True)
+        self._sync_workspace_for_jobs()
         self.status_bar.configure(text=f"Editing: {folder_name} / {page_name}")
         self.update_word_count()
 
+        elapsed_ms = (time.perf_counter() - open_started) * 1000
+        self.page_open_latency.record(elapsed_ms)
+        print(f"Page opened in {elapsed_ms:.1f} ms ({'prefetched' if prepared is not None else 'parsed'}, "
+              f"prefetch hit rate {self.prefetcher.hit_rate():.0%})")
+        self._prefetch_likely_next_pages(folder_name, page_name)
+
+    def _prefetch_likely_next_pages(self, folder_name, page_name):
+        """Queues the sidebar neighbours and the reference pages of the opened page for preparation."""
+        ordered_pages = [(f, p) for f in sorted(self.app_state.get_folders()) for p in sorted(self.app_state.get_pages(f))]
+        candidates = []
+        try:
+            position = ordered_pages.index((folder_name, page_name))
+            for offset in range(1, PREFETCH_NEIGHBOURS + 1):
+                if position + offset < len(ordered_pages):
+                    candidates.append(ordered_pages[position + offset])
+                if position - offset >= 0:
+                    candidates.append(ordered_pages[position - offset])
+        except ValueError:
+            pass
+
+        for ref_data in self.app_state.get_references().values():
+            candidates.append((ref_data['folder'], ref_data['page']))
+
+        self.prefetcher.schedule([key for key in dict.fromkeys(candidates) if key != (folder_name, page_name)])
+
+    def report_performance(self):
+        """Prints the collected performance statistics."""
+        print(f"Page open latency: {self.page_open_latency.format_summary()}")
+        print(f"Prefetch cache: {self.prefetcher.hits} hits / {self.prefetcher.misses} misses ({self.prefetcher.hit_rate():.0%} hit rate)")
+        print(f"Autocomplete query latency: {self.autocomplete_latency.format_summary()}")
+        print(f"Search keystroke-to-results latency: {self.search_latency.format_summary()}")
+        print(f"Ranked search query latency: {self.ranked_search_latency.format_summary()}")
+        print(f"Sidebar refresh latency: {self.sidebar_latency.format_summary()} (last: {self._last_sidebar_update})")
+        print(f"Icons: {ICON_REGISTRY.format_stats()}")
+        if self.ai_stream_history:
+            rates = [entry["tokens_per_second"] for entry in self.ai_stream_history]
+            print(f"AI time to first token: {self.ai_ttft_latency.format_summary()}; "
+                  f"mean {sum(rates) / len(rates):.1f} tokens/s over {len(rates)} streamed calls")
+        print(f"AI response cache: {self.response_cache.format_stats()}")
+        if HTTP_CLIENT.stats["requests"]:
+            print(f"HTTP: {HTTP_CLIENT.format_stats()}")
+        if self.ai_scheduler.history:
+            print(f"AI job queue wait: {self.ai_scheduler.wait_latency.format_summary()} over {len(self.ai_scheduler.history)} jobs")
+        if EVENT_LOOP_INSTRUMENTATION is not None:
+            print(f"Event loop lag: {EVENT_LOOP_INSTRUMENTATION.loop_lag.format_summary()}")
+            for row in EVENT_LOOP_INSTRUMENTATION.handler_rows()[:10]:
+                print(f"  {row['handler']}: n={row['count']} p50={row['p50']:.1f}ms p95={row['p95']:.1f}ms p99={row['p99']:.1f}ms")
+        if LAZY_IMPORT_SECONDS:
+            print("Lazy imports: " + ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in LAZY_IMPORT_SECONDS.items()))
+        print(f"Function bar update latency: {self.function_bar_latency.format_summary()}")
+        print(f"Model picker filter latency ({len(self.model_catalog)} models): {self.model_filter_latency.format_summary()}")
+        print(f"Command palette query latency ({len(self.command_index)} entries): {self.palette_latency.format_summary()}")
+        retrieval = self.retrieval_stats
+        if retrieval["calls"]:
+            reduction = 1 - retrieval["sent_chars"] / max(retrieval["full_chars"], 1)
+            print(f"Context retrieval: {retrieval['calls']} calls, {retrieval['fallbacks']} fallbacks, "
+                  f"{retrieval['sent_chars']} of {retrieval['full_chars']} reference chars sent ({reduction:.0%} smaller), "
+                  f"latency {self.retrieval_latency.format_summary()}")
+        for stats in self.find_replace_stats:
+            print(f"Find & replace run: {format_find_replace_throughput(stats)}")
+        for stats in self.duplicate_runs:
+            print(f"Duplicate analysis: {stats['paragraphs']} paragraphs, {stats['rehashed_pages']}/{stats['pages']} pages rehashed, "
+                  f"{stats['clusters']} clusters in {stats['seconds'] * 1000:.0f} ms")
+        cache_stats = self.app_state.plain_text_cache.stats()
+        print(f"Plain-text cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%}), "
+              f"{cache_stats['entries']} pages, {cache_stats['chars']} chars")
+        stats = self.continuation_stats
+        coalesced = self.batched_edit_stats["coalesced"]
+        print(f"Batched edits: {self.batched_edit_stats['batches']} batches coalesced {sum(coalesced.values())} hook calls {dict(coalesced)}")
+        print(f"Ghost text: {stats['requested']} requested, {stats['shown']} shown, {stats['accepted']} accepted "
+              f"({self.continuation_acceptance_rate():.0%} acceptance), {stats['requested'] - stats['accepted']} wasted")
 
     def save_current_page_content(self):
         """Saves the rich text content of the current page to AppState."""
+        if self._batch_depth:
+            if self._live_job is not None and self._live_job.began:
+                return self._save_with_live_job()
+            self._note_coalesced_hook("save_current_page_content")
+            return True
+        self._clear_ghost_text()
         if self.current_folder and self.current_page and self.workspace.cget("state") == "normal":
             try:
                 raw_dump = self.workspace.dump("1.0", tk.END, text=True, tag=True, window=False)
-
-                rich_content_dump = []
-                current_text = ""
-                last_index = "1.0"
-
-                for key, value, index in raw_dump:
-                    index_str = self.workspace.index(index)
-                    if key == "text":
-                        current_text += value
-                        last_index = self.workspace.index(f"{index_str}+{len(value)}c")
-                    elif key == "tagon":
-                        if current_text:
-                             rich_content_dump.append(("text", current_text, self.workspace.index(f"{last_index}-{len(current_text)}c")))
-                             current_text = ""
-                        rich_content_dump.append((f"tagon-{value}", "", index_str))
-                        last_index = index_str
-                    elif key == "tagoff":
-                        if current_text:
-                             rich_content_dump.append(("text", current_text, self.workspace.index(f"{last_index}-{len(current_text)}c")))
-                             current_text = ""
-                        rich_content_dump.append((f"tagoff-{value}", "", index_str))
-                        last_index = index_str
-
-                if current_text:
-                    rich_content_dump.append(("text", current_text, self.workspace.index(f"{last_index}-{len(current_text)}c")))
+                rich_content_dump = text_dump_to_rich_content(raw_dump)
 
                 if not rich_content_dump and not self.workspace.get("1.0", "end-1c"):
                     rich_content_dump = [("text", "", "1.0")]
@@ -1060,18 +1978,15 @@ class App(ctk.CTk):
         return False
 
 
-    def _tk_index_to_tuple(self, index):
-        try:
-            if isinstance(index, str):
-                index = self.workspace.index(index)
-                line, char = map(int, index.split('.'))
-                return (line, char)
-            elif isinstance(index, (tuple, list)) and len(index) == 2:
-                 return tuple(index)
-            return (0, 0)
-        except Exception as e:
-            print(f"Error converting index {index}: {e}")
-            return (0, 0)
+    def _save_with_live_job(self):
+        """Saves the open page while a job streams into it, whose batched edit would otherwise defer the save."""
+        job = self._live_job
+        state = self.workspace.cget("state")
+        self._detach_live_job()
+        saved = self.save_current_page_content()
+        self._attach_live_job(job)
+        self.workspace.configure(state=state)
+        return saved
 
     def clear_save_status(self):
         current_status = self.status_bar.cget("text")
@@ -1083,9 +1998,230 @@ class App(ctk.CTk):
 
     def on_text_change(self, event=None):
         """Handles text changes for saving and word count."""
+        if self._batch_depth:
+            self._note_coalesced_hook("on_text_change")
+            return
         if self.workspace.edit_modified():
             self.save_current_page_content()
         self.update_word_count()
+        if event is not None:
+            self._update_autocomplete(event)
+            self._schedule_continuation(event)
+
+    def _update_autocomplete(self, event):
+        """Queries the completion index for the word or phrase being typed and shows the popup."""
+        if event.keysym in AUTOCOMPLETE_IGNORED_KEYS or not self._content_indexes_ready:
+            return
+        if event.keysym != "BackSpace" and not (event.char and event.char.isprintable()):
+            self._hide_autocomplete()
+            return
+
+        started = time.perf_counter()
+        line_text = self.workspace.get("insert linestart", tk.INSERT)
+        fragment = re.search(r"[\w'-]*$", line_text).group()
+        if not fragment:
+            self._hide_autocomplete()
+            return
+
+        before = line_text[:-len(fragment)]
+        previous_words = re.findall(r"[\w'-]+", before)[-(AUTOCOMPLETE_MAX_PHRASE_WORDS - 1):] if before.endswith(" ") else []
+        typed_candidates = [" ".join(previous_words[-n:] + [fragment]) for n in range(len(previous_words), 0, -1)]
+        if len(fragment) >= AUTOCOMPLETE_MIN_PREFIX:
+            typed_candidates.append(fragment)
+
+        suggestions = []
+        seen = set()
+        for typed in typed_candidates:
+            for suggestion in self.completion_index.query(typed):
+                if suggestion.lower() not in seen:
+                    seen.add(suggestion.lower())
+                    suggestions.append((typed, suggestion))
+        suggestions = suggestions[:AUTOCOMPLETE_MAX_SUGGESTIONS]
+        self.autocomplete_latency.record((time.perf_counter() - started) * 1000)
+
+        if suggestions:
+            self._show_autocomplete(suggestions)
+        else:
+            self._hide_autocomplete()
+
+    def _show_autocomplete(self, suggestions):
+        bbox = self.workspace.bbox(tk.INSERT)
+        if not bbox:
+            self._hide_autocomplete()
+            return
+        if self._autocomplete_popup is None:
+            self._autocomplete_popup = tk.Toplevel(self)
+            self._autocomplete_popup.overrideredirect(True)
+            self._autocomplete_popup.withdraw()
+            self._autocomplete_listbox = tk.Listbox(
+                self._autocomplete_popup, activestyle="none", exportselection=False, borderwidth=1,
+                background=self.workspace.cget("background"), foreground=self.workspace.cget("foreground"),
+                selectbackground=self.workspace.cget("selectbackground")
+            )
+            self._autocomplete_listbox.pack(fill="both", expand=True)
+            self._autocomplete_listbox.bind("<ButtonRelease-1>", lambda e: self._accept_autocomplete())
+
+        self._autocomplete_suggestions = suggestions
+        listbox = self._autocomplete_listbox
+        listbox.delete(0, tk.END)
+        for typed, suggestion in suggestions:
+            listbox.insert(tk.END, suggestion)
+        listbox.configure(height=len(suggestions), width=max(len(s) for t, s in suggestions) + 2)
+        listbox.selection_set(0)
+
+        x = self.workspace.winfo_rootx() + bbox[0]
+        y = self.workspace.winfo_rooty() + bbox[1] + bbox[3] + 2
+        self._autocomplete_popup.geometry(f"+{x}+{y}")
+        self._autocomplete_popup.deiconify()
+        self._autocomplete_popup.lift()
+
+    def _hide_autocomplete(self):
+        self._autocomplete_suggestions = []
+        if self._autocomplete_popup is not None:
+            self._autocomplete_popup.withdraw()
+
+    def _move_autocomplete_selection(self, step):
+        if not self._autocomplete_suggestions:
+            self._cancel_continuation()
+            return None
+        listbox = self._autocomplete_listbox
+        current = listbox.curselection()
+        new_index = ((current[0] if current else 0) + step) % len(self._autocomplete_suggestions)
+        listbox.selection_clear(0, tk.END)
+        listbox.selection_set(new_index)
+        return "break"
+
+    def _accept_autocomplete(self):
+        """Inserts the rest of the selected suggestion at the cursor."""
+        if not self._autocomplete_suggestions or self.workspace.cget("state") == "disabled":
+            return False
+        current = self._autocomplete_listbox.curselection()
+        typed, suggestion = self._autocomplete_suggestions[current[0] if current else 0]
+        self._hide_autocomplete()
+        self.workspace.insert(tk.INSERT, suggestion[len(typed):])
+        self.on_text_change()
+        return True
+
+    def _on_tab_key(self, event=None):
+        if self._accept_autocomplete() or self._accept_ghost_text():
+            return "break"
+        self._cancel_continuation()
+        return None
+
+    def _dismiss_suggestions(self):
+        self._hide_autocomplete()
+        self._cancel_continuation()
+
+    def _on_workspace_keypress(self, event):
+        """Discards pending or displayed ghost text as soon as the user types."""
+        if event.keysym not in AUTOCOMPLETE_IGNORED_KEYS:
+            self._cancel_continuation()
+
+    # --- Speculative AI Continuation (Ghost Text) ---
+    def _schedule_continuation(self, event):
+        """Restarts the idle timer that issues a background continuation request."""
+        if event.keysym in AUTOCOMPLETE_IGNORED_KEYS or not self.app_state.get_ai_continuation_enabled():
+            return
+        self._cancel_continuation()
+        self._continuation_after_id = self.after(self.app_state.get_ai_continuation_idle_ms(), self._request_continuation)
+
+    def _cancel_continuation(self):
+        """Cancels the idle timer, invalidates in-flight requests and removes shown ghost text."""
+        if self._continuation_after_id is not None:
+            self.after_cancel(self._continuation_after_id)
+            self._continuation_after_id = None
+        self._continuation_generation += 1
+        if self._clear_ghost_text():
+            self.continuation_stats["rejected"] += 1
+
+    def _request_continuation(self):
+        self._continuation_after_id = None
+        if not self.current_page or self.workspace.cget("state") == "disabled":
+            return
+        if self._continuation_in_flight:
+            self._continuation_after_id = self.after(self.app_state.get_ai_continuation_idle_ms(), self._request_continuation)
+            return
+
+        model_name = self.app_state.get_selected_model()
+        if not model_name or model_name in INVALID_MODEL_NAMES or not self.configure_genai():
+            return
+        context_text = self.workspace.get("1.0", tk.INSERT)[-CONTINUATION_CONTEXT_CHARS:]
+        if not context_text.strip():
+            return
+
+        self._continuation_in_flight = True
+        self.continuation_stats["requested"] += 1
+        thread = threading.Thread(
+            target=self._continuation_thread,
+            args=(self._continuation_generation, self.app_state, self.chunk_retriever, self.app_state.get_api_provider(),
+                  self.app_state.get_selected_api_key_value(), model_name, context_text),
+            daemon=True
+        )
+        thread.start()
+
+    def _continuation_thread(self, generation, app_state, chunk_retriever, provider, api_key, model_name, context_text):
+        try:
+            reference_content, stats = build_context_content(app_state, chunk_retriever, context_text)
+            if stats["mode"] != "off":
+                self.after(0, self._record_retrieval_stats, stats)
+            combined_content = f"{reference_content}{context_text}"
+            response = generate_ai_response(provider, api_key, model_name, CONTINUATION_SYSTEM_PROMPT, combined_content)
+            self.after(0, self._handle_continuation, generation, response, provider, context_text)
+        except Exception as e:
+            print(f"Speculative continuation failed: {type(e).__name__} - {e}")
+            self.after(0, self._handle_continuation, generation, None, provider, context_text)
+
+    def _handle_continuation(self, generation, response, provider, context_text):
+        self._continuation_in_flight = False
+        if response is None or generation != self._continuation_generation or self.workspace.cget("state") == "disabled":
+            self.continuation_stats["discarded"] += 1
+            return
+        try:
+            ghost_text = extract_ai_text(response, provider)[:CONTINUATION_MAX_CHARS]
+        except Exception as e:
+            print(f"Discarding continuation: {e}")
+            self.continuation_stats["discarded"] += 1
+            return
+        if context_text[-1:].isalnum() and ghost_text[:1].isalnum():
+            ghost_text = " " + ghost_text
+
+        was_modified = self.workspace.edit_modified()
+        cursor_pos = self.workspace.index(tk.INSERT)
+        self.workspace.configure(undo=False)
+        self.workspace.insert(cursor_pos, ghost_text, ("ghost",))
+        self.workspace.configure(undo=True)
+        self.workspace.mark_set(tk.INSERT, cursor_pos)
+        self.workspace.edit_modified(was_modified)
+        self.continuation_stats["shown"] += 1
+
+    def _clear_ghost_text(self):
+        """Removes displayed ghost text without touching the undo stack. Returns the removed text."""
+        ranges = self.workspace.tag_ranges("ghost")
+        if not ranges:
+            return ""
+        ghost_text = self.workspace.get(ranges[0], ranges[-1])
+        was_modified = self.workspace.edit_modified()
+        previous_state = self.workspace.cget("state")
+        self.workspace.configure(state="normal", undo=False)
+        self.workspace.delete(ranges[0], ranges[-1])
+        self.workspace.configure(state=previous_state, undo=True)
+        self.workspace.edit_modified(was_modified)
+        return ghost_text
+
+    def _accept_ghost_text(self):
+        ghost_text = self._clear_ghost_text()
+        if not ghost_text:
+            return False
+        self.workspace.edit_separator()
+        self.workspace.insert(tk.INSERT, ghost_text)
+        self.workspace.edit_separator()
+        self.continuation_stats["accepted"] += 1
+        self.on_text_change()
+        return True
+
+    def continuation_acceptance_rate(self):
+        shown = self.continuation_stats["shown"]
+        return (self.continuation_stats["accepted"] / shown) if shown else 0.0
 
     def add_folder_dialog(self):
         dialog = ctk.CTkInputDialog(text="Enter new folder name:", title="Add Folder")
@@ -1121,6 +2257,9 @@ class App(ctk.CTk):
 
         if messagebox.askyesno("Delete Folder", f"🚨 Are you sure you want to permanently delete the folder '{self.current_folder}' and ALL its pages and functions?\nThis action cannot be undone.", icon='warning', parent=self):
              folder_to_delete = self.current_folder
+             if self._live_job is not None and self._live_job.folder_name == folder_to_delete:
+                 self._abandon_live_job()
+             self.ai_scheduler.cancel_page(folder_to_delete)
              self.current_folder = None
              self.current_page = None
              self.workspace.configure(state="normal")
@@ -1148,6 +2287,9 @@ class App(ctk.CTk):
         if messagebox.askyesno("Delete Page", f"Are you sure you want to delete the page '{self.current_page}' from folder '{self.current_folder}'?\nThis action cannot be undone.", icon='warning', parent=self):
             folder = self.current_folder
             page_to_delete = self.current_page
+            if self._live_job is not None and self._ai_job_is_visible(self._live_job):
+                self._abandon_live_job()
+            self.ai_scheduler.cancel_page(folder, page_to_delete)
 
             self.current_page = None
             self.workspace.configure(state="normal")
@@ -1167,41 +2309,84 @@ class App(ctk.CTk):
             else:
                  messagebox.showerror("Delete Page", f"Failed to delete page '{page_to_delete}'.", parent=self)
 
-    def update_function_bar(self):
+    def _create_function_bar_widgets(self):
+        """Creates the function bar's persistent containers; buttons are added by update_function_bar."""
+        self._function_bar_placeholder = ctk.CTkLabel(self.function_bar_frame, text="Select a folder to see AI functions", text_color=("gray50", "gray50"))
+
+        self._function_manage_frame = ctk.CTkFrame(self.function_bar_frame, fg_color="transparent")
+        batch_button = ctk.CTkButton(self._function_manage_frame, text="Batch...", command=self.open_batch_dialog, width=80)
+        batch_button.pack(side=tk.LEFT, padx=(0,5))
+        add_func_button = ctk.CTkButton(self._function_manage_frame, text="+ New", command=self.manage_functions_dialog, width=80)
+        add_func_button.pack(side=tk.LEFT, padx=(0,5))
+        edit_func_button = ctk.CTkButton(self._function_manage_frame, text="Manage", command=self.manage_functions_dialog, width=90)
+        edit_func_button.pack(side=tk.LEFT)
+
+        self._function_scroll_frame = ctk.CTkScrollableFrame(self.function_bar_frame, orientation="horizontal", height=40, fg_color="transparent", scrollbar_button_color=self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["fg_color"]), scrollbar_button_hover_color=self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["hover_color"]))
+        self._no_functions_label = ctk.CTkLabel(self._function_scroll_frame, text="No functions defined. Use 'Manage' to add.", text_color=("gray50", "gray50"))
+        self._function_buttons = {}
+        self._function_button_states = {}
+        self._function_order = None
+        self._function_bar_mode = None
+
+    def _destroy_function_bar_widgets(self):
+        """Drops every function bar widget so the next update rebuilds from scratch."""
         for widget in self.function_bar_frame.winfo_children():
             widget.destroy()
+        self._function_bar_placeholder = None
+
+    def update_function_bar(self):
+        """Shows the current folder's functions, reusing buttons and only toggling their state where possible."""
+        started = time.perf_counter()
+        if self._function_bar_placeholder is None:
+            self._create_function_bar_widgets()
 
         if not self.current_folder:
-            label = ctk.CTkLabel(self.function_bar_frame, text="Select a folder to see AI functions", text_color=("gray50", "gray50"))
-            label.pack(side=tk.LEFT, padx=5, pady=5)
+            self.command_index.replace_kind("function", [])
+            if self._function_bar_mode != "empty":
+                self._function_manage_frame.pack_forget()
+                self._function_scroll_frame.pack_forget()
+                self._function_bar_placeholder.pack(side=tk.LEFT, padx=5, pady=5)
+                self._function_bar_mode = "empty"
             return
 
-        manage_button_frame = ctk.CTkFrame(self.function_bar_frame, fg_color="transparent")
-        manage_button_frame.pack(side=tk.RIGHT, padx=(10,0), pady=5)
-        add_func_button = ctk.CTkButton(manage_button_frame, text="+ New", command=self.manage_functions_dialog, width=80)
-        add_func_button.pack(side=tk.LEFT, padx=(0,5))
-        edit_func_button = ctk.CTkButton(manage_button_frame, text="Manage", command=self.manage_functions_dialog, width=90)
-        edit_func_button.pack(side=tk.LEFT)
+        if self._function_bar_mode != "folder":
+            self._function_bar_placeholder.pack_forget()
+            self._function_manage_frame.pack(side=tk.RIGHT, padx=(10,0), pady=5)
+            self._function_scroll_frame.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5, pady=0)
+            self._function_bar_mode = "folder"
 
         functions = self.app_state.get_functions(self.current_folder)
-        page_selected = self.current_page is not None
-        ai_button_state = "normal" if page_selected and not self.ai_is_running else "disabled"
-
-        func_scroll_frame = ctk.CTkScrollableFrame(self.function_bar_frame, orientation="horizontal", height=40, fg_color="transparent", scrollbar_button_color=self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["fg_color"]), scrollbar_button_hover_color=self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["hover_color"]))
-        func_scroll_frame.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5, pady=0)
+        func_names = sorted(functions.keys())
+        if func_names != self._function_order:
+            self.command_index.replace_kind("function", [(func_name, func_name) for func_name in functions])
+            for func_name in [name for name in self._function_buttons if name not in functions]:
+                self._function_buttons.pop(func_name).destroy()
+                self._function_button_states.pop(func_name, None)
+            for func_name in func_names:
+                if func_name not in self._function_buttons:
+                    self._function_buttons[func_name] = ctk.CTkButton(
+                        self._function_scroll_frame,
+                        text=func_name,
+                        command=lambda fn=func_name: self.run_ai_function(fn),
+                    )
+            for func_name in self._function_order or []:
+                if func_name in self._function_buttons:
+                    self._function_buttons[func_name].pack_forget()
+            for func_name in func_names:
+                self._function_buttons[func_name].pack(side=tk.LEFT, padx=4, pady=5)
+            if func_names:
+                self._no_functions_label.pack_forget()
+            else:
+                self._no_functions_label.pack(side=tk.LEFT, padx=10)
+            self._function_order = func_names
 
-        if not functions:
-             no_func_label = ctk.CTkLabel(func_scroll_frame, text="No functions defined. Use 'Manage' to add.", text_color=("gray50", "gray50"))
-             no_func_label.pack(side=tk.LEFT, padx=10)
-        else:
-            for func_name in sorted(functions.keys()):
-                func_button = ctk.CTkButton(
-                    func_scroll_frame,
-                    text=func_name,
-                    command=lambda fn=func_name: self.run_ai_function(fn),
-                    state=ai_button_state
-                )
-                func_button.pack(side=tk.LEFT, padx=4, pady=5)
+        page_selected = self.current_page is not None
+        ai_button_state = "normal" if page_selected else "disabled"
+        for func_name, func_button in self._function_buttons.items():
+            if self._function_button_states.get(func_name) != ai_button_state:
+                func_button.configure(state=ai_button_state)
+                self._function_button_states[func_name] = ai_button_state
+        self.function_bar_latency.record((time.perf_counter() - started) * 1000)
 
     def open_settings(self):
         settings_dialog = ctk.CTkToplevel(self)
@@ -1215,9 +2400,11 @@ class App(ctk.CTk):
         tab_view.pack(padx=20, pady=(10, 0), fill="both", expand=True)
         tab_view.add("API Keys")
         tab_view.add("AI Model")
+        tab_view.add("Editor")
 
         self.create_api_keys_tab(tab_view.tab("API Keys"))
         self.create_ai_model_tab(tab_view.tab("AI Model"))
+        self.create_editor_tab(tab_view.tab("Editor"))
 
         close_button = ctk.CTkButton(settings_dialog, text="Close", command=settings_dialog.destroy, width=100)
         close_button.pack(pady=10)
@@ -1325,6 +2512,72 @@ class App(ctk.CTk):
         add_button.pack()
         _update_key_list()
 
+    def create_editor_tab(self, tab):
+        tab.grid_columnconfigure(0, weight=1)
+
+        continuation_frame = ctk.CTkFrame(tab)
+        continuation_frame.grid(row=0, column=0, padx=20, pady=(20, 5), sticky="ew")
+        continuation_frame.grid_columnconfigure(1, weight=1)
+
+        continuation_var = ctk.BooleanVar(value=self.app_state.get_ai_continuation_enabled())
+        continuation_cb = ctk.CTkCheckBox(
+            continuation_frame,
+            text="Suggest AI continuations when I pause typing (Tab accepts)",
+            variable=continuation_var,
+            command=lambda: self.app_state.set_ai_continuation_enabled(continuation_var.get())
+        )
+        continuation_cb.grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+
+        ctk.CTkLabel(continuation_frame, text="Idle delay (ms):").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        idle_entry = ctk.CTkEntry(continuation_frame, width=80)
+        idle_entry.insert(0, str(self.app_state.get_ai_continuation_idle_ms()))
+        idle_entry.grid(row=1, column=1, padx=5, pady=5, sticky="w")
+
+        def _save_idle_ms(event=None):
+            if not self.app_state.set_ai_continuation_idle_ms(idle_entry.get()):
+                idle_entry.delete(0, tk.END)
+                idle_entry.insert(0, str(self.app_state.get_ai_continuation_idle_ms()))
+        idle_entry.bind("<Return>", _save_idle_ms)
+        idle_entry.bind("<FocusOut>", _save_idle_ms)
+
+        stats = self.continuation_stats
+        stats_text = (f"This session: {stats['requested']} requested, {stats['shown']} shown, "
+                      f"{stats['accepted']} accepted ({self.continuation_acceptance_rate():.0%}), "
+                      f"{stats['requested'] - stats['accepted']} wasted")
+        ctk.CTkLabel(continuation_frame, text=stats_text, text_color="gray").grid(row=2, column=0, columnspan=2, padx=5, pady=(0, 5), sticky="w")
+
+        retrieval_frame = ctk.CTkFrame(tab)
+        retrieval_frame.grid(row=1, column=0, padx=20, pady=(10, 5), sticky="ew")
+        retrieval_frame.grid_columnconfigure(1, weight=1)
+
+        ctk.CTkLabel(retrieval_frame, text="AI context:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        mode_labels = {"off": "Full reference pages", "references": "Relevant chunks of references", "project": "Relevant chunks of whole project"}
+        mode_var = ctk.StringVar(value=mode_labels[self.app_state.get_retrieval_mode()])
+        ctk.CTkOptionMenu(
+            retrieval_frame, values=list(mode_labels.values()), variable=mode_var,
+            command=lambda label: self.app_state.set_retrieval_mode(next(mode for mode, text in mode_labels.items() if text == label))
+        ).grid(row=0, column=1, padx=5, pady=5, sticky="w")
+
+        ctk.CTkLabel(retrieval_frame, text="Chunks per request:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        top_k_entry = ctk.CTkEntry(retrieval_frame, width=80)
+        top_k_entry.insert(0, str(self.app_state.get_retrieval_top_k()))
+        top_k_entry.grid(row=1, column=1, padx=5, pady=5, sticky="w")
+
+        def _save_top_k(event=None):
+            if not self.app_state.set_retrieval_top_k(top_k_entry.get()):
+                top_k_entry.delete(0, tk.END)
+                top_k_entry.insert(0, str(self.app_state.get_retrieval_top_k()))
+        top_k_entry.bind("<Return>", _save_top_k)
+        top_k_entry.bind("<FocusOut>", _save_top_k)
+
+        retrieval = self.retrieval_stats
+        if retrieval["calls"]:
+            retrieval_text = (f"This session: {retrieval['calls']} requests, {retrieval['sent_chars']} of {retrieval['full_chars']} "
+                              f"context chars sent, median retrieval {self.retrieval_latency.summary().get('p50', 0):.1f} ms")
+        else:
+            retrieval_text = "Relevant chunks need the numpy and scipy packages."
+        ctk.CTkLabel(retrieval_frame, text=retrieval_text, text_color="gray").grid(row=2, column=0, columnspan=2, padx=5, pady=(0, 5), sticky="w")
+
     def on_select_api_key(self, selected_key_name):
         print(f"Selected API key: {selected_key_name}")
         if selected_key_name != "No keys defined":
@@ -1367,6 +2620,14 @@ class App(ctk.CTk):
             command=self._on_free_models_toggle
         )
         self.free_models_cb.pack(side=tk.LEFT)
+
+        prewarm_var = ctk.BooleanVar(value=self.app_state.get_prewarm_connections())
+        ctk.CTkCheckBox(
+            self.free_models_frame,
+            text="Connect to OpenRouter at startup",
+            variable=prewarm_var,
+            command=lambda: self.app_state.set_prewarm_connections(prewarm_var.get())
+        ).pack(side=tk.LEFT, padx=(20, 0))
         
         self._update_free_models_visibility(provider_var.get())
 
@@ -1393,16 +2654,43 @@ class App(ctk.CTk):
         )
         clear_search_btn.grid(row=0, column=1)
 
-        # Model list frame
+        filter_frame = ctk.CTkFrame(search_frame, fg_color="transparent")
+        filter_frame.grid(row=1, column=0, columnspan=2, sticky="ew", pady=(5, 0))
+        self.model_provider_var = ctk.StringVar(value=ALL_PROVIDERS_LABEL)
+        self.model_provider_menu = ctk.CTkOptionMenu(filter_frame, values=[ALL_PROVIDERS_LABEL], variable=self.model_provider_var, command=lambda _value: self._filter_models(), width=160)
+        self.model_provider_menu.pack(side=tk.LEFT, padx=(0, 5))
+        self.model_context_var = ctk.StringVar(value=next(iter(MODEL_CONTEXT_FILTERS)))
+        ctk.CTkOptionMenu(filter_frame, values=list(MODEL_CONTEXT_FILTERS), variable=self.model_context_var, command=lambda _value: self._filter_models(), width=120).pack(side=tk.LEFT, padx=(0, 5))
+        self.model_count_label = ctk.CTkLabel(filter_frame, text="", text_color="gray")
+        self.model_count_label.pack(side=tk.LEFT, padx=5)
+
+        # Model list frame: a fixed pool of row buttons reused as the list scrolls
         model_list_frame = ctk.CTkFrame(tab)
         model_list_frame.grid(row=3, column=0, columnspan=2, padx=20, pady=5, sticky="nsew")
         model_list_frame.grid_columnconfigure(0, weight=1)
         tab.grid_rowconfigure(3, weight=1)
 
-        # Scrollable model list
-        self.model_list = ctk.CTkScrollableFrame(model_list_frame)
+        self.model_list = ctk.CTkFrame(model_list_frame, fg_color="transparent")
         self.model_list.grid(row=0, column=0, sticky="nsew")
         self.model_list.grid_columnconfigure(0, weight=1)
+        self.model_list_scrollbar = ctk.CTkScrollbar(model_list_frame, command=self._on_model_scrollbar)
+        self.model_list_scrollbar.grid(row=0, column=1, sticky="ns")
+        self._model_rows = []
+        self._model_row_states = []
+        for row_index in range(MODEL_LIST_ROWS):
+            row_button = ctk.CTkButton(
+                self.model_list,
+                text="",
+                command=lambda i=row_index: self._select_model_row(i),
+                fg_color="transparent",
+                anchor="w"
+            )
+            self._model_rows.append(row_button)
+            self._model_row_states.append(None)
+        for widget in [self.model_list, *self._model_rows]:
+            widget.bind("<MouseWheel>", self._on_model_list_wheel)
+            widget.bind("<Button-4>", self._on_model_list_wheel)
+            widget.bind("<Button-5>", self._on_model_list_wheel)
 
         # Selected model display
         selected_frame = ctk.CTkFrame(tab)
@@ -1433,36 +2721,93 @@ class App(ctk.CTk):
             text="Refresh List", 
             image=self.icon_refresh, 
             compound="left", 
-            command=lambda: self.fetch_models(tab)
+            command=lambda: self.fetch_models(tab, force=True)
         )
         refresh_button.grid(row=0, column=1, padx=5, pady=5)
 
         self.after(100, lambda: self.fetch_models(tab))
 
     def _filter_models(self, *args):
-        """Filters the model list based on search text."""
-        search_text = self.model_search_var.get().lower()
-        
-        # Clear existing model buttons
-        for widget in self.model_list.winfo_children():
-            widget.destroy()
-
-        # Filter and display models
-        filtered_models = [
-            model for model in self.available_models 
-            if search_text in model.lower()
-        ]
+        """Re-queries the model catalog with the search text and filters and redraws the visible rows."""
+        started = time.perf_counter()
+        provider = self.model_provider_var.get()
+        self._model_results = self.model_catalog.query(
+            self.model_search_var.get(),
+            provider=None if provider == ALL_PROVIDERS_LABEL else provider,
+            free_only=self._free_models_filter_active(),
+            min_context=MODEL_CONTEXT_FILTERS.get(self.model_context_var.get(), 0),
+        )
+        self._model_list_offset = 0
+        self._render_model_rows()
+        self.model_count_label.configure(text=f"{len(self._model_results)} of {len(self.model_catalog)} models")
+        self.model_filter_latency.record((time.perf_counter() - started) * 1000)
+
+    def _free_models_filter_active(self):
+        return self.app_state.get_api_provider() == "openrouter" and self.app_state.get_show_free_models_only()
+
+    def _model_row_text(self, model):
+        details = []
+        if model["context_length"]:
+            details.append(f"{model['context_length'] // 1000}k ctx")
+        if "image" in model.get("input_modalities", ()):
+            details.append("images")
+        if model["free"]:
+            details.append("free")
+        elif model.get("pricing", {}).get("prompt"):
+            try:
+                details.append(f"${float(model['pricing']['prompt']) * 1e6:.2f}/M in")
+            except (TypeError, ValueError):
+                pass
+        return f"{model['id']}   ({', '.join(details)})" if details else model["id"]
+
+    def _render_model_rows(self):
+        """Points the pooled row buttons at the results visible at the current offset."""
+        total = len(self._model_results)
+        self._model_list_offset = max(0, min(self._model_list_offset, total - MODEL_LIST_ROWS))
+        selected_model = self.app_state.get_selected_model()
+        for row_index, row_button in enumerate(self._model_rows):
+            result_index = self._model_list_offset + row_index
+            if result_index < total:
+                model = self._model_results[result_index]
+                state = (self._model_row_text(model), model["id"] == selected_model)
+            else:
+                state = None
+            if state == self._model_row_states[row_index]:
+                continue
+            if state is None:
+                row_button.grid_remove()
+            else:
+                row_button.configure(text=state[0], fg_color=("blue" if state[1] else "transparent"))
+                row_button.grid(row=row_index, column=0, padx=5, pady=2, sticky="ew")
+            self._model_row_states[row_index] = state
+        if total > MODEL_LIST_ROWS:
+            self.model_list_scrollbar.set(self._model_list_offset / total, (self._model_list_offset + MODEL_LIST_ROWS) / total)
+        else:
+            self.model_list_scrollbar.set(0, 1)
+
+    def _scroll_model_list(self, offset):
+        if offset != self._model_list_offset:
+            self._model_list_offset = offset
+            self._render_model_rows()
+
+    def _on_model_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self._scroll_model_list(int(float(amount) * len(self._model_results)))
+        elif action == "scroll":
+            step = MODEL_LIST_ROWS if unit == "pages" else 1
+            self._scroll_model_list(self._model_list_offset + int(float(amount)) * step)
+
+    def _on_model_list_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self._scroll_model_list(self._model_list_offset - 3)
+        else:
+            self._scroll_model_list(self._model_list_offset + 3)
+        return "break"
 
-        for i, model in enumerate(filtered_models):
-            is_selected = model == self.app_state.get_selected_model()
-            btn = ctk.CTkButton(
-                self.model_list,
-                text=model,
-                command=lambda m=model: self._select_model_from_list(m),
-                fg_color=("blue" if is_selected else "transparent"),
-                anchor="w"
-            )
-            btn.grid(row=i, column=0, padx=5, pady=2, sticky="ew")
+    def _select_model_row(self, row_index):
+        result_index = self._model_list_offset + row_index
+        if result_index < len(self._model_results):
+            self._select_model_from_list(self._model_results[result_index]["id"])
 
     def _clear_model_search(self):
         """Clears the model search field."""
@@ -1472,29 +2817,7 @@ class App(ctk.CTk):
         """Handles model selection from the list."""
         self.app_state.set_selected_model(model_name)
         self.selected_model_label.configure(text=model_name)
-        self._filter_models()  # Refresh the list to update selection highlighting
-
-    def _handle_models_fetch_success(self, models_list):
-        """Updated to work with the new model list UI"""
-        self.available_models = models_list
-        current_selection = self.app_state.get_selected_model()
-        
-        if not self.available_models:
-            self.model_status_label.configure(
-                text="No compatible models found or API error.", 
-                text_color="red"
-            )
-        else:
-            if current_selection not in self.available_models:
-                current_selection = self.available_models[0]
-                self.app_state.set_selected_model(current_selection)
-            
-            self.selected_model_label.configure(text=current_selection)
-            self._filter_models()  # Populate the model list
-            self.model_status_label.configure(
-                text=f"Found {len(self.available_models)} models.", 
-                text_color="green"
-            )
+        self._render_model_rows()  # Refresh the visible rows to update selection highlighting
 
     def _on_provider_change(self, provider):
         if self.app_state.set_api_provider(provider):
@@ -1509,77 +2832,105 @@ class App(ctk.CTk):
 
     def _on_free_models_toggle(self):
         self.app_state.set_show_free_models_only(self.free_models_var.get())
-        self.fetch_models(self.model_status_label.winfo_toplevel())
+        self._apply_model_catalog()
 
-    def fetch_models(self, parent_tab):
-        """Fetches available AI models from the selected provider."""
+    def fetch_models(self, parent_tab, force=False):
+        """Shows the stored model catalog at once and refreshes it in the background when stale or forced."""
         api_key = self.app_state.get_selected_api_key_value()
         if not api_key:
             self.model_status_label.configure(text="Error: API Key missing or invalid.", text_color="red")
+            self.model_catalog.set_models([])
             self._filter_models()  # Clear the model list
             return
 
-        self.model_status_label.configure(text="Fetching models...", text_color="orange")
-        self.available_models = []  # Clear current models
-        self._filter_models()  # Update UI to show empty state
+        provider = self.app_state.get_api_provider()
+        entry = self.model_catalog_store.get(provider, api_key)
+        if entry:
+            self.model_catalog.set_models(entry["models"])
+            self._apply_model_catalog(entry)
+            if self.model_catalog_store.is_fresh(entry) and not force:
+                return
+        else:
+            self.model_status_label.configure(text="Fetching models...", text_color="orange")
+            self.available_models = []  # Clear current models
+            self.model_catalog.set_models([])
+            self._filter_models()  # Update UI to show empty state
 
-        try:
-            if parent_tab.winfo_exists():
-                parent_tab.winfo_toplevel().update_idletasks()
-        except tk.TclError: 
-            pass
+            try:
+                if parent_tab.winfo_exists():
+                    parent_tab.winfo_toplevel().update_idletasks()
+            except tk.TclError: 
+                pass
 
-        fetch_thread = threading.Thread(target=self._fetch_models_thread, args=(api_key,))
-        fetch_thread.start()
-    def _fetch_models_thread(self, api_key):
-        try:
-            provider = self.app_state.get_api_provider()
-            
-            if provider == "google":
-                # Google provider code remains unchanged
-                genai.configure(api_key=api_key)
-                listed_models = genai.list_models()
-                models_list = sorted([m.name for m in listed_models if 'generateContent' in m.supported_generation_methods])
-            else:
-                print("Fetching models from OpenRouter...")
-                response = requests.get(
-                    f"{OPENROUTER_BASE_URL}/models",
-                    headers={"Authorization": f"Bearer {api_key}"}
-                )
-                response.raise_for_status()
-                
-                print(f"OpenRouter response status: {response.status_code}")
-                
-                models_data = response.json().get('data', [])  # Get the 'data' array from response
-                models_list = []
-                show_free_only = self.app_state.get_show_free_models_only()
-                
-                for model in models_data:
-                    model_id = model.get('id')
-                    if model_id:
-                        if show_free_only:
-                            pricing = model.get('pricing', {})
-                            # Check if all pricing values are '0'
-                            if all(value == '0' for value in pricing.values()):
-                                models_list.append(model_id)
-                        else:
-                            models_list.append(model_id)
-                
-                models_list.sort()
-                print(f"Parsed {len(models_list)} models")
+        self._start_model_catalog_refresh(provider, api_key, entry)
 
-            self.after(0, self._handle_models_fetch_success, models_list)
+    def refresh_model_catalog_if_stale(self, allow_network=True):
+        """Loads the stored catalog for the current provider and key, refreshing it in the background once it is older than the TTL."""
+        api_key = self.app_state.get_selected_api_key_value()
+        if not api_key:
+            return
+        provider = self.app_state.get_api_provider()
+        entry = self.model_catalog_store.get(provider, api_key)
+        if entry:
+            self.model_catalog.set_models(entry["models"])
+            self._update_available_models()
+        if allow_network and not self.model_catalog_store.is_fresh(entry):
+            self._start_model_catalog_refresh(provider, api_key, entry)
+
+    def _start_model_catalog_refresh(self, provider, api_key, entry):
+        fetch_key = (provider, api_key)
+        if fetch_key in self._model_fetches:
+            return
+        self._model_fetches.add(fetch_key)
+        if entry and self._model_settings_open():
+            self.model_status_label.configure(text=f"{len(self.available_models)} models from {format_catalog_age(self.model_catalog_store.age_seconds(entry))}, refreshing...", text_color="orange")
+        fetch_thread = threading.Thread(target=self._fetch_models_thread, args=(self.model_catalog_store, provider, api_key, entry), daemon=True)
+        fetch_thread.start()
 
+    def _fetch_models_thread(self, store, provider, api_key, entry):
+        try:
+            entry = refresh_model_catalog(store, provider, api_key, entry)
+            self.after(0, self._handle_models_fetch_success, store, provider, api_key, entry)
         except Exception as e:
             print(f"Error in _fetch_models_thread: {type(e).__name__} - {str(e)}")
-            self.after(0, self._handle_models_fetch_error, e)
+            self.after(0, self._handle_models_fetch_error, store, provider, api_key, e)
+
+    def _is_current_model_source(self, store, provider, api_key):
+        return (store is self.model_catalog_store and provider == self.app_state.get_api_provider()
+                and api_key == self.app_state.get_selected_api_key_value())
 
-    def _handle_models_fetch_success(self, models_list):
+    def _model_settings_open(self):
+        try:
+            return self.model_status_label is not None and bool(self.model_status_label.winfo_exists())
+        except tk.TclError:
+            return False
+
+    def _handle_models_fetch_success(self, store, provider, api_key, entry):
         """Handles successful model fetch by updating the UI with the new models list."""
-        self.available_models = models_list
+        self._model_fetches.discard((provider, api_key))
+        if not self._is_current_model_source(store, provider, api_key):
+            return  # Provider, key or project changed meanwhile; the listing is still stored for later
+        self.model_catalog.set_models(entry["models"])
+        if self._model_settings_open():
+            self._apply_model_catalog(entry)
+        else:
+            self._update_available_models()
+
+    def _update_available_models(self):
+        """Derives the selectable models from the catalog and the free-only toggle, without a network call."""
+        self.available_models = self.model_catalog.ids(free_only=self._free_models_filter_active())
+        self.command_index.replace_kind("model", [(model_name, model_name) for model_name in self.available_models])
+
+    def _apply_model_catalog(self, entry=None):
+        """Updates the selectable models, then refreshes the picker."""
+        self._update_available_models()
+        self.model_provider_menu.configure(values=[ALL_PROVIDERS_LABEL, *self.model_catalog.providers])
+        if self.model_provider_var.get() not in self.model_catalog.providers:
+            self.model_provider_var.set(ALL_PROVIDERS_LABEL)
         current_selection = self.app_state.get_selected_model()
         
         if not self.available_models:
+            self._filter_models()
             self.model_status_label.configure(
                 text="No compatible models found or API error.", 
                 text_color="red"
@@ -1591,20 +2942,28 @@ class App(ctk.CTk):
             
             self.selected_model_label.configure(text=current_selection)
             self._filter_models()  # Update the model list UI
+            updated = f", updated {format_catalog_age(self.model_catalog_store.age_seconds(entry))}" if entry else ""
             self.model_status_label.configure(
-                text=f"Found {len(self.available_models)} models.", 
+                text=f"Found {len(self.available_models)} models{updated}.", 
                 text_color="green"
             )
 
-    def _handle_models_fetch_error(self, error):
-        """Handles errors that occur during model fetching."""
+    def _handle_models_fetch_error(self, store, provider, api_key, error):
+        """Handles errors that occur during model fetching, keeping a stored listing if there is one."""
+        self._model_fetches.discard((provider, api_key))
         error_type = type(error).__name__
         msg = f"Error fetching models: {error_type} - {error}"
         print(msg)
-        self.available_models = []
+        if not self._is_current_model_source(store, provider, api_key):
+            return
+        if store.get(provider, api_key):
+            msg = f"Could not refresh models ({error_type}); showing the stored list."
+        else:
+            self.available_models = []
+            self.model_catalog.set_models([])
         
         try:
-            if self.model_status_label.winfo_exists():
+            if self._model_settings_open():
                 self.model_status_label.configure(text=msg, text_color="red")
                 self._filter_models()  # Clear and update the model list
         except tk.TclError: 
@@ -1662,8 +3021,11 @@ class App(ctk.CTk):
         prompt_label.grid(row=1, column=0, columnspan=2, padx=5, pady=(5,0), sticky="w")
         self.func_prompt_text = ctk.CTkTextbox(edit_frame, wrap="word")
         self.func_prompt_text.grid(row=2, column=0, columnspan=2, padx=5, pady=5, sticky="nsew")
+        self.func_cache_var = ctk.BooleanVar(value=True)
+        ctk.CTkCheckBox(edit_frame, text="Reuse cached responses for unchanged text (turn off for creative functions)",
+                        variable=self.func_cache_var).grid(row=3, column=0, columnspan=2, padx=5, pady=(5, 0), sticky="w")
         button_frame = ctk.CTkFrame(edit_frame, fg_color="transparent")
-        button_frame.grid(row=3, column=0, columnspan=2, pady=10, sticky="sew")
+        button_frame.grid(row=4, column=0, columnspan=2, pady=10, sticky="sew")
         button_frame.grid_columnconfigure((0,1,2), weight=1)
         new_button = ctk.CTkButton(button_frame, text="Clear / New", command=lambda: self._clear_func_edit_fields(current_functions), width=100)
         new_button.grid(row=0, column=0, padx=5, pady=5)
@@ -1682,7 +3044,6 @@ class App(ctk.CTk):
             widget.destroy()
         self.selected_func_button = None
         default_fg = self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["fg_color"])
-        selected_fg = self._apply_appearance_mode(ctk.ThemeManager.theme["CTkOptionMenu"]["button_color"])
         hover_color = self._apply_appearance_mode(ctk.ThemeManager.theme["CTkButton"]["hover_color"])
         func_names = sorted(functions_dict.keys())
         if not func_names:
@@ -1711,6 +3072,7 @@ class App(ctk.CTk):
              self.func_name_entry.insert(0, selected_name)
              self.func_prompt_text.delete("1.0", tk.END)
              self.func_prompt_text.insert("1.0", functions_dict.get(selected_name, ""))
+             self.func_cache_var.set(self.app_state.is_function_cacheable(self.current_folder, selected_name))
 
     def _clear_func_edit_fields(self, functions_dict, clear_list_selection=True):
         if clear_list_selection and self.selected_func_button:
@@ -1724,6 +3086,7 @@ class App(ctk.CTk):
             if self.func_name_entry.winfo_exists(): self.func_name_entry.delete(0, tk.END)
             if self.func_prompt_text.winfo_exists(): self.func_prompt_text.delete("1.0", tk.END)
         except tk.TclError: pass
+        self.func_cache_var.set(True)
 
     def _save_edited_function(self, functions_dict):
         name = self.func_name_entry.get().strip()
@@ -1740,6 +3103,7 @@ class App(ctk.CTk):
              if not self.app_state.delete_function(self.current_folder, original_name):
                    messagebox.showerror("Save Error", f"Could not remove old function '{original_name}'.", parent=parent_dialog); return
         if self.app_state.add_or_update_function(self.current_folder, name, prompt):
+             self.app_state.set_function_cacheable(self.current_folder, name, self.func_cache_var.get())
              functions_dict[name] = prompt
              if original_name and original_name != name: del functions_dict[original_name]
              self._populate_func_listbox(functions_dict)
@@ -1763,8 +3127,10 @@ class App(ctk.CTk):
         if not api_key:
             print("GenAI configuration skipped: No API key selected or value is empty.")
             return False
+        if self.app_state.get_api_provider() != "google":
+            return True
         try:
-            genai.configure(api_key=api_key)
+            load_genai().configure(api_key=api_key)
             return True
         except Exception as e:
              print(f"Error configuring GenAI: {e}")
@@ -1774,9 +3140,7 @@ class App(ctk.CTk):
         if not self.current_folder or not self.current_page:
             messagebox.showwarning("Run Function", "Please select a page first.", parent=self)
             return
-        if self.ai_is_running:
-             messagebox.showwarning("Busy", "AI is currently processing. Please wait.", parent=self)
-             return
+        self._cancel_continuation()
         if not self.configure_genai():
             messagebox.showerror("API Key Error", "Google AI API Key is not configured or invalid. Check Settings.", parent=self)
             return
@@ -1813,152 +3177,517 @@ class App(ctk.CTk):
              messagebox.showerror("Model Error", f"Invalid AI model ('{model_name}'). Select a valid model in Settings.", parent=self)
              return
 
-        self.ai_is_running = True
-        self.update_function_bar()
+        details = {"selection": None, "version": None}
+        if run_on_selection:
+            details["selection"] = (len(self.workspace.get("1.0", tk.SEL_FIRST)), len(self.workspace.get("1.0", tk.SEL_LAST)))
+        if not self.save_current_page_content():
+            return
+        details["version"] = self.app_state.get_page_version(self.current_folder, self.current_page)
+
+        runner = self._make_ai_runner(self.current_folder, func_name, system_prompt, model_name, user_content)
+        job = self.ai_scheduler.submit(self.current_folder, self.current_page, func_name, runner, AI_JOB_INTERACTIVE, details)
         status_suffix = " (selection)" if run_on_selection else ""
-        self.status_bar.configure(text=f"⏳ Running '{func_name}'{status_suffix}...")
-        self.workspace.configure(state="disabled")
-        self.toggle_format_toolbar(False)
-        self.update_idletasks()
+        self.status_bar.configure(text=f"⏳ Queued '{func_name}'{status_suffix} as job #{job.id}...")
+
+    def _record_retrieval_stats(self, stats):
+        """Adds the statistics of one context retrieval to the totals; runs on the UI thread."""
+        self.retrieval_latency.record(stats["ms"])
+        self.retrieval_stats["calls"] += 1
+        self.retrieval_stats["fallbacks"] += int(stats["fallback"])
+        self.retrieval_stats["full_chars"] += stats["full_chars"]
+        self.retrieval_stats["sent_chars"] += stats["sent_chars"]
+        if not stats["fallback"]:
+            print(f"Context retrieval ({stats['mode']}): {stats['chunks']} chunks, {stats['sent_chars']} chars instead of {stats['full_chars']} "
+                  f"({1 - stats['sent_chars'] / max(stats['full_chars'], 1):.0%} smaller) in {stats['ms']:.1f} ms")
+
+    def _make_ai_runner(self, folder_name, func_name, system_prompt, model_name, user_content):
+        """Returns the job runner that streams a function's response, through the response cache unless the function opted out."""
+        provider = self.app_state.get_api_provider()
+        api_key = self.app_state.get_selected_api_key_value()
+        response_cache = self.response_cache if self.app_state.is_function_cacheable(folder_name, func_name) else None
+        app_state = self.app_state
+        chunk_retriever = self.chunk_retriever
+
+        def runner(job):
+            # Runs on a scheduler thread: the retrieval statistics are handed to the UI thread
+            context_content, stats = build_context_content(app_state, chunk_retriever, user_content)
+            if stats["mode"] != "off":
+                try:
+                    self.after(0, self._record_retrieval_stats, stats)
+                except RuntimeError:
+                    pass  # the main loop has already exited
+            combined_content = f"{context_content}{user_content}"
 
-        thread = threading.Thread(target=self._ai_call_thread, args=(model_name, system_prompt, user_content, func_name, run_on_selection))
-        thread.start()
+            def produce():
+                return stream_ai_response(provider, api_key, model_name, system_prompt, combined_content, job.cancel_event, job.usage)
 
-    def _ai_call_thread(self, model_name, system_prompt, user_content, func_name, run_on_selection):
+            if response_cache is None:
+                pieces = produce()
+            else:
+                cache_key = ResponseCache.make_key(provider, model_name, system_prompt, combined_content)
+                pieces = response_cache.stream(cache_key, produce, job.cancel_event, job.details)
+            for text in pieces:
+                job.emit(text)
+        return runner
+
+    def clear_response_cache(self):
+        if messagebox.askyesno("Clear AI Response Cache", "Forget every cached AI response of this project?", parent=self):
+            self.response_cache.clear()
+            self.status_bar.configure(text="AI response cache cleared.")
+
+    # --- AI Jobs ---
+    def _on_ai_job_event(self, job):
+        """AIJobScheduler listener; hands the job over to the UI thread."""
         try:
-            references = self.app_state.get_references()
-            reference_content = ""
-            if references:
-                reference_content = "--- Reference Content (For Context) ---\n"
-                for ref_key, ref_data in references.items():
-                    ref_text = self._get_plain_text_content(ref_data['folder'], ref_data['page'])
-                    reference_content += f"\n[{ref_data['page']}]:\n{ref_text}\n"
-                reference_content += "\n--- End References ---\n\n"
-
-            combined_content = f"{reference_content}{user_content}"
-            provider = self.app_state.get_api_provider()
-            api_key = self.app_state.get_selected_api_key_value()
-
-            if provider == "google":
-                is_gemma = "gemma" in model_name.lower()
-                if is_gemma:
-                    model = genai.GenerativeModel(model_name=model_name)
-                    prompt_content = f"{"No formatting"+system_prompt}\n\n{combined_content}"
-                    response = model.generate_content(prompt_content)
-                else:
-                    model = genai.GenerativeModel(
-                        model_name=model_name,
-                        system_instruction="No formatting"+system_prompt
-                    )
-                    response = model.generate_content(combined_content)
+            self.after(0, self._handle_ai_job_event, job)
+        except RuntimeError:
+            pass  # the main loop has already exited
+
+    def _handle_ai_job_event(self, job):
+        batch = job.details.get("batch")
+        if batch is not None:
+            if not job.active:
+                batch.job_finished(job)
+                self._on_batch_progress(batch)
+        elif job.status == "running":
+            if self._live_job is None and not job.applied and self._ai_job_is_visible(job):
+                self._attach_live_job(job)
+            self._schedule_ai_tick()
+        elif not job.active:
+            self._finish_ai_job(job)
+        self._sync_workspace_for_jobs()
+        self._refresh_jobs_panel()
+
+    def _ai_job_is_visible(self, job):
+        return job.page_key == (self.current_folder, self.current_page)
+
+    def _page_has_ai_jobs(self, folder_name, page_name):
+        """True while a job for the page is queued or running and has not been cancelled."""
+        return any(not job.cancel_event.is_set() for job in self.ai_scheduler.page_jobs(folder_name, page_name))
+
+    def _schedule_ai_tick(self):
+        if self._ai_tick_id is None:
+            self._ai_tick_id = self.after(STREAM_FLUSH_INTERVAL_MS, self._ai_tick)
+
+    def _ai_tick(self):
+        """Inserts the text the visible job received since the last frame, at most once per STREAM_FLUSH_INTERVAL_MS.
+
+        Jobs for other pages keep their text buffered until they finish or their page is opened.
+        """
+        self._ai_tick_id = None
+        if self._live_job is not None:
+            self._insert_live_text(self._live_job)
+        if self.ai_scheduler.counts()["running"]:
+            self._schedule_ai_tick()
+
+    def _attach_live_job(self, job):
+        """Makes the job on the open page stream into the workspace, continuing where it left off."""
+        self._live_job = job
+        if job.began:
+            self.workspace.mark_set("ai_stream", f"1.0+{job.insert_offset}c")
+            self.workspace.mark_gravity("ai_stream", tk.RIGHT)
+            self._begin_batched_edit("ai_stream")
+
+    def _detach_live_job(self):
+        """Saves what the visible job has inserted so far before its page is closed; the rest goes through AppState."""
+        job = self._live_job
+        if job is None:
+            return
+        self._insert_live_text(job)
+        self._live_job = None
+        if job.began:
+            self.workspace.configure(state="normal")
+            job.insert_offset = len(self.workspace.get("1.0", "ai_stream"))
+            self._end_batched_edit()
+            self.workspace.mark_unset("ai_stream")
+
+    def _abandon_live_job(self):
+        """Drops the visible job's insertion state when its page is being deleted."""
+        job = self._live_job
+        if job is None:
+            return
+        self._live_job = None
+        job.applied = True
+        if job.began:
+            self._batch_depth -= 1
+            self.workspace.mark_unset("ai_stream", "batch_start", "batch_end")
+
+    def _apply_stored_job_text(self, job):
+        """Writes the buffered text of a job whose page is not open into AppState."""
+        text = job.take_text()
+        if not text:
+            return
+        if not apply_ai_job_text(self.app_state, job, text):
+            print(f"AI job #{job.id}: page {job.folder_name} / {job.page_name} no longer exists, result discarded.")
 
+    def _insert_live_text(self, job):
+        text = job.take_text()
+        if not text or job.applied:
+            return
+        self.workspace.configure(state="normal")
+        if not job.began:
+            self._begin_live_insert(job)
+        self.workspace.insert("ai_stream", text)
+        self.workspace.configure(state="disabled")
+        self.workspace.see("ai_stream")
+        self.status_bar.configure(text=f"⏳ Streaming '{job.func_name}'... {job.chars} chars")
+
+    def _begin_live_insert(self, job):
+        """Prepares the insertion point on the first received text, so failed calls leave the page untouched."""
+        job.began = True
+        selection = job.details.get("selection")
+        if selection and self.app_state.get_page_version(job.folder_name, job.page_name) == job.details.get("version"):
+            self._begin_batched_edit(f"1.0+{selection[0]}c")
+            self.workspace.delete(f"1.0+{selection[0]}c", f"1.0+{selection[1]}c")
+            self.workspace.mark_set("ai_stream", f"1.0+{selection[0]}c")
+        else:
+            job.details["selection"] = None
+            self._begin_batched_edit("end-1c")
+            current_content = self.workspace.get("1.0", "end-1c").strip()
+            prefix = "\n\n" if current_content else ""
+            self.workspace.insert(tk.END, f"{prefix}--- AI Result ({job.func_name}) ---", ("ai_separator",))
+            self.workspace.insert(tk.END, "\n")
+            self.workspace.mark_set("ai_stream", "end-1c")
+        self.workspace.mark_gravity("ai_stream", tk.RIGHT)
+
+    def stop_ai_function(self):
+        """Cancels the jobs of the open page, keeping the text received so far."""
+        if not self.current_page:
+            return
+        for job in self.ai_scheduler.page_jobs(self.current_folder, self.current_page):
+            self.cancel_ai_job(job)
+
+    def cancel_ai_job(self, job):
+        """Cancels a queued or running job; a streaming job on the open page is finalized at once."""
+        if not self.ai_scheduler.cancel(job.id):
+            return
+        if job is self._live_job:
+            self._finish_ai_job(job)
+        self._sync_workspace_for_jobs()
+        self._refresh_jobs_panel()
+
+    def _finish_ai_job(self, job):
+        """Applies the rest of a finished or cancelled job's text and reports the outcome."""
+        if job.applied:
+            return
+        if self._live_job is None and self._ai_job_is_visible(job) and job.deltas:
+            self._attach_live_job(job)
+        if job is self._live_job:
+            self._insert_live_text(job)
+            self._live_job = None
+            if job.began:
+                self.workspace.configure(state="normal")
+                self._end_batched_edit()
+                self.workspace.mark_unset("ai_stream")
+                self.workspace.see(tk.END if not job.details.get("selection") else tk.INSERT)
+        else:
+            self._apply_stored_job_text(job)
+        job.applied = True
+
+        func_name = job.func_name
+        where = "" if self._ai_job_is_visible(job) else f" on {job.folder_name} / {job.page_name}"
+        stopped = job.cancel_event.is_set()
+        error = job.error
+        if error is None and not job.began and not stopped:
+            error = ValueError("Empty response from AI")
+        if error is not None and not stopped:
+            if job.priority == AI_JOB_INTERACTIVE:
+                self._handle_ai_error(error, func_name)
+            if job.began:
+                self.status_bar.configure(text=f"❌ '{func_name}'{where} failed mid-stream ({type(error).__name__}); partial result kept.")
             else:
-                response = requests.post(
-                    url=f"{OPENROUTER_BASE_URL}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "HTTP-Referer": "localhost",
-                        "X-Title": APP_NAME
-                    },
-                    json={
-                        "model": model_name,
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "No formatting" + system_prompt
-                            },
-                            {
-                                "role": "user",
-                                "content": combined_content
-                            }
-                        ]
-                    }
-                )
-                response.raise_for_status()
-                response = response.json()
+                self.status_bar.configure(text=f"❌ '{func_name}'{where} failed ({type(error).__name__}).")
+        elif stopped:
+            self.status_bar.configure(text=f"⏹ '{func_name}'{where} stopped; {job.chars} chars kept.")
+        else:
+            source = {"hit": " (cache hit)", "shared": " (shared with an identical request)"}.get(job.details.get("cache"), "")
+            action = "replaced selection" if job.details.get("selection") else "appended result"
+            self.status_bar.configure(text=f"✅ '{func_name}' {action}{where}{source}.")
+        self._record_job_stats(job)
 
-            self.after(0, self._handle_ai_response, response, func_name, run_on_selection, provider)
+    def _record_job_stats(self, job):
+        if job.first_token_at is None or job.details.get("cache") == "hit":
+            return
+        ttft_ms = (job.first_token_at - job.started_at) * 1000
+        tokens = job.usage.get("completion_tokens")
+        estimated = not tokens
+        if estimated:
+            tokens = job.chars / STREAM_CHARS_PER_TOKEN
+        generation_seconds = max((job.finished_at or time.perf_counter()) - job.first_token_at, 1e-6)
+        tokens_per_second = tokens / generation_seconds
+        self.ai_ttft_latency.record(ttft_ms)
+        self.ai_stream_history.append({"function": job.func_name, "ttft_ms": ttft_ms, "tokens": tokens, "tokens_per_second": tokens_per_second, "estimated": estimated})
+        print(f"AI job #{job.id} '{job.func_name}': TTFT {ttft_ms:.0f} ms, {'~' if estimated else ''}{tokens:.0f} tokens "
+              f"at {tokens_per_second:.1f} tokens/s")
 
-        except Exception as e:
-            self.after(0, self._handle_ai_error, e, func_name)
-        finally:
-            self.after(0, self._ai_call_finished)
+    def _handle_ai_error(self, error, func_name):
+        title, msg = describe_ai_error(error, func_name)
+        messagebox.showerror(title, msg, parent=self)
 
-    def _handle_ai_response(self, response, func_name, run_on_selection, provider):
+    def _sync_workspace_for_jobs(self):
+        """Locks the open page while jobs for it are queued or running, and updates the job indicators."""
+        busy = self.current_page is not None and self._page_has_ai_jobs(self.current_folder, self.current_page)
+        if busy:
+            self.stop_ai_button.grid()
+        else:
+            self.stop_ai_button.grid_remove()
         try:
-            ai_text = ""
-            
-            if provider == "google":
-                if hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts'):
-                    ai_text = "".join([part.text for part in response.candidates[0].content.parts if hasattr(part, 'text')])
-            else:
-                choices = response.get('choices', [])
-                if choices:
-                    ai_text = choices[0].get('message', {}).get('content', '').strip()
-                else:
-                    raise ValueError("No response choices from OpenRouter")
+            if self.current_page is not None and self.workspace.winfo_exists():
+                self.workspace.configure(state="disabled" if busy else "normal")
+        except tk.TclError: pass
+        self.toggle_format_toolbar(self.current_page is not None and not busy)
 
-            if not ai_text.strip():
-                raise ValueError("Empty response from AI")
+        counts = self.ai_scheduler.counts()
+        if counts["running"] or counts["queued"]:
+            self.jobs_button.configure(text=f"AI jobs: {counts['running']} running, {counts['queued']} queued")
+            self.jobs_button.grid()
+        else:
+            self.jobs_button.grid_remove()
+
+    def open_jobs_panel(self):
+        """Shows queued, running and recently finished AI jobs, with cancel buttons for the active ones."""
+        if self._jobs_dialog is None or not self._jobs_dialog.winfo_exists():
+            dialog = ctk.CTkToplevel(self)
+            dialog.title("AI Jobs")
+            dialog.geometry("720x420")
+            dialog.transient(self)
+            dialog.grid_columnconfigure(0, weight=1)
+            dialog.grid_rowconfigure(1, weight=1)
+            self._jobs_status = ctk.CTkLabel(dialog, text="", anchor="w", text_color="gray", font=ctk.CTkFont(size=12))
+            self._jobs_status.grid(row=0, column=0, padx=10, pady=(10, 5), sticky="ew")
+            self._jobs_frame = ctk.CTkScrollableFrame(dialog)
+            self._jobs_frame.grid(row=1, column=0, padx=10, pady=(5, 10), sticky="nsew")
+            self._job_rows = {}
+            self._job_order = []
+            self._jobs_dialog = dialog
+            self._poll_jobs_panel()
+        else:
+            self._jobs_dialog.deiconify()
+            self._jobs_dialog.lift()
+        self._refresh_jobs_panel()
 
-            self.workspace.configure(state="normal")
+    def _poll_jobs_panel(self):
+        if self._jobs_dialog is None or not self._jobs_dialog.winfo_exists():
+            return
+        if self.ai_scheduler.counts()["running"]:
+            self._refresh_jobs_panel()
+        self._jobs_dialog.after(1000, self._poll_jobs_panel)
 
-            if run_on_selection:
-                try:
-                    sel_start = self.workspace.index(tk.SEL_FIRST)
-                    sel_end = self.workspace.index(tk.SEL_LAST)
-                    self.workspace.delete(sel_start, sel_end)
-                    self.workspace.insert(sel_start, ai_text)
-                    self.status_bar.configure(text=f"✅ '{func_name}' replaced selection.")
-                except tk.TclError:
-                    run_on_selection = False
-                    print("Warning: Selection lost before AI replace, appending instead.")
-                    self.status_bar.configure(text=f"'{func_name}' completed (selection lost).")
-
-            if not run_on_selection:
-                separator_tag = "ai_separator"
-                current_content = self.workspace.get("1.0", "end-1c").strip()
-                prefix = "\n\n" if current_content else ""
-                separator = f"{prefix}--- AI Result ({func_name}) ---"
-                self.workspace.insert(tk.END, separator, (separator_tag,))
-                self.workspace.insert(tk.END, f"\n{ai_text}")
-                self.status_bar.configure(text=f"✅ '{func_name}' appended result.")
-
-            self.workspace.see(tk.END)
-            self.workspace.edit_modified(True)
-            self.save_current_page_content()
+    def _refresh_jobs_panel(self):
+        if self._jobs_dialog is None or not self._jobs_dialog.winfo_exists():
+            return
+        jobs = self.ai_scheduler.jobs()
+        job_ids = {job.id for job in jobs}
+        for job_id in [job_id for job_id in self._job_rows if job_id not in job_ids]:
+            self._job_rows.pop(job_id)["frame"].destroy()
+
+        for job in jobs:
+            row = self._job_rows.get(job.id)
+            if row is None:
+                frame = ctk.CTkFrame(self._jobs_frame, fg_color="transparent")
+                label = ctk.CTkLabel(frame, text="", anchor="w", font=ctk.CTkFont(family="Courier", size=12))
+                label.pack(side="left", fill="x", expand=True)
+                cancel_button = ctk.CTkButton(frame, text="Cancel", width=70, height=22, command=lambda j=job: self.cancel_ai_job(j))
+                cancel_button.pack(side="right", padx=(5, 0))
+                row = self._job_rows[job.id] = {"frame": frame, "label": label, "cancel": cancel_button}
+            if job.status == "queued":
+                timing = f"waiting {(time.perf_counter() - job.submitted_at):.0f}s"
+            else:
+                timing = f"{job.elapsed_ms() / 1000:.1f}s, {job.chars} chars"
+            outcome = f" ({type(job.error).__name__})" if job.error is not None else ""
+            row["label"].configure(text=f"#{job.id:<4} {job.status + outcome:<22} {job.func_name[:20]:<21} "
+                                        f"{job.folder_name} / {job.page_name}  [{AI_JOB_PRIORITY_LABELS.get(job.priority, job.priority)}]  {timing}")
+            if job.active and not job.cancel_event.is_set():
+                row["cancel"].pack(side="right", padx=(5, 0))
+            else:
+                row["cancel"].pack_forget()
+        order = [job.id for job in jobs]
+        if order != self._job_order:
+            for job_id in order:
+                frame = self._job_rows[job_id]["frame"]
+                frame.pack_forget()
+                frame.pack(fill="x", pady=1)
+            self._job_order = order
+
+        counts = self.ai_scheduler.counts()
+        self._jobs_status.configure(text=f"{counts['running']} running (max {self.ai_scheduler.max_workers}), {counts['queued']} queued. "
+                                         f"Queue wait: {self.ai_scheduler.wait_latency.format_summary()}")
+
+    # --- Batch Runs ---
+    def open_batch_dialog(self):
+        """Opens the dialog for running one function over selected or all pages of the current folder."""
+        if not self.current_folder:
+            messagebox.showwarning("Batch Run", "Please select a folder first.", parent=self)
+            return
+        if self._batch_dialog is not None and self._batch_dialog.winfo_exists():
+            self._batch_dialog.deiconify()
+            self._batch_dialog.lift()
+            return
+        functions = self.app_state.get_functions(self.current_folder)
+        if not functions:
+            messagebox.showinfo("Batch Run", "This folder has no functions. Use 'Manage' to add one.", parent=self)
+            return
 
-        except Exception as e:
-            print(f"Error processing AI response: {e}")
-            response_details = ""
-            try:
-                 response_details = f"\nResponse: {response}"
-                 if hasattr(response, 'prompt_feedback'): response_details += f"\nPrompt Feedback: {response.prompt_feedback}"
-                 if hasattr(response, 'candidates'): response_details += f"\nCandidates: {response.candidates}"
-            except Exception: pass
-            messagebox.showerror("AI Response Error", f"Error processing AI response: {e}" + response_details, parent=self)
-            self.status_bar.configure(text=f"'{func_name}' failed (processing error).")
+        folder_name = self.current_folder
+        dialog = ctk.CTkToplevel(self)
+        dialog.title(f"Batch Run in '{folder_name}'")
+        dialog.geometry("560x600")
+        dialog.transient(self)
+        dialog.grid_columnconfigure(1, weight=1)
+        dialog.grid_rowconfigure(4, weight=1)
+
+        ctk.CTkLabel(dialog, text="Function:").grid(row=0, column=0, padx=(10, 5), pady=(10, 5), sticky="w")
+        self._batch_func_var = ctk.StringVar(value=sorted(functions)[0])
+        ctk.CTkOptionMenu(dialog, values=sorted(functions), variable=self._batch_func_var).grid(row=0, column=1, padx=(0, 10), pady=(10, 5), sticky="ew")
+        ctk.CTkLabel(dialog, text="Result:").grid(row=1, column=0, padx=(10, 5), pady=5, sticky="w")
+        self._batch_mode_var = ctk.StringVar(value=next(iter(BATCH_RESULT_MODE_LABELS)))
+        ctk.CTkOptionMenu(dialog, values=list(BATCH_RESULT_MODE_LABELS), variable=self._batch_mode_var).grid(row=1, column=1, padx=(0, 10), pady=5, sticky="ew")
+        ctk.CTkLabel(dialog, text="Parallel requests:").grid(row=2, column=0, padx=(10, 5), pady=5, sticky="w")
+        self._batch_parallelism_var = ctk.StringVar(value=DEFAULT_BATCH_PARALLELISM)
+        ctk.CTkOptionMenu(dialog, values=BATCH_PARALLELISM_CHOICES, variable=self._batch_parallelism_var, width=80).grid(row=2, column=1, padx=(0, 10), pady=5, sticky="w")
+
+        pages_header = ctk.CTkFrame(dialog, fg_color="transparent")
+        pages_header.grid(row=3, column=0, columnspan=2, padx=10, pady=(10, 0), sticky="ew")
+        ctk.CTkLabel(pages_header, text="Pages:", font=ctk.CTkFont(weight="bold")).pack(side="left")
+        ctk.CTkButton(pages_header, text="None", width=60, command=lambda: self._set_batch_pages(False)).pack(side="right")
+        ctk.CTkButton(pages_header, text="All", width=60, command=lambda: self._set_batch_pages(True)).pack(side="right", padx=5)
+        pages_frame = ctk.CTkScrollableFrame(dialog)
+        pages_frame.grid(row=4, column=0, columnspan=2, padx=10, pady=5, sticky="nsew")
+        self._batch_page_vars = {}
+        for page_name in sorted(self.app_state.get_pages(folder_name)):
+            page_var = ctk.BooleanVar(value=True)
+            ctk.CTkCheckBox(pages_frame, text=page_name, variable=page_var).pack(anchor="w", padx=5, pady=2)
+            self._batch_page_vars[page_name] = page_var
+
+        buttons_frame = ctk.CTkFrame(dialog, fg_color="transparent")
+        buttons_frame.grid(row=5, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
+        self._batch_start_button = ctk.CTkButton(buttons_frame, text="Start", width=90, command=self._start_batch)
+        self._batch_start_button.pack(side="left", padx=(0, 5))
+        self._batch_cancel_button = ctk.CTkButton(buttons_frame, text="Cancel", width=90, state="disabled", command=self._cancel_batch)
+        self._batch_cancel_button.pack(side="left", padx=5)
+        self._batch_retry_button = ctk.CTkButton(buttons_frame, text="Retry Failed", width=100, state="disabled", command=self._retry_failed_batch_pages)
+        self._batch_retry_button.pack(side="left", padx=5)
+        self._batch_progress = ctk.CTkProgressBar(buttons_frame)
+        self._batch_progress.pack(side="left", fill="x", expand=True, padx=(10, 0))
+        self._batch_progress.set(0)
+
+        self._batch_status = ctk.CTkLabel(dialog, text=f"{len(self._batch_page_vars)} pages in '{folder_name}'.", anchor="w", justify="left",
+                                          wraplength=520, text_color="gray", font=ctk.CTkFont(size=12))
+        self._batch_status.grid(row=6, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="ew")
+        self._batch_dialog_folder = folder_name
+        self._batch_dialog = dialog
+        if self._batch is not None and not self._batch.committed:
+            self._on_batch_progress(self._batch)
+
+    def _set_batch_pages(self, selected):
+        for page_var in self._batch_page_vars.values():
+            page_var.set(selected)
+
+    def _batch_dialog_open(self):
+        return self._batch_dialog is not None and self._batch_dialog.winfo_exists()
+
+    def _start_batch(self, page_names=None):
+        if self._batch is not None and not self._batch.committed:
+            return
+        folder_name = self._batch_dialog_folder
+        func_name = self._batch_func_var.get()
+        system_prompt = self.app_state.get_functions(folder_name).get(func_name)
+        if not system_prompt:
+            self._batch_status.configure(text=f"Function '{func_name}' no longer exists.")
+            return
+        if page_names is None:
+            page_names = [page_name for page_name, page_var in self._batch_page_vars.items() if page_var.get()]
+        if not page_names:
+            self._batch_status.configure(text="Select at least one page.")
+            return
+        if not self.configure_genai():
+            messagebox.showerror("API Key Error", "The API Key is not configured or invalid. Check Settings.", parent=self._batch_dialog)
+            return
+        model_name = self.app_state.get_selected_model()
+        if not model_name or model_name in INVALID_MODEL_NAMES:
+            messagebox.showerror("Model Error", f"Invalid AI model ('{model_name}'). Select a valid model in Settings.", parent=self._batch_dialog)
+            return
+        if not self.save_current_page_content():
+            self._batch_status.configure(text="Could not save the current page; aborting.")
+            return
 
-    def _handle_ai_error(self, error, func_name):
-        error_type = type(error).__name__
-        msg = f"Error running '{func_name}':\n\n[{error_type}]\n{error}"
-        title = "AI Execution Error"
-        error_str = str(error)
-        if "Permission denied" in error_str: msg = f"AI Error: Permission Denied.\nCheck API key validity/permissions.\nDetails: {error_str}"; title = "API Permission Error"
-        elif "Invalid Argument" in error_str or "model" in error_str.lower() or "prompt" in error_str.lower(): msg = f"AI Error: Invalid Argument.\nCheck model/prompt/content.\nDetails: {error_str}"; title = "AI Argument Error"
-        elif "ResourceExhausted" in error_str or "quota" in error_str.lower(): msg = f"AI Error: Quota Exceeded.\nDetails: {error_str}"; title = "API Quota Error"
-        elif "network" in error_str.lower() or "connection" in error_str.lower() or "ssl" in error_str.lower(): msg = f"AI Error: Network/Connection Issue.\nCheck internet/firewall.\nDetails: {error_str}"; title = "Network Error"
-        messagebox.showerror(title, msg, parent=self)
-        self.status_bar.configure(text=f"❌ '{func_name}' failed ({error_type}).")
+        def make_runner(page_text):
+            return self._make_ai_runner(folder_name, func_name, system_prompt, model_name, page_text)
+
+        parallelism = int(self._batch_parallelism_var.get())
+        # Keep one slot free so interactive runs are not stuck behind the batch.
+        self.ai_scheduler.set_max_workers(max(AI_MAX_CONCURRENT_JOBS, parallelism + 1))
+        batch = BatchRun(self.ai_scheduler, self.app_state, folder_name, page_names, func_name, make_runner,
+                         BATCH_RESULT_MODE_LABELS[self._batch_mode_var.get()], parallelism)
+        self._batch = batch
+        self._batch_start_button.configure(state="disabled")
+        self._batch_retry_button.configure(state="disabled")
+        self._batch_cancel_button.configure(state="normal")
+        self._batch_progress.set(0)
+        print(f"Batch '{func_name}' started on {len(page_names)} pages of '{folder_name}' ({parallelism} parallel, {batch.mode})")
+        batch.start()
+        self._on_batch_progress(batch)
+        self.after(BATCH_PROGRESS_INTERVAL_MS, self._poll_batch, batch)
+
+    def _poll_batch(self, batch):
+        """Refreshes the throughput and ETA between job completions."""
+        if batch is not self._batch or batch.done:
+            return
+        self._on_batch_progress(batch)
+        self.after(BATCH_PROGRESS_INTERVAL_MS, self._poll_batch, batch)
 
-    def _ai_call_finished(self):
-        self.ai_is_running = False
-        try:
-            if self.workspace.winfo_exists():
-                self.workspace.configure(state="normal")
-        except tk.TclError: pass
-        self.toggle_format_toolbar(self.current_page is not None)
-        self.update_function_bar()
+    def _on_batch_progress(self, batch):
+        if batch is not self._batch:
+            return
+        if batch.done and not batch.committed:
+            self._finish_batch(batch)
+            return
+        progress_text = batch.format_progress()
+        self.status_bar.configure(text=f"⏳ Batch '{batch.func_name}': {progress_text}")
+        if self._batch_dialog_open():
+            self._batch_progress.set(batch.progress()["finished"] / max(batch.total, 1))
+            self._batch_status.configure(text=progress_text)
+
+    def _cancel_batch(self):
+        batch = self._batch
+        if batch is None or batch.done:
+            return
+        batch.cancel()
+        if self._batch_dialog_open():
+            self._batch_cancel_button.configure(state="disabled")
+            self._batch_status.configure(text="Cancelling; finished pages will still be saved...")
+        self._on_batch_progress(batch)
+
+    def _retry_failed_batch_pages(self):
+        if self._batch is not None and self._batch.failed_pages():
+            self._start_batch(self._batch.failed_pages())
+
+    def _finish_batch(self, batch):
+        """Writes every result of the batch with one save and reports the throughput."""
+        self.ai_scheduler.set_max_workers(AI_MAX_CONCURRENT_JOBS)
+        had_live_job = self._live_job is not None
+        self._detach_live_job()
+        if self.current_folder and self.current_page:
+            self.save_current_page_content()
+        changed = batch.commit()
+        if any(folder_name == batch.folder_name for folder_name, _ in changed):
+            self.update_sidebar()
+        if self.current_page and (had_live_job or (self.current_folder, self.current_page) in changed):
+            self._last_saved_content_dump = None
+            self.select_page(self.current_folder, self.current_page)
+
+        progress_text = batch.format_progress()
+        summary = f"Batch '{batch.func_name}' {'cancelled' if batch.cancelled else 'finished'}: {len(changed)} pages written. {progress_text}"
+        print(summary)
+        self.status_bar.configure(text=f"{'⏹' if batch.cancelled else '✅'} {summary}")
+        if self._batch_dialog_open():
+            failed = batch.failed_pages()
+            details = "".join(f"\n  {page_name}: {type(batch.failures[page_name]).__name__}: {batch.failures[page_name]}" for page_name in failed[:10])
+            self._batch_status.configure(text=summary + details)
+            self._batch_progress.set(1)
+            self._batch_start_button.configure(state="normal")
+            self._batch_cancel_button.configure(state="disabled")
+            self._batch_retry_button.configure(state="normal" if failed else "disabled")
 
     def _apply_appearance_mode(self, ctk_color_tuple):
          if not isinstance(ctk_color_tuple, (tuple, list)) or len(ctk_color_tuple) != 2:
@@ -1992,8 +3721,28 @@ class App(ctk.CTk):
             except Exception as e:
                 messagebox.showerror("Save Project As Error", f"Could not copy project file:\n{e}", parent=self)
 
+    def _stop_project_ai_work(self):
+        """Cancels every AI job and the batch of the current project, writing what they produced so far into it."""
+        self._detach_live_job()
+        for job in self.ai_scheduler.active_jobs():
+            self.ai_scheduler.cancel(job.id)
+            if "batch" not in job.details and not job.applied:
+                self._apply_stored_job_text(job)
+                job.applied = True  # Text arriving after this belongs to a project that is no longer open
+        if self._batch is not None and not self._batch.committed:
+            self._batch.cancel()
+            self._batch.commit()
+        self.ai_scheduler.set_max_workers(AI_MAX_CONCURRENT_JOBS)
+
     def load_project(self):
         """Loads a project from a chosen file."""
+        active_jobs = len(self.ai_scheduler.active_jobs())
+        if active_jobs and not messagebox.askyesno(
+            "Load Project",
+            f"{active_jobs} AI job(s) are still queued or running.\nStop them, keep their partial results and load another project?",
+            parent=self
+        ):
+            return
         if self.current_page and self.workspace.edit_modified():
             response = messagebox.askyesnocancel(
                 "Unsaved Changes",
@@ -2019,7 +3768,14 @@ class App(ctk.CTk):
             
             new_app_state = AppState(chosen_path)
             if new_app_state.load_data():
+                self._stop_project_ai_work()
+                if self._batch_dialog_open():
+                    self._batch_dialog.destroy()
+                self._batch = None
+                self._save_content_indexes()
                 self.app_state = new_app_state
+                self.prefetcher.reset(new_app_state)
+                self._attach_content_indexes()
                 
                 self.current_folder = None
                 self.current_page = None
@@ -2075,6 +3831,7 @@ class App(ctk.CTk):
     def on_closing(self):
         """Handles application close, prompting for unsaved changes."""
         print("Closing application...")
+        self._cancel_continuation()
 
         unsaved_changes = False
         if self.current_page and self.workspace.edit_modified():
@@ -2095,14 +3852,151 @@ class App(ctk.CTk):
                 print("Closing cancelled by user.")
                 return
 
+        self._stop_project_ai_work()
+        self.ai_scheduler.shutdown()
+
         print("Saving final app state...")
         self.app_state.save_data()
+        self._save_content_indexes()
+        self.report_performance()
+        self.response_cache.close()
 
         print("Destroying main window.")
         self.destroy()
 
 
+def benchmark_sidebar(page_counts=(100, 500, 2000)):
+    """Times navigator refreshes for projects of increasing size; needs a display."""
+    import tempfile
+    for page_count in page_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            app_state = AppState(os.path.join(directory, "bench.json"))
+            folder_name = app_state.get_folders()[0]
+            pages = app_state.data["folders"][folder_name]["pages"]
+            for page_index in range(page_count):
+                pages[f"Page {page_index:05d}"] = {"content": [], "notes": ""}
+            app = App(app_state)
+            app.update()
+            page_names = sorted(pages)
+
+            app._sidebar_rows, stale_rows = {}, app._sidebar_rows
+            for row in stale_rows.values():
+                for widget in row["widgets"]:
+                    widget.destroy()
+            started = time.perf_counter()
+            app.update_sidebar()
+            app.update_idletasks()
+            build_ms = (time.perf_counter() - started) * 1000
+
+            refresh_samples = []
+            for page_name in page_names[:: max(1, page_count // 20)]:
+                app.current_page = page_name
+                started = time.perf_counter()
+                app.update_sidebar()
+                app.update_idletasks()
+                refresh_samples.append((time.perf_counter() - started) * 1000)
+
+            app.search_results = {(folder_name, page_name) for page_name in page_names[::3]}
+            started = time.perf_counter()
+            app.update_sidebar()
+            app.update_idletasks()
+            search_ms = (time.perf_counter() - started) * 1000
+
+            widget_count = sum(len(row["widgets"]) for row in app._sidebar_rows.values())
+            print(f"Sidebar {page_count:>5} pages: {widget_count} widgets, full build {build_ms:.0f} ms, "
+                  f"selection refresh median {sorted(refresh_samples)[len(refresh_samples) // 2]:.1f} ms, "
+                  f"search highlight refresh {search_ms:.1f} ms")
+            app.destroy()
+
+
+def benchmark_function_bar(function_count=100, samples=20):
+    """Compares a from-scratch function bar and references rebuild with in-place updates; needs a display."""
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        app_state = AppState(os.path.join(directory, "bench.json"))
+        folder_name = app_state.get_folders()[0]
+        app_state.data["folders"][folder_name]["functions"] = {f"Function {i:03d}": "Prompt" for i in range(function_count)}
+        app_state.data["folders"][folder_name]["pages"]["Bench"] = {"content": [], "notes": ""}
+        app_state.data["references"] = {f"{folder_name}/Ref {i:03d}": {"folder": folder_name, "page": f"Ref {i:03d}"} for i in range(function_count)}
+        app = App(app_state)
+        app.select_page(folder_name, "Bench")
+        app.update()
+
+        def median_ms(action):
+            timings = []
+            for _ in range(samples):
+                started = time.perf_counter()
+                action()
+                app.update_idletasks()
+                timings.append((time.perf_counter() - started) * 1000)
+            return sorted(timings)[len(timings) // 2]
+
+        def rebuild_function_bar():
+            app._destroy_function_bar_widgets()
+            app.update_function_bar()
+
+        def toggle_function_bar():
+            app.current_page = None if app.current_page else "Bench"
+            app.update_function_bar()
+
+        def rebuild_references():
+            for row in app._reference_rows.values():
+                row.destroy()
+            app._reference_rows.clear()
+            app.update_references_list()
+
+        print(f"Function bar, {function_count} functions: rebuild {median_ms(rebuild_function_bar):.1f} ms, "
+              f"in-place update {median_ms(toggle_function_bar):.1f} ms")
+        print(f"References, {function_count} references: rebuild {median_ms(rebuild_references):.1f} ms, "
+              f"in-place update {median_ms(app.update_references_list):.1f} ms")
+        app.destroy()
+
+
+def finish_startup(app, app_state, profiler, profile, budget_ms=None):
+    """Runs once the first window is idle: takes the startup backup and, if asked, reports the profile."""
+    profiler.mark("first idle")
+    ready_ms = profiler.elapsed_ms("first idle")
+    print(f"Window ready in {ready_ms:.0f} ms")
+    print("Creating backup...")
+    app_state.create_backup()
+    profiler.mark("backup (after first paint)")
+    if app_state.get_api_provider() == "openrouter" and app_state.get_prewarm_connections() and app_state.get_selected_api_key_value():
+        HTTP_CLIENT.prewarm(f"{OPENROUTER_BASE_URL}/models")
+    if not profile:
+        app.refresh_model_catalog_if_stale(allow_network=app_state.get_prewarm_connections())
+        return
+    print(profiler.format_report())
+    if budget_ms is not None:
+        within_budget = ready_ms <= budget_ms
+        print(f"Startup budget {budget_ms:.0f} ms: {'OK' if within_budget else 'EXCEEDED'} ({ready_ms:.0f} ms to first idle)")
+        profiler.exit_code = 0 if within_budget else 1
+    app.destroy()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=APP_NAME)
+    parser.add_argument("--pack-icons", action="store_true", help=f"Bundle the PNGs in '{ICONS_FOLDER}' into {ICON_BUNDLE_MODULE}.py and exit.")
+    parser.add_argument("--profile-startup", action="store_true", help="Print a phase-by-phase startup timing breakdown and exit once the window is idle.")
+    parser.add_argument("--startup-budget", type=float, metavar="MS", help="With the startup profile, exit with status 1 if the first idle takes longer than MS milliseconds.")
+    parser.add_argument("--instrument", action="store_true", help="Time every Tk event handler and after() callback and log slow ones (Ctrl+Shift+D shows the stats).")
+    parser.add_argument("--slow-handler-ms", type=float, default=DEFAULT_SLOW_HANDLER_MS, metavar="MS", help="With --instrument, log handlers slower than this with their stack.")
+    parser.add_argument("--benchmark", choices=["find-replace", "sidebar", "function-bar"], help="Run a benchmark instead of starting the editor.")
+    args = parser.parse_args()
+    profiler = StartupProfiler()
+    profiler.mark("imports", IMPORTS_FINISHED)
+    if args.pack_icons:
+        pack_icon_bundle()
+        raise SystemExit(0)
+    if args.benchmark == "find-replace":
+        benchmark_find_replace()
+        raise SystemExit(0)
+    if args.benchmark == "sidebar":
+        benchmark_sidebar()
+        raise SystemExit(0)
+    if args.benchmark == "function-bar":
+        benchmark_function_bar()
+        raise SystemExit(0)
+
     if not os.path.exists(ICONS_FOLDER):
         try:
             os.makedirs(ICONS_FOLDER)
@@ -2117,14 +4011,20 @@ if __name__ == "__main__":
         except OSError as e:
             print(f"Warning: Could not create backup folder '{BACKUP_FOLDER}': {e}")
 
+    if args.instrument:
+        EVENT_LOOP_INSTRUMENTATION = EventLoopInstrumentation(args.slow_handler_ms)
+        EVENT_LOOP_INSTRUMENTATION.install()
+        print(f"Event loop instrumentation enabled (slow handler threshold {args.slow_handler_ms:.0f} ms).")
+
     print("Initializing application state...")
     app_state = AppState()
-
-    print("Creating backup...")
-    app_state.create_backup()
+    profiler.mark("AppState load")
 
     print("Creating application window...")
     app = App(app_state)
     app.protocol("WM_DELETE_WINDOW", app.on_closing)
+    profiler.mark("widget construction")
+    app.after_idle(finish_startup, app, app_state, profiler, args.profile_startup or args.startup_budget is not None, args.startup_budget)
     print("Starting main loop.")
-    app.mainloop()
\ No newline at end of file
+    app.mainloop()
+    raise SystemExit(profiler.exit_code)
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import content_assist_core as core
+
+
+@pytest.fixture
+def make_project(tmp_path):
+    """Returns a factory writing a synthetic project of page_count pages and returning its path."""
+    def make(page_count=20, words_per_page=200):
+        path = str(tmp_path / "project.json")
+        app_state = core.AppState(path)
+        folder_name = app_state.get_folders()[0]
+        pages = app_state.data["folders"][folder_name]["pages"]
+        for page_index in range(page_count):
+            text = core._synthetic_page(page_index, words_per_page)
+            pages[f"Page {page_index:04d}"] = {"content": core.text_dump_to_rich_content(core._synthetic_text_dump(text)), "notes": ""}
+        app_state.save_data()
+        return path
+    return make
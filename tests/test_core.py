@@ -0,0 +1,681 @@
+import concurrent.futures
+import io
+import json
+import os
+import queue
+import re
+import socket
+import threading
+import time
+
+import pytest
+
+import content_assist_core as core
+
+
+def _page_text_and_tags(rich_content_dump):
+    """(plain text, {tag: [tagged substrings]}) of a dump, to compare pages independently of index layout."""
+    text, spans = core.rich_content_to_spans(rich_content_dump)
+    tagged = {}
+    for tag_name, start, end in spans:
+        tagged.setdefault(tag_name, []).append(text[start:end])
+    return core.rich_content_to_plain_text(rich_content_dump), tagged
+
+
+# --- Rich content conversion ---
+def test_text_dump_to_rich_content_merges_runs_and_keeps_toggles():
+    raw_dump = [
+        ("text", "Hello ", "1.0"),
+        ("tagon", "bold", "1.6"),
+        ("text", "bold", "1.6"),
+        ("tagoff", "bold", "1.10"),
+        ("text", " world", "1.10"),
+        ("text", "\n", "1.16"),
+    ]
+    assert core.text_dump_to_rich_content(raw_dump) == [
+        ("text", "Hello ", "1.0"),
+        ("tagon-bold", "", "1.6"),
+        ("text", "bold", "1.6"),
+        ("tagoff-bold", "", "1.10"),
+        ("text", " world\n", "1.10"),
+    ]
+
+
+def test_text_dump_to_rich_content_empty():
+    assert core.text_dump_to_rich_content([]) == []
+
+
+def test_prepare_rich_content_returns_text_and_tag_ranges():
+    rich_content_dump = [
+        ("text", "Line one\n", "1.0"),
+        ("tagon-italic", "", "2.0"),
+        ("text", "Line", "2.0"),
+        ("tagoff-italic", "", "2.4"),
+        ("text", " two\n", "2.4"),
+    ]
+    text, tag_ranges = core.prepare_rich_content(rich_content_dump)
+    assert text == "Line one\nLine two"
+    assert tag_ranges == [("italic", "2.0", "2.4")]
+    assert core.prepare_rich_content([]) == ("", [])
+
+
+def test_spans_round_trip_through_rich_content():
+    text = "alpha beta\ngamma delta\n"
+    spans = [("bold", 6, 10), ("italic", 11, 16)]
+    rich_content_dump = core.spans_to_rich_content(text, spans)
+    assert core.rich_content_to_spans(rich_content_dump) == (text, spans)
+
+
+# --- Replacing ranges ---
+def test_replace_keeps_tags_aligned_after_length_change():
+    rich_content_dump = core.spans_to_rich_content("a cat and a dog\n", [("bold", 12, 15)])
+    new_dump = core.replace_rich_content_ranges(rich_content_dump, [(2, 5, "tiger")])
+    assert _page_text_and_tags(new_dump) == ("a tiger and a dog", {"bold": ["dog"]})
+
+
+def test_replace_several_ranges_shifts_later_tags():
+    text = "one two three four\n"
+    rich_content_dump = core.spans_to_rich_content(text, [("bold", 8, 13), ("italic", 14, 18)])
+    new_dump = core.replace_rich_content_ranges(rich_content_dump, [(0, 3, "1"), (4, 7, "twenty-two")])
+    assert _page_text_and_tags(new_dump) == ("1 twenty-two three four", {"bold": ["three"], "italic": ["four"]})
+
+
+def test_replace_inside_tag_grows_the_tag():
+    rich_content_dump = core.spans_to_rich_content("keep this bold\n", [("bold", 5, 14)])
+    new_dump = core.replace_rich_content_ranges(rich_content_dump, [(5, 9, "that very")])
+    assert _page_text_and_tags(new_dump) == ("keep that very bold", {"bold": ["that very bold"]})
+
+
+def test_replace_over_tag_boundary_moves_it_to_the_new_text():
+    rich_content_dump = core.spans_to_rich_content("plain BOLD tail\n", [("bold", 6, 10)])
+    new_dump = core.replace_rich_content_ranges(rich_content_dump, [(4, 8, "-x-")])
+    assert _page_text_and_tags(new_dump) == ("plai-x-LD tail", {"bold": ["-x-LD"]})
+
+
+def test_regex_replace_counts_matches():
+    rich_content_dump = core.spans_to_rich_content("cat cat dog\n", [("italic", 8, 11)])
+    count, new_dump = core.regex_replace_rich_content(rich_content_dump, re.compile("cat"), "lion")
+    assert count == 2
+    assert _page_text_and_tags(new_dump) == ("lion lion dog", {"italic": ["dog"]})
+    assert core.regex_replace_rich_content(rich_content_dump, re.compile("bird"), "x") == (0, None)
+
+
+# --- Markdown ---
+def test_markdown_tag_spans_excludes_delimiters():
+    text = "a **bold** and *italic* word"
+    spans = core.markdown_tag_spans(text)
+    assert [(tag, text[start:end]) for tag, start, end in spans if tag == "bold"] == [("bold", "bold")]
+    assert ("italic", "italic") in [(tag, text[start:end]) for tag, start, end in spans]
+
+
+def test_markdown_tag_spans_bold_italic_and_underscores():
+    text = "***both*** and __strong__ and _em_"
+    found = {(tag, text[start:end]) for tag, start, end in core.markdown_tag_spans(text)}
+    assert ("bold_italic", "both") in found
+    assert ("bold", "strong") in found
+    assert ("italic", "em") in found
+
+
+def test_markdown_tag_spans_ignores_unclosed_and_empty():
+    assert core.markdown_tag_spans("an *unclosed emphasis") == []
+    assert core.markdown_tag_spans("plain text only") == []
+
+
+# --- Search index ---
+def _project_with_pages(tmp_path, pages):
+    app_state = core.AppState(str(tmp_path / "project.json"))
+    app_state.add_folder("Notes")
+    for page_name, text in pages.items():
+        app_state.add_page("Notes", page_name)
+        app_state.update_page_content("Notes", page_name, core.spans_to_rich_content(text + "\n", []))
+    app_state.save_data()
+    return app_state
+
+
+def test_search_index_substring_and_ranked_queries(tmp_path):
+    app_state = _project_with_pages(tmp_path, {
+        "Dragons": "The dragon flew over the castle. Dragons are rare.",
+        "Castle": "The castle walls were high.",
+        "Sea": "Ships sailed across the narrow sea.",
+    })
+    search_index = core.SearchIndex(app_state)
+    search_index.build()
+    assert search_index.search("CASTLE") == {("Notes", "Dragons"), ("Notes", "Castle")}
+    assert search_index.search("narrow se") == {("Notes", "Sea")}
+    assert search_index.search("unicorn") == set()
+    results = search_index.rank("dragon*")
+    assert [result["page"] for result in results] == ["Dragons"]
+    assert results[0]["snippet"].startswith("The dragon")
+    assert [result["page"] for result in search_index.rank('"castle walls"')] == ["Castle"]
+
+
+def test_search_index_follows_page_edits(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"Page": "old words"})
+    search_index = core.SearchIndex(app_state)
+    search_index.build()
+    app_state.add_content_listener(search_index.on_content_change)
+    app_state.update_page_content("Notes", "Page", core.spans_to_rich_content("new words\n", []))
+    assert search_index.search("old") == set()
+    assert search_index.search("new") == {("Notes", "Page")}
+    app_state.delete_page("Notes", "Page")
+    assert search_index.search("words") == set()
+
+
+def test_search_index_sidecar_round_trip(tmp_path, capsys):
+    app_state = _project_with_pages(tmp_path, {
+        "Dragons": "The dragon flew over the castle.",
+        "Sea": "Ships sailed across the narrow sea.",
+    })
+    search_index = core.SearchIndex(app_state)
+    search_index.build()
+    search_index.save()
+    sidecar = core.sidecar_path(app_state.filename, core.SEARCH_INDEX_SUFFIX)
+    with open(sidecar, encoding="utf-8") as f:
+        assert "narrow sea" not in f.read()
+
+    reloaded_state = core.AppState(app_state.filename)
+    reloaded = core.SearchIndex(reloaded_state)
+    capsys.readouterr()
+    reloaded.build()
+    assert "Search index loaded" in capsys.readouterr().out
+    assert reloaded.search("narrow sea") == {("Notes", "Sea")}
+    assert [result["page"] for result in reloaded.rank("dragon")] == ["Dragons"]
+    assert reloaded.rank("castle")[0]["score"] == search_index.rank("castle")[0]["score"]
+
+
+def test_search_index_sidecar_ignored_after_data_file_changes(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"Page": "first text"})
+    search_index = core.SearchIndex(app_state)
+    search_index.build()
+    search_index.save()
+    app_state.update_page_content("Notes", "Page", core.spans_to_rich_content("second text\n", []))
+    os.utime(app_state.filename, (0, 1))
+
+    reloaded = core.SearchIndex(core.AppState(app_state.filename))
+    reloaded.build()
+    assert reloaded.search("second") == {("Notes", "Page")}
+    assert reloaded.search("first") == set()
+
+
+# --- Streaming ---
+class _ChunkedBody(io.RawIOBase):
+    """Raw body handing out a fixed number of bytes per read, to split multi-byte characters."""
+    def __init__(self, data, chunk_size):
+        self._data = io.BytesIO(data)
+        self._chunk_size = chunk_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._data.read(min(len(buffer), self._chunk_size))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def test_stream_ai_response_decodes_sse_as_utf8(monkeypatch):
+    requests = pytest.importorskip("requests")
+    events = [{"choices": [{"delta": {"content": piece}}]} for piece in ["Café ", "naïve — ", "日本語 ✓"]]
+    body = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events) + "data: [DONE]\n\n"
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "text/event-stream"
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)  # As the transport adapter sets it
+    response.raw = _ChunkedBody(body.encode("utf-8"), 3)
+    monkeypatch.setattr(core.HTTP_CLIENT, "post", lambda **kwargs: response)
+    assert "".join(core.stream_ai_response("openrouter", "key", "model", "", "text")) == "Café naïve — 日本語 ✓"
+
+
+# --- HTTP client ---
+@pytest.fixture
+def hang_up_server():
+    """Local server that reads each request and closes the connection without answering; yields (url, request count)."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    received = []
+
+    def serve():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            with connection:
+                connection.recv(65536)
+                received.append(True)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"http://127.0.0.1:{server.getsockname()[1]}/v1", received
+    server.close()
+
+
+def test_http_post_is_not_retried_once_sent(hang_up_server):
+    requests = pytest.importorskip("requests")
+    url, received = hang_up_server
+    client = core.HttpClient(max_retries=2)
+    client._backoff = lambda attempt: 0
+    with pytest.raises(requests.ConnectionError):
+        client.post(url, json={})
+    assert len(received) == 1
+    with pytest.raises(requests.ConnectionError):
+        client.get(url)
+    assert len(received) == 4
+
+
+def test_http_post_is_retried_when_the_connection_fails():
+    requests = pytest.importorskip("requests")
+    closed_port = socket.socket()
+    closed_port.bind(("127.0.0.1", 0))
+    url = f"http://127.0.0.1:{closed_port.getsockname()[1]}/v1"
+    closed_port.close()
+    client = core.HttpClient(max_retries=2)
+    client._backoff = lambda attempt: 0
+    with pytest.raises(requests.ConnectionError):
+        client.post(url, json={})
+    assert client.stats["retries"] == 2
+
+
+# --- Response cache ---
+@pytest.fixture
+def response_cache(tmp_path):
+    cache = core.ResponseCache(str(tmp_path / "responses.sqlite"))
+    yield cache
+    cache.close()
+
+
+def _read_stream(cache, key, produce, cancel_event=None):
+    outcome = {}
+    pieces = list(cache.stream(key, produce, cancel_event, outcome))
+    return pieces, outcome.get("cache")
+
+
+def _coalesced_requests(monkeypatch, response_cache, leader_cancel):
+    """Starts a leader whose first piece is out and an identical follower waiting on it; returns (leader, follower, release, follower_calls)."""
+    producing, release, waiting = threading.Event(), threading.Event(), threading.Event()
+    follower_calls = []
+
+    def leader_produce():
+        producing.set()
+        yield "Hel"
+        release.wait(5)
+        if not leader_cancel.is_set():
+            yield "lo"
+
+    def follower_produce():
+        follower_calls.append(True)
+        yield from ["Hel", "lo"]
+
+    original_wait = core._InFlightResponse.wait
+
+    def recording_wait(flight, cancel_event=None):
+        waiting.set()
+        return original_wait(flight, cancel_event)
+
+    monkeypatch.setattr(core._InFlightResponse, "wait", recording_wait)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    leader = executor.submit(_read_stream, response_cache, "key", leader_produce, leader_cancel)
+    assert producing.wait(5)
+    follower = executor.submit(_read_stream, response_cache, "key", follower_produce)
+    assert waiting.wait(5)
+    executor.shutdown(wait=False)
+    return leader, follower, release, follower_calls
+
+
+def test_response_cache_shares_an_identical_request_in_flight(monkeypatch, response_cache):
+    leader, follower, release, follower_calls = _coalesced_requests(monkeypatch, response_cache, threading.Event())
+    release.set()
+    assert leader.result(5) == (["Hel", "lo"], "miss")
+    assert follower.result(5) == (["Hello"], "shared")
+    assert follower_calls == []
+    assert response_cache.get("key") == "Hello"
+
+
+def test_response_cache_follower_takes_over_when_the_leader_is_cancelled(monkeypatch, response_cache):
+    leader_cancel = threading.Event()
+    leader, follower, release, follower_calls = _coalesced_requests(monkeypatch, response_cache, leader_cancel)
+    leader_cancel.set()
+    release.set()
+    assert leader.result(5) == (["Hel"], "miss")
+    assert follower.result(5) == (["Hel", "lo"], "miss")
+    assert follower_calls == [True]
+    assert response_cache.get("key") == "Hello"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Settable replacement for time.time, so cache timestamps are deterministic."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(core.time, "time", lambda: now[0])
+    return now
+
+
+def test_response_cache_evicts_least_recently_used_past_max_bytes(tmp_path, clock):
+    cache = core.ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=10)
+    cache.put("a", "aaaa")
+    clock[0] += 1
+    cache.put("b", "bbbb")
+    clock[0] += 1
+    assert cache.get("a") == "aaaa"
+    clock[0] += 1
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("aaaa", "cccc")
+    assert cache.stats["evictions"] == 1
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") is None and cache.get("a") == "aaaa"
+    cache.close()
+
+    reopened = core.ResponseCache(cache.path, max_bytes=10)
+    assert reopened._total_bytes == 8  # The size accounting is restored from disk
+    reopened.close()
+
+
+def test_response_cache_expires_entries_by_age(tmp_path, clock):
+    cache = core.ResponseCache(str(tmp_path / "responses.sqlite"), max_age_days=1)
+    cache.put("old", "old response")
+    cache.put("stale", "stale response")
+    clock[0] += 86400 + 1
+    assert cache.get("old") is None
+    assert cache.stats["evictions"] == 1
+    cache.put("new", "new response")  # Storing also sweeps out the expired entries
+    assert cache.stats["evictions"] == 2
+    assert cache.get("new") == "new response"
+    assert cache._total_bytes == len("new response")
+    cache.close()
+
+
+def test_response_cache_after_close(response_cache):
+    response_cache.put("key", "stored")
+    response_cache.close()
+    assert response_cache.get("key") is None
+    response_cache.put("key", "dropped")
+    response_cache.clear()
+    assert _read_stream(response_cache, "key", lambda: iter(["fresh"])) == (["fresh"], "miss")
+    response_cache.close()
+
+
+# --- AI jobs ---
+def _wait_for(condition, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, "timed out waiting for the scheduler"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = core.AIJobScheduler()
+    yield scheduler
+    scheduler.shutdown()
+
+
+def _gated_runner(started, release, text="result"):
+    """Runner that records its page, then streams text once release is set or the job is cancelled."""
+    def runner(job):
+        started.append(job.page_key)
+        while not release.is_set() and not job.cancel_event.is_set():
+            time.sleep(0.002)
+        job.emit(text)
+    return runner
+
+
+def test_scheduler_runs_one_job_per_page(scheduler):
+    started, release = [], threading.Event()
+    first = scheduler.submit("Notes", "A", "Summarize", _gated_runner(started, release))
+    second = scheduler.submit("Notes", "A", "Expand", _gated_runner(started, release))
+    other = scheduler.submit("Notes", "B", "Summarize", _gated_runner(started, release))
+    _wait_for(lambda: len(started) == 2)
+    assert (first.status, second.status, other.status) == ("running", "queued", "running")
+    assert scheduler.is_page_busy("Notes", "A")
+    release.set()
+    _wait_for(lambda: not first.active and not second.active and not other.active)
+    assert started == [("Notes", "A"), ("Notes", "B"), ("Notes", "A")]
+    assert second.started_at >= first.finished_at
+    assert not scheduler.is_page_busy("Notes", "A")
+
+
+def test_scheduler_starts_queued_jobs_by_priority(scheduler):
+    scheduler.set_max_workers(1)
+    started, release = [], threading.Event()
+    blocker = scheduler.submit("Notes", "Blocker", "Summarize", _gated_runner(started, release))
+    _wait_for(lambda: blocker.status == "running")
+    scheduler.submit("Notes", "Background 1", "Summarize", _gated_runner(started, release), core.AI_JOB_BACKGROUND)
+    scheduler.submit("Notes", "Background 2", "Summarize", _gated_runner(started, release), core.AI_JOB_BACKGROUND)
+    interactive = scheduler.submit("Notes", "Interactive", "Summarize", _gated_runner(started, release))
+    assert [job.page_name for job in scheduler.active_jobs()] == ["Blocker", "Interactive", "Background 1", "Background 2"]
+    release.set()
+    _wait_for(lambda: not scheduler.active_jobs())
+    assert [page_name for _, page_name in started] == ["Blocker", "Interactive", "Background 1", "Background 2"]
+    assert interactive.status == "done"
+
+
+def test_scheduler_cancel_queued_and_running_jobs(scheduler):
+    scheduler.set_max_workers(1)
+    started, release = [], threading.Event()
+    events = []
+    scheduler.add_listener(lambda job: events.append((job.page_name, job.status)))
+    running = scheduler.submit("Notes", "A", "Summarize", _gated_runner(started, release))
+    queued = scheduler.submit("Notes", "B", "Summarize", _gated_runner(started, release))
+    _wait_for(lambda: running.status == "running")
+
+    assert scheduler.cancel(queued.id)
+    assert queued.status == "cancelled" and ("B", "cancelled") in events
+
+    assert scheduler.cancel(running.id)
+    assert running.cancel_event.is_set()
+    _wait_for(lambda: running.status == "cancelled")
+    assert running.take_text() == "result"  # What the runner produced before stopping is kept
+    assert started == [("Notes", "A")]
+    assert not scheduler.cancel(running.id)
+    assert [job.page_name for job in scheduler.jobs()] == ["A", "B"]
+
+
+def test_apply_ai_job_text_appends_under_a_separator(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"A": "Body text"})
+    job = core.AIJob(1, "Notes", "A", "Summarize", None)
+    assert core.apply_ai_job_text(app_state, job, "Hello")
+    assert core.apply_ai_job_text(app_state, job, " world")
+    assert app_state.get_page_plain_text("Notes", "A") == "Body text\n\n--- AI Result (Summarize) ---\nHello world"
+    _, tagged = _page_text_and_tags(app_state.get_page_content("Notes", "A"))
+    assert tagged["ai_separator"] == ["\n\n--- AI Result (Summarize) ---"]
+
+
+def test_apply_ai_job_text_replaces_an_unchanged_selection(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"A": "keep this word here"})
+    version = app_state.get_page_version("Notes", "A")
+    job = core.AIJob(1, "Notes", "A", "Rewrite", None, details={"selection": (10, 14), "version": version})
+    core.apply_ai_job_text(app_state, job, "phrase")
+    core.apply_ai_job_text(app_state, job, "!")
+    assert app_state.get_page_plain_text("Notes", "A") == "keep this phrase! here"
+
+
+def test_apply_ai_job_text_appends_when_the_page_changed(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"A": "keep this word here"})
+    version = app_state.get_page_version("Notes", "A")
+    app_state.update_page_content("Notes", "A", core.spans_to_rich_content("edited meanwhile\n", []))
+    job = core.AIJob(1, "Notes", "A", "Rewrite", None, details={"selection": (10, 14), "version": version})
+    core.apply_ai_job_text(app_state, job, "phrase")
+    assert app_state.get_page_plain_text("Notes", "A") == "edited meanwhile\n\n--- AI Result (Rewrite) ---\nphrase"
+    assert job.details["selection"] is None
+
+
+def test_apply_ai_job_text_on_a_deleted_page(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"A": "text"})
+    app_state.delete_page("Notes", "A")
+    assert not core.apply_ai_job_text(app_state, core.AIJob(1, "Notes", "A", "Summarize", None), "result")
+
+
+# --- Batch runs ---
+def _start_batch(scheduler, app_state, page_names, make_runner, **options):
+    """Starts a BatchRun; returns it with the queue its finished jobs arrive on, as the App's listener would forward them."""
+    batch = core.BatchRun(scheduler, app_state, "Notes", page_names, "Shout", make_runner, **options)
+    finished = queue.Queue()
+    scheduler.add_listener(lambda job: finished.put(job) if not job.active and job.details.get("batch") is batch else None)
+    batch.start()
+    return batch, finished
+
+
+def _drain_batch(batch, finished, until=None):
+    """Feeds finished jobs to the batch on this thread until it is done, or until(batch) holds."""
+    while not batch.done and not (until and until(batch)):
+        batch.job_finished(finished.get(timeout=5))
+
+
+def _shout_runner(page_text):
+    return lambda job: job.emit(page_text.upper())
+
+
+def _flaky_runner(failures_left):
+    """make_runner whose runner raises while failures_left[page] is positive, then shouts the page text."""
+    def make_runner(page_text):
+        def runner(job):
+            if failures_left.get(job.page_name, 0) > 0:
+                failures_left[job.page_name] -= 1
+                raise ConnectionError("provider unavailable")
+            job.emit(page_text.upper())
+        return runner
+    return make_runner
+
+
+def test_batch_append_mode_writes_all_results_with_one_save(tmp_path, scheduler, monkeypatch):
+    app_state = _project_with_pages(tmp_path, {"A": "alpha", "B": "beta", "Empty": "", "C": "gamma"})
+    batch, finished = _start_batch(scheduler, app_state, ["A", "B", "Empty", "C"], _shout_runner, parallelism=2)
+    _drain_batch(batch, finished)
+    assert batch.skipped == ["Empty"]
+    assert app_state.get_page_plain_text("Notes", "A") == "alpha"  # Nothing is written before commit
+    writes = []
+    original_save = app_state.save_data
+
+    def counting_save():
+        if not app_state._save_batch_depth:
+            writes.append(True)
+        original_save()
+
+    monkeypatch.setattr(app_state, "save_data", counting_save)
+    assert sorted(batch.commit()) == [("Notes", "A"), ("Notes", "B"), ("Notes", "C")]
+    assert len(writes) == 1
+    assert app_state.get_page_plain_text("Notes", "B") == "beta\n\n--- AI Result (Shout) ---\nBETA"
+    assert batch.commit() == []
+    assert batch.format_progress().startswith("4/4 pages")
+
+
+def test_batch_replace_mode_replaces_the_page(tmp_path, scheduler):
+    app_state = _project_with_pages(tmp_path, {"A": "alpha", "B": "beta"})
+    batch, finished = _start_batch(scheduler, app_state, ["A", "B"], _shout_runner, mode="replace")
+    _drain_batch(batch, finished)
+    batch.commit()
+    assert app_state.get_page_plain_text("Notes", "A") == "ALPHA"
+    assert app_state.get_page_plain_text("Notes", "B") == "BETA"
+    assert batch.conflicts == []
+
+
+def test_batch_replace_mode_appends_to_a_page_edited_during_the_run(tmp_path, scheduler):
+    app_state = _project_with_pages(tmp_path, {"A": "alpha", "B": "beta"})
+    batch, finished = _start_batch(scheduler, app_state, ["A", "B"], _shout_runner, mode="replace")
+    _drain_batch(batch, finished)
+    app_state.update_page_content("Notes", "A", core.spans_to_rich_content("alpha, edited\n", []))
+    batch.commit()
+    assert app_state.get_page_plain_text("Notes", "A") == "alpha, edited\n\n--- AI Result (Shout) ---\nALPHA"
+    assert app_state.get_page_plain_text("Notes", "B") == "BETA"
+    assert batch.conflicts == ["A"]
+    assert "1 edited during the run, result appended" in batch.format_progress()
+
+
+def test_batch_new_page_mode_keeps_the_source_pages(tmp_path, scheduler):
+    app_state = _project_with_pages(tmp_path, {"A": "alpha", "A (Shout)": "taken"})
+    batch, finished = _start_batch(scheduler, app_state, ["A"], _shout_runner, mode="new page")
+    _drain_batch(batch, finished)
+    assert batch.commit() == [("Notes", "A (Shout 2)")]
+    assert app_state.get_page_plain_text("Notes", "A") == "alpha"
+    assert app_state.get_page_plain_text("Notes", "A (Shout)") == "taken"
+    assert app_state.get_page_plain_text("Notes", "A (Shout 2)") == "ALPHA"
+
+
+def test_batch_retries_failed_pages_up_to_max_retries(tmp_path, scheduler):
+    app_state = _project_with_pages(tmp_path, {"Flaky": "flaky", "Broken": "broken", "Fine": "fine"})
+    failures_left = {"Flaky": 2, "Broken": 10}
+    batch, finished = _start_batch(scheduler, app_state, ["Flaky", "Broken", "Fine"], _flaky_runner(failures_left), max_retries=2)
+    _drain_batch(batch, finished)
+    assert batch.results == {"Flaky": "FLAKY", "Fine": "FINE"}
+    assert batch.failed_pages() == ["Broken"]
+    assert isinstance(batch.failures["Broken"], ConnectionError)
+    assert batch.attempts == {"Flaky": 3, "Broken": 3, "Fine": 1}
+    assert batch.retries == 4
+    assert "1 failed, 4 retries" in batch.format_progress()
+
+
+def test_batch_cancel_then_commit_keeps_finished_results(tmp_path, scheduler):
+    app_state = _project_with_pages(tmp_path, {"A": "alpha", "B": "beta", "C": "gamma"})
+    release = threading.Event()
+
+    def make_runner(page_text):
+        return _shout_runner(page_text) if page_text == "alpha" else _gated_runner([], release, page_text.upper())
+
+    batch, finished = _start_batch(scheduler, app_state, ["A", "B", "C"], make_runner, parallelism=1)
+    _drain_batch(batch, finished, until=lambda batch: "A" in batch.results)
+    batch.cancel()
+    _drain_batch(batch, finished)
+    assert batch.done and batch.cancelled
+    assert batch.failed_pages() == [] and batch.retries == 0
+    assert batch.attempts == {"A": 1, "B": 1}
+    assert batch.commit() == [("Notes", "A")]
+    assert app_state.get_page_plain_text("Notes", "B") == "beta"
+
+
+def test_batch_page_cancelled_alone_is_reported_as_failed(tmp_path, scheduler):
+    app_state = _project_with_pages(tmp_path, {"A": "alpha", "B": "beta"})
+    release = threading.Event()
+    batch, finished = _start_batch(scheduler, app_state, ["A", "B"], lambda page_text: _gated_runner([], release, page_text.upper()), parallelism=2)
+    job_a = next(job for job in scheduler.active_jobs() if job.page_name == "A")
+    scheduler.cancel(job_a.id)
+    release.set()
+    _drain_batch(batch, finished)
+    assert batch.failed_pages() == ["A"]
+    assert batch.attempts["A"] == 1 and batch.retries == 0
+    assert "1 failed" in batch.format_progress()
+    assert batch.commit() == [("Notes", "B")]
+
+
+# --- AppState ---
+def test_page_version_changes_on_content_updates(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"A": "one", "B": "two"})
+    version_a = app_state.get_page_version("Notes", "A")
+    version_b = app_state.get_page_version("Notes", "B")
+    assert version_a != version_b
+    app_state.update_page_content("Notes", "A", core.spans_to_rich_content("changed\n", []))
+    assert app_state.get_page_version("Notes", "A") not in (version_a, version_b)
+    assert app_state.get_page_version("Notes", "B") == version_b
+    assert app_state.get_page_plain_text("Notes", "A") == "changed"
+
+
+def test_batch_updates_writes_once_on_exit(tmp_path, monkeypatch):
+    app_state = _project_with_pages(tmp_path, {"A": "one"})
+    writes = []
+    original_save = app_state.save_data
+
+    def counting_save():
+        if not app_state._save_batch_depth:
+            writes.append(True)
+        original_save()
+
+    monkeypatch.setattr(app_state, "save_data", counting_save)
+    with app_state.batch_updates():
+        with app_state.batch_updates():
+            for index in range(5):
+                app_state.update_page_content("Notes", "A", core.spans_to_rich_content(f"edit {index}\n", []))
+        assert writes == []
+    assert writes == [True]
+    with open(app_state.filename, encoding="utf-8") as f:
+        stored = json.load(f)
+    assert core.rich_content_to_plain_text(stored["folders"]["Notes"]["pages"]["A"]["content"]) == "edit 4"
+
+
+def test_batch_updates_without_changes_does_not_write(tmp_path):
+    app_state = _project_with_pages(tmp_path, {"A": "one"})
+    modified = os.path.getmtime(app_state.filename)
+    os.utime(app_state.filename, (0, 1))
+    with app_state.batch_updates():
+        pass
+    assert os.path.getmtime(app_state.filename) == 1
+    assert modified != 1
@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import content_assist_core as core
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Generous enough for a loaded CI machine; override with CONTENT_ASSIST_STARTUP_BUDGET_MS
+STARTUP_BUDGET_MS = float(os.environ.get("CONTENT_ASSIST_STARTUP_BUDGET_MS", 1500))
+IMPORT_BUDGET_MS = 500
+LAZY_MODULES = ["google.generativeai", "google.api_core", "requests", "PIL"]
+
+
+def _open_project(path):
+    """The headless part of App startup: load the data file and whichever index sidecars are current.
+
+    Returns the indexes that still need a cold build, which the App runs on a worker thread.
+    """
+    app_state = core.AppState(path)
+    app_state.load_data()
+    completion_index = core.CompletionIndex(app_state)
+    search_index = core.SearchIndex(app_state)
+    cold_indexes = [index for index in (completion_index, search_index) if not index.load()]
+    core.ChunkRetriever(app_state).build()
+    return app_state, completion_index, search_index, cold_indexes
+
+
+def test_core_import_is_fast_and_leaves_providers_unloaded():
+    script = (
+        "import sys, time\n"
+        "started = time.perf_counter()\n"
+        "import content_assist_core\n"
+        "elapsed_ms = (time.perf_counter() - started) * 1000\n"
+        f"print(elapsed_ms, [name for name in {LAZY_MODULES!r} if name in sys.modules])\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    elapsed_ms, loaded = result.stdout.strip().splitlines()[-1].split(" ", 1)
+    assert float(elapsed_ms) < IMPORT_BUDGET_MS
+    assert loaded == "[]"
+
+
+def test_cold_project_open_defers_index_builds(make_project):
+    path = make_project(page_count=1500, words_per_page=500)
+    started = time.perf_counter()
+    app_state, completion_index, search_index, cold_indexes = _open_project(path)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    assert len(app_state.get_pages(app_state.get_folders()[0])) == 1500
+    assert cold_indexes == [completion_index, search_index]
+    assert elapsed_ms < STARTUP_BUDGET_MS / 3, f"cold project open took {elapsed_ms:.0f} ms"
+
+
+def test_cold_index_build_within_budget(make_project):
+    path = make_project(page_count=200, words_per_page=500)
+    _, _, search_index, cold_indexes = _open_project(path)
+    started = time.perf_counter()
+    for index in cold_indexes:
+        index.index_pages()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    assert search_index.search("council")
+    assert elapsed_ms < STARTUP_BUDGET_MS, f"cold index build took {elapsed_ms:.0f} ms"
+
+
+def test_warm_project_open_uses_sidecars(make_project):
+    path = make_project(page_count=200, words_per_page=500)
+    _, completion_index, search_index, cold_indexes = _open_project(path)
+    for index in cold_indexes:
+        index.index_pages()
+    completion_index.save()
+    search_index.save()
+    started = time.perf_counter()
+    _, _, _, cold_indexes = _open_project(path)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    assert cold_indexes == []
+    assert elapsed_ms < STARTUP_BUDGET_MS / 3, f"warm project open took {elapsed_ms:.0f} ms"
+
+
+@pytest.mark.skipif(not os.environ.get("DISPLAY") and sys.platform.startswith("linux"), reason="needs a display")
+def test_window_startup_within_budget(tmp_path):
+    pytest.importorskip("customtkinter")
+    # Run from an empty directory so the app creates a fresh data file and backups there
+    result = subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, "Content_Assist_V2.py"), "--startup-budget", str(STARTUP_BUDGET_MS)],
+        cwd=tmp_path, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]